@@ -23,79 +23,73 @@
 #   Alvaro del Castillo San Felix <acs@bitergia.com>
 #
 
+import asyncio
 import inspect
+import itertools
+import json
 import logging
-import pickle
+import multiprocessing
+import sys
 import traceback
 
 import redis
 
+from collections import OrderedDict
 from datetime import datetime
 from dateutil import parser
+from queue import Empty
 
 from arthur.common import Q_STORAGE_ITEMS
 
+from .arthur_queue import ArthurQueue
 from .ocean.conf import ConfOcean
 from .utils import get_elastic
 from .utils import get_connectors, get_connector_from_name
+from .elk.elastic import BulkWriter
+from .elk.enrich import Enrich
 from .elk.utils import get_last_enrich, grimoire_con
+from .metrics import metrics
+from .studies import run_studies
 
 
 logger = logging.getLogger(__name__)
 
 requests_ses = grimoire_con()
 
-arthur_items = {}  # Hash with tag list with all items collected from arthur queue
+HEADER_JSON = {"Content-Type": "application/json"}
 
+ARTHUR_REDIS_URL = 'redis://localhost/8'
 
-def feed_arthur():
-    """ Feed Ocean with backend data collected from arthur redis queue"""
+arthur_queue_stats = {}  # Lag and progress of the last arthur queue consumed
 
-    logger.info("Collecting items from redis queue")
+load_identities_stats = {}  # Progress of the last load_identities execution
 
-    db_url = 'redis://localhost/8'
+LOAD_IDENTITIES_SEEN = 100000  # keys of the last identities not sent again to SortingHat
 
-    conn = redis.StrictRedis.from_url(db_url)
-    logger.debug("Redis connection stablished with %s.", db_url)
+SLICES_CHECK_SECONDS = 10  # seconds waiting for results between checks of the slices processes
 
-    # Get and remove queued items in an atomic transaction
-    pipe = conn.pipeline()
-    pipe.lrange(Q_STORAGE_ITEMS, 0, -1)
-    pipe.ltrim(Q_STORAGE_ITEMS, 1, 0)
-    items = pipe.execute()[0]
 
-    for item in items:
-        arthur_item = pickle.loads(item)
-        if arthur_item['tag'] not in arthur_items:
-            arthur_items[arthur_item['tag']] = []
-        arthur_items[arthur_item['tag']].append(arthur_item)
-
-    for tag in arthur_items:
-        logger.debug("Items for %s: %i", tag, len(arthur_items[tag]))
+def feed_backend_arthur(ocean_backend, tag):
+    """ Feed Ocean with the items of a tag collected from arthur redis queue
 
+    The items are read and stored in batches of a bulk pack, and each
+    batch is removed from the queue only once it is stored. The items
+    that couldn't be stored are kept in the queue for the next run.
+    """
 
-def feed_backend_arthur(backend_name, backend_params):
-    """ Feed Ocean with backend data collected from arthur redis queue"""
+    logger.info("Collecting items for %s from redis queue", tag)
 
-    # Always get pending items from arthur for all data sources
-    feed_arthur()
+    conn = redis.StrictRedis.from_url(ARTHUR_REDIS_URL)
+    logger.debug("Redis connection stablished with %s.", ARTHUR_REDIS_URL)
 
-    logger.debug("Items available for %s", arthur_items.keys())
+    queue = ArthurQueue(conn, Q_STORAGE_ITEMS, tag, ocean_backend.elastic.max_items_bulk)
+    for items in queue.batches():
+        failed = ocean_backend.feed(arthur_items=items)
+        queue.ack(failed)
+        arthur_queue_stats.update(queue.stats)
 
-    # Get only the items for the backend
-    if not get_connector_from_name(backend_name):
-        raise RuntimeError("Unknown backend %s" % backend_name)
-    connector = get_connector_from_name(backend_name)
-    klass = connector[3]  # BackendCmd for the connector
-
-    backend_cmd = klass(*backend_params)
-    tag = backend_cmd.backend.tag
-    logger.debug("Getting items for %s.", tag)
-
-    if tag in arthur_items:
-        logger.debug("Found items for %s.", tag)
-        for item in arthur_items[tag]:
-            yield item
+    arthur_queue_stats.update(queue.stats)
+    logger.debug("Items collected for %s: %i", tag, queue.stats["items"])
 
 
 def feed_backend(url, clean, fetch_cache, backend_name, backend_params,
@@ -106,6 +100,7 @@ def feed_backend(url, clean, fetch_cache, backend_name, backend_params,
     repo = {}    # repository data to be stored in conf
     repo['backend_name'] = backend_name
     repo['backend_params'] = backend_params
+    start = datetime.now()
 
     if es_index:
         clean = False  # don't remove index, it could be shared
@@ -171,10 +166,8 @@ def feed_backend(url, clean, fetch_cache, backend_name, backend_params,
 
         # fetch params support
         if arthur:
-            # If using arthur just provide the items generator to be used
-            # to collect the items and upload to Elasticsearch
-            aitems = feed_backend_arthur(backend_name, backend_params)
-            ocean_backend.feed(arthur_items=aitems)
+            # If using arthur, the items of the backend come from its queue
+            feed_backend_arthur(ocean_backend, backend.tag)
         elif latest_items:
             if category:
                 ocean_backend.feed(latest_items=latest_items, category=category)
@@ -221,90 +214,160 @@ def feed_backend(url, clean, fetch_cache, backend_name, backend_params,
         logger.debug("Repository not added to Ocean because errors.")
         logger.debug(backend_params)
 
+    metrics.observe('stage_seconds', (datetime.now() - start).total_seconds(),
+                    stage="feed_backend", backend=backend_name)
+    if not repo['success']:
+        metrics.inc('feed_errors_total', backend=backend_name)
+
     logger.info("Done %s " % (backend_name))
 
 
 def get_items_from_uuid(uuid, enrich_backend, ocean_backend):
     """ Get all items that include uuid """
 
-    # logger.debug("Getting items for merged uuid %s "  % (uuid))
+    return list(get_items_from_uuids([uuid], enrich_backend, ocean_backend))
+
+
+def get_items_from_uuids(uuids, enrich_backend, ocean_backend):
+    """ Get all the raw items whose enriched items include any of the uuids
 
+    The enriched items are searched with terms queries of at most
+    max_items_clause uuids, reading all their pages. Each raw item is
+    returned once, read with _mget in chunks of max_items_clause ids.
+
+    :param uuids: iterable with the uuids to search
+    :param enrich_backend: enrich backend whose index includes the uuids
+    :param ocean_backend: backend with the raw items
+    :returns: generator of raw items
+    """
+
+    max_ids = enrich_backend.elastic.max_items_clause
     uuid_fields = enrich_backend.get_fields_uuid()
 
-    terms = ""  # all terms with uuids in the enriched item
+    uuids = sorted(set(uuids))
+    items_ids = set()  # items already returned
+
+    def get_items(ids):
+        url_mget = ocean_backend.elastic.index_url + "/_mget"
+        query = {"docs": [{"_id": item_id} for item_id in ids]}
+        r = requests_ses.post(url_mget, data=json.dumps(query), headers=HEADER_JSON)
+        r.raise_for_status()
+        for res_item in r.json()['docs']:
+            if res_item.get('found'):
+                yield res_item["_source"]
 
-    for field in uuid_fields:
-        terms += """
-         {"term": {
-           "%s": {
-              "value": "%s"
-           }
-         }}
-         """ % (field, uuid)
-        terms += ","
+    for i in range(0, len(uuids), max_ids):
+        uuids_chunk = uuids[i:i + max_ids]
+        terms = [{"terms": {field: uuids_chunk}} for field in uuid_fields]
+        query = {"query": {"bool": {"should": terms}}}
 
-    terms = terms[:-1]  # remove last , for last item
+        new_ids = []
+        for eitem in enrich_backend.elastic.scroll_hits(query, size=max_ids):
+            # For one item several eitems could be generated
+            item_id = enrich_backend.get_item_id(eitem)
+            if item_id not in items_ids:
+                items_ids.add(item_id)
+                new_ids.append(item_id)
 
-    query = """
-    {"query": { "bool": { "should": [%s] }}}
-    """ % (terms)
+            if len(new_ids) >= max_ids:
+                yield from get_items(new_ids)
+                new_ids = []
 
-    url_search = enrich_backend.elastic.index_url + "/_search"
-    url_search += "?size=1000"  # TODO get all items
+        if new_ids:
+            yield from get_items(new_ids)
 
-    r = requests_ses.post(url_search, data=query)
+    logger.debug("Items to be renriched for %i merged uuids: %i", len(uuids), len(items_ids))
 
-    eitems = r.json()['hits']['hits']
 
-    if len(eitems) == 0:
-        # logger.warning("No enriched items found for uuid: %s " % (uuid))
-        return []
+def get_changed_fields(eitem, new_fields):
+    """ Get the fields of new_fields whose value is not the one in eitem """
 
-    items_ids = []
+    return {field: value for field, value in new_fields.items() if eitem.get(field) != value}
 
-    for eitem in eitems:
-        item_id = enrich_backend.get_item_id(eitem)
-        # For one item several eitems could be generated
-        if item_id not in items_ids:
-            items_ids.append(item_id)
 
-    # Time to get the items
-    logger.debug("Items to be renriched for merged uuids: %s" % (",".join(items_ids)))
+def fetch_hits(enrich_backend, _filter=None):
+    """ Get the _id and the enriched item of the hits of the enriched index """
 
-    url_mget = ocean_backend.elastic.index_url + "/_mget"
+    for page in enrich_backend.fetch_pages(_filter):
+        for hit in page:
+            yield hit['_id'], hit['_source']
 
-    items_ids_query = ""
 
-    for item_id in items_ids:
-        items_ids_query += '{"_id" : "%s"}' % (item_id)
-        items_ids_query += ","
-    items_ids_query = items_ids_query[:-1]  # remove last , for last item
+def update_items(enrich_backend, updates):
+    """ Send the partial updates of the enriched items and wait until they
+    are visible in searches
 
-    query = '{"docs" : [%s]}' % (items_ids_query)
-    r = requests_ses.post(url_mget, data=query)
+    :param updates: (doc_id, fields) of the enriched items to update
+    :returns: number of enriched items updated
+    """
+
+    with BulkWriter(enrich_backend.elastic) as writer:
+        for doc_id, fields in updates:
+            writer.update(doc_id, fields)
 
-    res_items = r.json()['docs']
+    if writer.total:
+        enrich_backend.elastic.refresh_index()
 
-    items = []
-    for res_item in res_items:
-        if res_item['found']:
-            items.append(res_item["_source"])
+    logger.debug("Updated %i/%i items in %s (%0.2f MB)", writer.total, writer.added,
+                 enrich_backend.elastic.index_url, writer.total_bytes / (1024 * 1024))
 
-    return items
+    return writer.total
 
 
 def refresh_projects(enrich_backend):
+    """Refresh the project fields in enriched index.
+
+    :param enrich_backend: enriched backend to update
+    :returns: generator of the (doc_id, fields) of the items whose project
+        fields change
+    """
     logger.debug("Refreshing project field in %s", enrich_backend.elastic.index_url)
     total = 0
+    changed = 0
 
-    eitems = enrich_backend.fetch()
-    for eitem in eitems:
-        new_project = enrich_backend.get_item_project(eitem)
-        eitem.update(new_project)
-        yield eitem
+    for doc_id, eitem in fetch_hits(enrich_backend):
         total += 1
+        new_project = get_changed_fields(eitem, enrich_backend.get_item_project(eitem))
+        if new_project:
+            changed += 1
+            yield doc_id, new_project
 
-    logger.info("Total eitems refreshed for project field %i", total)
+    logger.info("Total eitems refreshed for project field %i, changed %i", total, changed)
+
+
+class UuidsItems(object):
+    """ Raw items including a set of uuids, fetched like from an ocean backend """
+
+    def __init__(self, uuids, enrich_backend, ocean_backend):
+        self.uuids = uuids
+        self.enrich_backend = enrich_backend
+        self.ocean_backend = ocean_backend
+
+    def fetch(self):
+        return get_items_from_uuids(self.uuids, self.enrich_backend, self.ocean_backend)
+
+
+def refresh_uuids_items(ocean_backend, enrich_backend, uuids):
+    """ Enrich again the raw items including any of the uuids
+
+    The uuids of merged identities could be in other roles than author,
+    so all the raw items including them are enriched again, looking up
+    all the uuids in one batch.
+
+    :param ocean_backend: backend with the raw items of the enriched index
+    :param enrich_backend: enriched backend to update
+    :param uuids: list of uuids to refresh
+    :returns: number of items enriched
+    """
+
+    logger.debug("Refreshing the items of %i uuids in %s", len(uuids),
+                 enrich_backend.elastic.index_url)
+
+    total = enrich_backend.enrich_items(UuidsItems(uuids, enrich_backend, ocean_backend))
+
+    logger.info("Total items enriched again for %i uuids: %i", len(uuids), total)
+
+    return total
 
 
 def refresh_identities(enrich_backend, filter_author=None):
@@ -319,60 +382,98 @@ def refresh_identities(enrich_backend, filter_author=None):
 
     :param enrich_backend: enriched backend to update
     :param  filter_author: filter to use to match items
+    :returns: generator of the (doc_id, fields) of the items whose identities
+        fields change
     """
 
-    def update_items(new_filter_author):
+    stats = {"total": 0, "changed": 0}
 
-        for eitem in enrich_backend.fetch(new_filter_author):
-            # logger.info(eitem)
-            roles = None
-            try:
-                roles = enrich_backend.roles
-            except AttributeError:
-                pass
-            new_identities = enrich_backend.get_item_sh_from_id(eitem, roles)
-            eitem.update(new_identities)
-            yield eitem
+    def refresh_items(new_filter_author):
 
-    logger.debug("Refreshing identities fields from %s", enrich_backend.elastic.index_url)
+        roles = None
+        try:
+            roles = enrich_backend.roles
+        except AttributeError:
+            pass
 
-    total = 0
+        for doc_id, eitem in fetch_hits(enrich_backend, new_filter_author):
+            stats["total"] += 1
+            new_identities = get_changed_fields(eitem, enrich_backend.get_item_sh_from_id(eitem, roles))
+            if new_identities:
+                stats["changed"] += 1
+                yield doc_id, new_identities
+
+    logger.debug("Refreshing identities fields from %s", enrich_backend.elastic.index_url)
 
     max_ids = enrich_backend.elastic.max_items_clause
 
     if filter_author is None:
         # No filter, update all items
-        for item in update_items(None):
-            yield item
-            total += 1
+        yield from refresh_items(None)
     else:
-        nidentities = len(filter_author['value'])
-        logger.debug('Identities to refresh: %i', nidentities)
-        if nidentities > max_ids:
+        # The same uuid could come several times from a merge wave
+        values = sorted(set(filter_author['value']))
+        logger.debug('Identities to refresh: %i', len(values))
+        if len(values) > max_ids:
             logger.warning('Refreshing identities in groups of %i', max_ids)
-            while filter_author['value']:
-                new_filter_author = {"name": filter_author['name'],
-                                     "value": filter_author['value'][0:max_ids]}
-                filter_author['value'] = filter_author['value'][max_ids:]
-                for item in update_items(new_filter_author):
-                    yield item
-                    total += 1
-        else:
-            for item in update_items(filter_author):
-                yield item
-                total += 1
-    logger.info("Total eitems refreshed for identities fields %i", total)
+        for i in range(0, len(values), max_ids):
+            new_filter_author = {"name": filter_author['name'],
+                                 "value": values[i:i + max_ids]}
+            yield from refresh_items(new_filter_author)
+    logger.info("Total eitems refreshed for identities fields %i, changed %i",
+                stats["total"], stats["changed"])
 
 
 def load_identities(ocean_backend, enrich_backend):
+    """ Add to SortingHat the identities found in the raw items
+
+    Identities are sent to SortingHat in chunks as soon as the chunk is
+    full. They are deduplicated by a hashable key, remembering the keys of
+    the last LOAD_IDENTITIES_SEEN different identities, so memory is
+    bounded and only an identity not seen for that many others is sent
+    again (SortingHat ignores it). The progress is available in
+    load_identities_stats.
+    """
     try:
         from .elk.sortinghat import SortingHat
     except ImportError:
         logger.warning("SortingHat not available.")
 
-    # First we add all new identities to SH
-    items_count = 0
-    new_identities = []
+    backend_name = enrich_backend.get_connector_name()
+    chunk_size = SortingHat.bulk_size
+
+    stats = load_identities_stats
+    stats.update({"items": 0, "identities": 0, "chunks": 0,
+                  "items_rate": 0.0, "identities_rate": 0.0})
+    start = datetime.now()
+
+    chunk = []
+    seen = OrderedDict()  # keys of the last identities, the least recent first
+
+    def update_rates():
+        seconds = max((datetime.now() - start).total_seconds(), 1e-6)
+        stats["items_rate"] = stats["items"] / seconds
+        stats["identities_rate"] = stats["identities"] / seconds
+
+    def load_chunk():
+        with metrics.time('sortinghat_seconds', call="add_identities", backend=backend_name):
+            SortingHat.add_identities(enrich_backend.sh_db, chunk, backend_name)
+        metrics.inc('sortinghat_calls_total', call="add_identities", backend=backend_name)
+        stats["chunks"] += 1
+        update_rates()
+        logger.debug("Loaded %i identities chunks from %i items from %s (%0.1f items/s)",
+                     stats["chunks"], stats["items"], backend_name, stats["items_rate"])
+        chunk.clear()
+
+    def read_packs(items):
+        """ Read the items in packs, preparing the identities of each pack """
+        items = iter(items)
+        while True:
+            pack = list(itertools.islice(items, chunk_size))
+            if not pack:
+                break
+            enrich_backend.prefetch_identities(pack)
+            yield from pack
 
     # Support that ocean_backend is a list of items (old API)
     if isinstance(ocean_backend, list):
@@ -380,37 +481,195 @@ def load_identities(ocean_backend, enrich_backend):
     else:
         items = ocean_backend.fetch()
 
-    for item in items:
-        items_count += 1
+    for item in read_packs(items):
+        stats["items"] += 1
         # Get identities from new items to be added to SortingHat
         identities = enrich_backend.get_identities(item)
         for identity in identities:
-            if identity not in new_identities:
-                new_identities.append(identity)
-        if items_count % 100 == 0:
+            key = tuple(sorted(identity.items()))
+            if key in seen:
+                seen.move_to_end(key)
+                continue
+            seen[key] = None
+            if len(seen) > LOAD_IDENTITIES_SEEN:
+                seen.popitem(last=False)
+            chunk.append(identity)
+            stats["identities"] += 1
+            if len(chunk) >= chunk_size:
+                load_chunk()
+        if stats["items"] % 100 == 0:
+            update_rates()
             logger.debug("Processed %i items identities (%i identities) from %s",
-                         items_count, len(new_identities),
-                         enrich_backend.get_connector_name())
-    logger.debug("TOTAL ITEMS: %i", items_count)
+                         stats["items"], stats["identities"], backend_name)
+    if chunk:
+        load_chunk()
+    update_rates()
+    logger.debug("TOTAL ITEMS: %i", stats["items"])
 
-    logger.info("Total new identities to be checked %i", len(new_identities))
+    logger.info("Total new identities checked %i (%0.1f items/s)",
+                stats["identities"], stats["items_rate"])
 
-    SortingHat.add_identities(enrich_backend.sh_db, new_identities,
-                              enrich_backend.get_connector_name())
+    metrics.inc('identities_loaded_total', stats["identities"], backend=backend_name)
+    metrics.observe('stage_seconds', (datetime.now() - start).total_seconds(),
+                    stage="load_identities", backend=backend_name)
 
-    return len(new_identities)
+    return stats["identities"]
 
 
 def enrich_items(ocean_backend, enrich_backend, events=False):
     total = 0
 
-    if not events:
-        total = enrich_backend.enrich_items(ocean_backend)
-    else:
-        total = enrich_backend.enrich_events(ocean_backend)
+    backend_name = enrich_backend.get_connector_name()
+    stage = "enrich_events" if events else "enrich_items"
+
+    with metrics.time('stage_seconds', stage=stage, backend=backend_name):
+        if not events:
+            total = enrich_backend.enrich_items(ocean_backend)
+        else:
+            total = enrich_backend.enrich_events(ocean_backend)
+    if total:
+        metrics.inc('items_enriched_total', total, backend=backend_name)
     return total
 
 
+def enrich_items_asyncio(ocean_backend, enrich_backend, events=False):
+    """ Enrich the items reading and writing them with the asyncio ES client
+
+    Only the rich items of get_rich_item or get_rich_events are written,
+    so the backends with their own enrich_items are enriched as usual.
+    The asyncio client needs Python 3.6, so it is only imported here.
+    """
+
+    if sys.version_info < (3, 6):
+        logger.warning("Async enrichment needs Python 3.6. Enriching without it.")
+        return enrich_items(ocean_backend, enrich_backend, events)
+
+    if type(enrich_backend).enrich_items is not Enrich.enrich_items:
+        logger.warning("Async enrichment not supported in %s. Enriching without it.",
+                       enrich_backend.get_connector_name())
+        return enrich_items(ocean_backend, enrich_backend, events)
+
+    from .elk.elastic_async import enrich_items_async
+
+    backend_name = enrich_backend.get_connector_name()
+    stage = "enrich_events" if events else "enrich_items"
+
+    with metrics.time('stage_seconds', stage=stage, backend=backend_name):
+        loop = asyncio.get_event_loop()
+        total = loop.run_until_complete(enrich_items_async(ocean_backend, enrich_backend, events))
+    if total:
+        metrics.inc('items_enriched_total', total, backend=backend_name)
+    return total
+
+
+def get_slices_results(workers, results):
+    """ Get the results of the slices processes from the results queue
+
+    A process which exits without sending its result (killed, out of
+    memory ...) would block the reading forever, so the processes are
+    checked while waiting. Its slice is considered failed if it is still
+    without result after it has exited.
+
+    :param workers: dict with the process of each slice
+    :param results: queue with the (slice_id, total) sent by the processes
+    :returns: dict with the total of each slice, None if it failed
+    """
+
+    totals = {}
+    exited = set()  # slices whose process has exited without result
+
+    while len(totals) < len(workers):
+        try:
+            slice_id, total = results.get(timeout=SLICES_CHECK_SECONDS)
+            totals[slice_id] = total
+            continue
+        except Empty:
+            pass
+
+        for slice_id, worker in workers.items():
+            if slice_id in totals or worker.exitcode is None:
+                continue
+            # Wait one more check for a result sent just before exiting
+            if slice_id in exited:
+                logger.error("Process of slice %i exited with code %s without result",
+                             slice_id, worker.exitcode)
+                totals[slice_id] = None
+            exited.add(slice_id)
+
+    return totals
+
+
+def enrich_items_slices(ocean_backend, enrich_backend, slices, events=False):
+    """ Enrich the items splitting the raw scroll in slices
+
+    Each slice is enriched in its own process, with its own connections to
+    ES and SortingHat and its own bulk writer. The filters and the
+    incremental from_date/offset of ocean_backend are used in all slices.
+
+    :param ocean_backend: ocean backend with the raw items to enrich
+    :param enrich_backend: enrich backend to use in all the slices
+    :param slices: number of slices and processes
+    :param events: enrich events instead of items
+    :returns: total number of items enriched
+    """
+
+    if ocean_backend.elastic.major == '2':
+        logger.warning("Sliced scroll not supported in ES 2. Enriching without slices.")
+        return enrich_items(ocean_backend, enrich_backend, events)
+
+    if ocean_backend.search_after:
+        logger.warning("Sliced enrichment needs scroll. Not using search_after.")
+        ocean_backend.search_after = False
+
+    # Processes are forked to share the configured backends
+    ctx = multiprocessing.get_context('fork')
+    results = ctx.Queue()
+
+    def enrich_slice(slice_id):
+        ocean_backend.set_scroll_slice(slice_id, slices)
+        try:
+            total = enrich_items(ocean_backend, enrich_backend, events)
+        except Exception:
+            logger.error("Error enriching slice %i: %s", slice_id, traceback.format_exc())
+            total = None
+        results.put((slice_id, total))
+
+    # Connections can not be shared between processes. Close them so
+    # each process opens its own ones.
+    for backend in [ocean_backend, enrich_backend]:
+        backend.requests.close()
+        backend.elastic.requests.close()
+    if enrich_backend.sh_db:
+        enrich_backend.sh_db._engine.dispose()
+
+    logger.info("Enriching %s in %i slices", ocean_backend.elastic.index_url, slices)
+
+    backend_name = enrich_backend.get_connector_name()
+    stage = "enrich_events" if events else "enrich_items"
+
+    with metrics.time('stage_seconds', stage=stage, backend=backend_name):
+        workers = {slice_id: ctx.Process(target=enrich_slice, args=(slice_id,))
+                   for slice_id in range(slices)}
+        for worker in workers.values():
+            worker.start()
+        # Read the results before joining so workers are not blocked in the queue
+        totals = get_slices_results(workers, results)
+        for worker in workers.values():
+            worker.join()
+
+    for slice_id in sorted(totals):
+        logger.debug("Total items enriched in slice %i: %s", slice_id, totals[slice_id])
+
+    failed = [slice_id for slice_id in totals if totals[slice_id] is None]
+    if failed:
+        raise RuntimeError("Enrichment failed in slices %s" % failed)
+
+    # The metrics of the slices processes are lost, so only the total is added
+    metrics.inc('items_enriched_total', sum(totals.values()), backend=backend_name)
+
+    return sum(totals.values())
+
+
 def get_ocean_backend(backend_cmd, enrich_backend, no_incremental,
                       filter_raw=None, filter_raw_should=None):
     """ Get the ocean backend configured to start from the last enriched date """
@@ -458,13 +717,11 @@ def get_ocean_backend(backend_cmd, enrich_backend, no_incremental,
 
 
 def do_studies(enrich_backend, no_incremental=False):
-    try:
-        for study in enrich_backend.studies:
-            logger.info("Starting study: %s (no_incremental %s)", study, no_incremental)
-            study(enrich_backend, no_incremental)
-    except Exception as e:
-        logger.error("Problem executing study %s", study)
-        traceback.print_exc()
+    results = run_studies(enrich_backend, no_incremental)
+
+    failed = [study for study in results if results[study] is None]
+    if failed:
+        logger.error("Studies failed for %s: %s", enrich_backend.elastic.index_url, failed)
 
 
 def enrich_backend(url, clean, backend_name, backend_params, ocean_index=None,
@@ -478,11 +735,13 @@ def enrich_backend(url, clean, backend_name, backend_params, ocean_index=None,
                    do_refresh_projects=False, do_refresh_identities=False,
                    author_id=None, author_uuid=None, filter_raw=None,
                    filters_raw_prefix=None, jenkins_rename_file=None,
-                   unaffiliated_group=None, pair_programming=False):
+                   unaffiliated_group=None, pair_programming=False,
+                   enrich_slices=1, enrich_async=False):
     """ Enrich Ocean index """
 
     backend = None
     enrich_index = None
+    enrich_backend = None
 
     if ocean_index or ocean_index_enrich:
         clean = False  # don't remove index, it could be shared
@@ -557,9 +816,7 @@ def enrich_backend(url, clean, backend_name, backend_params, ocean_index=None,
             do_studies(enrich_backend, no_incremental)
         elif do_refresh_projects:
             logger.info("Refreshing project field in %s", enrich_backend.elastic.index_url)
-            field_id = enrich_backend.get_field_unique_id()
-            eitems = refresh_projects(enrich_backend)
-            enrich_backend.elastic.bulk_upload_sync(eitems, field_id)
+            update_items(enrich_backend, refresh_projects(enrich_backend))
         elif do_refresh_identities:
 
             filter_author = None
@@ -572,9 +829,12 @@ def enrich_backend(url, clean, backend_name, backend_params, ocean_index=None,
 
             logger.info("Refreshing identities fields in %s", enrich_backend.elastic.index_url)
 
-            field_id = enrich_backend.get_field_unique_id()
-            eitems = refresh_identities(enrich_backend, filter_author)
-            enrich_backend.elastic.bulk_upload_sync(eitems, field_id)
+            if author_uuid and ocean_index:
+                elastic_ocean = get_elastic(url, ocean_index, clean, ocean_backend)
+                ocean_backend.set_elastic(elastic_ocean)
+                refresh_uuids_items(ocean_backend, enrich_backend, author_uuid)
+            else:
+                update_items(enrich_backend, refresh_identities(enrich_backend, filter_author))
         else:
             clean = False  # Don't remove ocean index when enrich
             elastic_ocean = get_elastic(url, ocean_index, clean, ocean_backend)
@@ -592,7 +852,17 @@ def enrich_backend(url, clean, backend_name, backend_params, ocean_index=None,
 
             else:
                 # Enrichment for the new items once SH update is finished
-                if not events_enrich:
+                if enrich_slices > 1:
+                    enrich_count = enrich_items_slices(ocean_backend, enrich_backend,
+                                                       enrich_slices, events=events_enrich)
+                    if enrich_count is not None:
+                        logger.info("Total items enriched %i ", enrich_count)
+                elif enrich_async:
+                    enrich_count = enrich_items_asyncio(ocean_backend, enrich_backend,
+                                                        events=events_enrich)
+                    if enrich_count is not None:
+                        logger.info("Total items enriched %i ", enrich_count)
+                elif not events_enrich:
                     enrich_count = enrich_items(ocean_backend, enrich_backend)
                     if enrich_count is not None:
                         logger.info("Total items enriched %i ", enrich_count)
@@ -601,7 +871,7 @@ def enrich_backend(url, clean, backend_name, backend_params, ocean_index=None,
                     if enrich_count is not None:
                         logger.info("Total events enriched %i ", enrich_count)
                 if studies:
-                    do_studies(enrich_backend)
+                    do_studies(enrich_backend, no_incremental)
 
     except Exception as ex:
         logger.error("%s", traceback.format_exc())
@@ -610,5 +880,9 @@ def enrich_backend(url, clean, backend_name, backend_params, ocean_index=None,
                          backend_name, backend.origin, ex)
         else:
             logger.error("Error enriching ocean %s", ex)
+    finally:
+        if enrich_backend and backend_name == "git":
+            # Keep the GitHub logins found for the next executions
+            enrich_backend.github_logins.save()
 
     logger.info("Done %s ", backend_name)
@@ -0,0 +1,203 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Consumer of the items queue of arthur
+#
+# Copyright (C) 2018 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+import logging
+import pickle
+import time
+
+from redis.exceptions import WatchError
+
+
+logger = logging.getLogger(__name__)
+
+
+class ArthurQueue(object):
+    """ Read the items of a tag from the arthur items queue in batches
+
+    Arthur pushes the items of all its tasks to one redis list. The items
+    of the tag are read from it in batches of at most batch_size items.
+    The items of other tags found in the batches are moved to a list
+    for each tag, from which their consumers read first.
+
+    A batch is moved to a pending list of the tag when it is read, and it
+    is removed from there only when acknowledged with ack, once the items
+    are stored. The pending items of a consumer that didn't finish, and
+    the items that couldn't be stored, are read again in the next run (at
+    least once delivery).
+
+    The lag of the queue is available in stats.
+    """
+
+    def __init__(self, conn, queue, tag, batch_size=1000):
+        self.conn = conn
+        self.queue = queue
+        self.tag = tag
+        self.batch_size = batch_size
+
+        self.tag_queue = self.get_tag_queue(queue, tag)
+        self.pending_queue = self.tag_queue + ':pending'
+        self.failed_queue = self.tag_queue + ':failed'
+        self.batch = None  # last batch read, not yet acknowledged
+        self.batch_raw = None  # pickled items of the last batch
+
+        self.stats = {"queue_length": 0, "tag_queue_length": 0, "pending": 0,
+                      "items": 0, "failed": 0, "batches": 0, "lag_seconds": 0.0}
+
+        self.__recover()
+
+    @staticmethod
+    def get_tag_queue(queue, tag):
+        """ Name of the list with the items of a tag """
+
+        return queue + ':' + tag
+
+    def __recover(self):
+        """ Move the failed and pending items of a previous run to the tag queue """
+
+        pending = self.conn.lrange(self.failed_queue, 0, -1)
+        pending += self.conn.lrange(self.pending_queue, 0, -1)
+        if not pending:
+            return
+
+        logger.warning("Recovering %i items not stored from %s", len(pending), self.pending_queue)
+        pipe = self.conn.pipeline()
+        # The pending items are the oldest ones, so they go first
+        pipe.lpush(self.tag_queue, *reversed(pending))
+        pipe.delete(self.failed_queue)
+        pipe.delete(self.pending_queue)
+        pipe.execute()
+
+    def __move_batch(self, source):
+        """ Move up to batch_size items from the head of source to the pending list """
+
+        with self.conn.pipeline() as pipe:
+            while True:
+                try:
+                    # Arthur could be pushing items to the queue
+                    pipe.watch(source)
+                    items = pipe.lrange(source, 0, self.batch_size - 1)
+                    pipe.multi()
+                    if items:
+                        pipe.ltrim(source, len(items), -1)
+                        pipe.rpush(self.pending_queue, *items)
+                    pipe.execute()
+                    return items
+                except WatchError:
+                    continue
+
+    def __route(self, items):
+        """ Split the items of the tag from the ones of other tags
+
+        The items of other tags are pushed to their own lists.
+
+        :returns: tuple with the items of the tag and the pickled ones
+        """
+
+        tag_items = []
+        tag_raw = []
+        other_items = {}
+
+        for item in items:
+            arthur_item = pickle.loads(item)
+            if arthur_item['tag'] == self.tag:
+                tag_items.append(arthur_item)
+                tag_raw.append(item)
+            else:
+                other_items.setdefault(arthur_item['tag'], []).append(item)
+
+        if other_items:
+            pipe = self.conn.pipeline()
+            for tag, items in other_items.items():
+                logger.debug("Items for %s: %i", tag, len(items))
+                pipe.rpush(self.get_tag_queue(self.queue, tag), *items)
+            pipe.execute()
+
+        return tag_items, tag_raw
+
+    def __update_stats(self, items):
+        pipe = self.conn.pipeline()
+        pipe.llen(self.queue)
+        pipe.llen(self.tag_queue)
+        pipe.llen(self.pending_queue)
+        (self.stats["queue_length"], self.stats["tag_queue_length"],
+         self.stats["pending"]) = pipe.execute()
+
+        timestamps = [item['timestamp'] for item in items if 'timestamp' in item]
+        if timestamps:
+            self.stats["lag_seconds"] = max(time.time() - min(timestamps), 0.0)
+
+    def batches(self):
+        """ Get the items of the tag in batches
+
+        Each batch must be acknowledged with ack once stored, before
+        asking for the next one. A batch not acknowledged is read again
+        by the next consumer of the tag.
+
+        :returns: generator of lists of items
+        """
+
+        sources = [self.tag_queue, self.queue]
+
+        while sources:
+            items = self.__move_batch(sources[0])
+            if not items:
+                # The items of the tag queue go first
+                sources.pop(0)
+                continue
+
+            self.batch, self.batch_raw = self.__route(items)
+            self.__update_stats(self.batch)
+            if not self.batch:
+                self.ack()
+                continue
+
+            yield self.batch
+
+    def ack(self, failed=None):
+        """ Remove the pending items of the last batch once they are stored
+
+        :param failed: items of the batch that couldn't be stored, kept to
+            be read again in the next run
+        """
+
+        failed_raw = []
+        if failed:
+            # The failed items are the same objects of the batch
+            failed = set(id(item) for item in failed)
+            failed_raw = [raw for item, raw in zip(self.batch, self.batch_raw) if id(item) in failed]
+
+        pipe = self.conn.pipeline()
+        pipe.delete(self.pending_queue)
+        if failed_raw:
+            logger.warning("Arthur items of %s not stored: %i", self.tag, len(failed_raw))
+            pipe.rpush(self.failed_queue, *failed_raw)
+        pipe.execute()
+        self.stats["pending"] = 0
+        self.stats["failed"] += len(failed_raw)
+
+        if self.batch:
+            self.stats["items"] += len(self.batch) - len(failed_raw)
+            self.stats["batches"] += 1
+            logger.debug("Arthur items of %s: %i in %i batches, %i in queue, lag %0.1f s",
+                         self.tag, self.stats["items"], self.stats["batches"],
+                         self.stats["queue_length"], self.stats["lag_seconds"])
+            self.batch = None
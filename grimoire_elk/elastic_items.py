@@ -27,9 +27,12 @@
 
 import json
 import logging
+import queue
+import threading
 
 from .elk.utils import get_repository_filter, grimoire_con
 from .elastic_mapping import Mapping
+from .metrics import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -41,6 +44,10 @@ class ElasticItems():
     # In large projects like Eclipse commits, 100 is too much
     # Change it from p2o command line or mordred config
     scroll_size = 100
+    # Pages read in advance in a background thread while fetching (0 disables it)
+    scroll_prefetch = 0
+    # Read the items with search_after instead of scroll
+    search_after = False
 
     def __init__(self, perceval_backend, from_date=None, insecure=True, offset=None):
 
@@ -50,6 +57,9 @@ class ElasticItems():
         self.offset = offset  # fetch from offset
         self.filter_raw = None  # to filter raw items from Ocean
         self.filter_raw_should = None  # to filter raw items from Ocean
+        self.scroll_slice = None  # (id, max) of the slice to read with sliced scroll
+        self.search_after_start = None  # sort key of the item to start after with search_after
+        self.search_after_value = None  # sort key of the last item read with search_after
 
         self.requests = grimoire_con(insecure)
         self.elastic = None
@@ -79,6 +89,10 @@ class ElasticItems():
         """ Bool filter should to be used when getting items from Ocean index """
         self.filter_raw_should = filter_raw_should
 
+    def set_scroll_slice(self, slice_id, slices):
+        """ Get only the items in slice_id when the scroll is splitted in slices """
+        self.scroll_slice = (slice_id, slices)
+
     def get_connector_name(self):
         """ Find the name for the current connector """
         from .utils import get_connector_name
@@ -91,30 +105,134 @@ class ElasticItems():
 
         logger.debug("Creating a elastic items generator.")
 
-        elastic_scroll_id = None
+        if self.scroll_prefetch > 0:
+            pages = self.fetch_pages_prefetch(_filter)
+        else:
+            pages = self.fetch_pages(_filter)
 
-        while True:
-            rjson = self.get_elastic_items(elastic_scroll_id, _filter=_filter)
+        for page in pages:
+            metrics.inc('items_fetched_total', len(page), index=self.elastic.index)
+            for hit in page:
+                eitem = hit['_source']
+                yield eitem
+        return
 
-            if rjson and "_scroll_id" in rjson:
-                elastic_scroll_id = rjson["_scroll_id"]
+    def fetch_pages(self, _filter=None):
+        """ Fetch the pages (list of hits) of items from the index """
 
-            if rjson and "hits" in rjson:
-                received = len(rjson["hits"]["hits"])
-                if received == 0:
-                    logger.debug("Fetching from %s: done receiving",
-                                 self.elastic.index_url)
+        if self.search_after:
+            return self.fetch_pages_search_after(_filter)
+        return self.fetch_pages_scroll(_filter)
+
+    def fetch_pages_scroll(self, _filter=None):
+        """ Fetch the pages of items from the index using scroll """
+
+        elastic_scroll_id = None
+
+        try:
+            while True:
+                rjson = self.get_elastic_items(elastic_scroll_id, _filter=_filter)
+
+                if rjson and "_scroll_id" in rjson:
+                    elastic_scroll_id = rjson["_scroll_id"]
+
+                if rjson and "hits" in rjson:
+                    received = len(rjson["hits"]["hits"])
+                    if received == 0:
+                        logger.debug("Fetching from %s: done receiving",
+                                     self.elastic.index_url)
+                        break
+                    logger.debug("Fetching from %s: %d received",
+                                 self.elastic.index_url, received)
+                    yield rjson["hits"]["hits"]
+                else:
+                    logger.warning("No results found from %s", self.elastic.index_url)
                     break
-                logger.debug("Fetching from %s: %d received",
-                             self.elastic.index_url, received)
-                for hit in rjson["hits"]["hits"]:
-                    eitem = hit['_source']
-                    yield eitem
-            else:
+        finally:
+            # Don't keep the scroll context in ES until it expires
+            if elastic_scroll_id:
+                self.clear_scroll(elastic_scroll_id)
+        return
+
+    def fetch_pages_search_after(self, _filter=None):
+        """ Fetch the pages of items from the index using search_after
+
+        The items are sorted using get_search_after_sort. Each fetch starts
+        after search_after_start, from the first item if it is None. After
+        each page search_after_value has the sort key of its last item, so
+        a fetch can be resumed from it.
+        """
+
+        search_after_value = self.search_after_start
+        self.search_after_value = search_after_value
+
+        while True:
+            rjson = self.get_elastic_items_search_after(search_after_value, _filter=_filter)
+
+            if not rjson or "hits" not in rjson:
                 logger.warning("No results found from %s", self.elastic.index_url)
                 break
+
+            received = len(rjson["hits"]["hits"])
+            if received == 0:
+                logger.debug("Fetching from %s: done receiving",
+                             self.elastic.index_url)
+                break
+            logger.debug("Fetching from %s: %d received (after %s)",
+                         self.elastic.index_url, received, search_after_value)
+
+            search_after_value = rjson["hits"]["hits"][-1]["sort"]
+            self.search_after_value = search_after_value
+            yield rjson["hits"]["hits"]
         return
 
+    def fetch_pages_prefetch(self, _filter=None):
+        """ Fetch the pages of items from the index reading ahead
+
+        A background thread keeps up to scroll_prefetch pages requested
+        while the current one is processed, so the ES latency is hidden
+        behind the processing of the items.
+        """
+
+        pages = queue.Queue(maxsize=self.scroll_prefetch)
+        stop = threading.Event()
+        done = object()  # end of pages mark
+
+        def put(page):
+            # Wait for room in the queue unless the consumer is gone
+            while not stop.is_set():
+                try:
+                    pages.put(page, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def read_pages():
+            try:
+                for page in self.fetch_pages(_filter):
+                    if not put(page):
+                        return
+            except Exception as ex:
+                put(ex)
+            else:
+                put(done)
+
+        reader = threading.Thread(target=read_pages, daemon=True)
+        reader.start()
+
+        try:
+            while True:
+                page = pages.get()
+                if page is done:
+                    break
+                if isinstance(page, Exception):
+                    raise page
+                yield page
+        finally:
+            stop.set()
+            reader.join()
+
     def get_elastic_items(self, elastic_scroll_id=None, _filter=None):
         """ Get the items from the index related to the backend applying and
         optional _filter if provided"""
@@ -141,105 +259,164 @@ class ElasticItems():
             }
             query_data = json.dumps(scroll_data)
         else:
-            # If using a perceval backends always filter by repository
-            # to support multi repository indexes
-            # We need the filter dict as a string to join with the rest
-            filters_dict = self.get_repository_filter_raw(term=True)
-            if filters_dict:
-                filters = json.dumps(filters_dict)
-            else:
-                filters = ''
+            query_data = self.get_elastic_items_query(_filter)
+            logger.debug("Raw query to %s\n%s", url, json.dumps(json.loads(query_data), indent=4))
 
-            if self.filter_raw:
-                filters += '''
-                    , {"term":
-                        { "%s":"%s"  }
-                    }
-                ''' % (self.filter_raw['name'], self.filter_raw['value'])
+        items = []
+        rjson = None
+        try:
+            with metrics.time('scroll_page_seconds', index=self.elastic.index):
+                res = self.requests.post(url, data=query_data, headers=headers)
+            res.raise_for_status()
+            rjson = res.json()
+        except Exception:
+            # The index could not exists yet or it could be empty
+            logger.warning("No JSON found in %s" % (res.text))
+            logger.warning("No results found from %s" % (url))
 
-            if _filter:
-                filter_str = '''
-                    , {"terms":
-                        { "%s": %s }
-                    }
-                ''' % (_filter['name'], _filter['value'])
-                # List to string conversion uses ' that are not allowed in JSON
-                filter_str = filter_str.replace("'", "\"")
-                filters += filter_str
-
-            if self.from_date:
-                date_field = self.get_incremental_date()
-                from_date = self.from_date.isoformat()
-
-                filters += '''
-                    , {"range":
-                        {"%s": {"gte": "%s"}}
-                    }
-                ''' % (date_field, from_date)
-            elif self.offset:
-                filters += '''
-                    , {"range":
-                        {"offset": {"gte": %i}}
-                    }
-                ''' % (self.offset)
-
-            # Order the raw items from the old ones to the new so if the
-            # enrich process fails, it could be resume incrementally
-            order_query = ''
-            order_field = None
-            if self.perceval_backend:
-                order_field = self.get_incremental_date()
-            elif hasattr(self, 'is_twitter_ocean'):
-                # TwitterOcean, order field is special
-                order_field = '@timestamp'
-            if order_field is not None:
-                order_query = ', "sort": { "%s": { "order": "asc" }} ' % order_field
-
-            filters_should = ''
-            if self.filter_raw_should:
-                filters_should = json.dumps(self.filter_raw_should)[1:-1]
-                # We need to add a bool should query to the outer must query
-                query_should = '{"bool": {%s}}' % filters_should
-                filters += ", " + query_should
-
-            # Fix the filters string if it starts with "," (empty first filter)
-            if filters.lstrip().startswith(','):
-                filters = filters.lstrip()[1:]
-
-            filters_dict = json.loads("[" + filters + "]")
-            if len(filters_dict) == 0:
-                # Avoid empty list of filters, ES 6.x doesn't like it
-                # In this case, ensure that order_query does not start with ,
-                if order_query.startswith(','):
-                    order_query = order_query[1:]
-                query = """
-                {
-                  %s
-                }
-                """ % (order_query)
-            else:
-                query = """
-                {
-                    "query": {
-                        "bool": {
-                            "must": [%s]
-                        }
-                    } %s
-                }
-                """ % (filters, order_query)
+        return rjson
 
-            logger.debug("Raw query to %s\n%s", url, json.dumps(json.loads(query), indent=4))
-            query_data = query
+    def clear_scroll(self, elastic_scroll_id):
+        """ Free the scroll context in ES """
+
+        self.elastic.clear_scroll(elastic_scroll_id)
+
+    def get_search_after_sort(self):
+        """ Fields to sort the items when using search_after. The last one
+        must be unique for each item: the uuid is not unique in enriched
+        indexes (events, answers ...), so the id of the document is used. """
+
+        # _id can't be sorted before ES 6
+        doc_id = "_uid" if self.elastic.major in ['2', '5'] else "_id"
+
+        return [self.get_incremental_date(), doc_id]
+
+    def get_elastic_items_search_after(self, search_after_value=None, _filter=None):
+        """ Get the page of items after search_after_value applying and
+        optional _filter if provided"""
+
+        headers = {"Content-Type": "application/json"}
+
+        if not self.elastic:
+            return None
+        url = self.elastic.index_url
+        url += "/_search?size=%i" % self.scroll_size
+
+        query = json.loads(self.get_elastic_items_query(_filter))
+        # search_after can't be used in scroll slices
+        query.pop('slice', None)
+        query['sort'] = [{field: {"order": "asc"}} for field in self.get_search_after_sort()]
+        if search_after_value:
+            query['search_after'] = search_after_value
 
-        items = []
         rjson = None
         try:
-            res = self.requests.post(url, data=query_data, headers=headers)
+            with metrics.time('scroll_page_seconds', index=self.elastic.index):
+                res = self.requests.post(url, data=json.dumps(query), headers=headers)
             res.raise_for_status()
             rjson = res.json()
         except Exception:
             # The index could not exists yet or it could be empty
-            logger.warning("No JSON found in %s" % (res.text))
             logger.warning("No results found from %s" % (url))
 
         return rjson
+
+    def get_elastic_items_query(self, _filter=None):
+        """ Query to get the items from the index related to the backend
+        applying and optional _filter if provided"""
+
+        # If using a perceval backends always filter by repository
+        # to support multi repository indexes
+        # We need the filter dict as a string to join with the rest
+        filters_dict = self.get_repository_filter_raw(term=True)
+        if filters_dict:
+            filters = json.dumps(filters_dict)
+        else:
+            filters = ''
+
+        if self.filter_raw:
+            filters += '''
+                , {"term":
+                    { "%s":"%s"  }
+                }
+            ''' % (self.filter_raw['name'], self.filter_raw['value'])
+
+        if _filter:
+            filter_str = '''
+                , {"terms":
+                    { "%s": %s }
+                }
+            ''' % (_filter['name'], _filter['value'])
+            # List to string conversion uses ' that are not allowed in JSON
+            filter_str = filter_str.replace("'", "\"")
+            filters += filter_str
+
+        if self.from_date:
+            date_field = self.get_incremental_date()
+            from_date = self.from_date.isoformat()
+
+            filters += '''
+                , {"range":
+                    {"%s": {"gte": "%s"}}
+                }
+            ''' % (date_field, from_date)
+        elif self.offset:
+            filters += '''
+                , {"range":
+                    {"offset": {"gte": %i}}
+                }
+            ''' % (self.offset)
+
+        # Order the raw items from the old ones to the new so if the
+        # enrich process fails, it could be resume incrementally
+        order_query = ''
+        order_field = None
+        if self.perceval_backend:
+            order_field = self.get_incremental_date()
+        elif hasattr(self, 'is_twitter_ocean'):
+            # TwitterOcean, order field is special
+            order_field = '@timestamp'
+        if order_field is not None:
+            order_query = ', "sort": { "%s": { "order": "asc" }} ' % order_field
+
+        filters_should = ''
+        if self.filter_raw_should:
+            filters_should = json.dumps(self.filter_raw_should)[1:-1]
+            # We need to add a bool should query to the outer must query
+            query_should = '{"bool": {%s}}' % filters_should
+            filters += ", " + query_should
+
+        # Fix the filters string if it starts with "," (empty first filter)
+        if filters.lstrip().startswith(','):
+            filters = filters.lstrip()[1:]
+
+        filters_dict = json.loads("[" + filters + "]")
+        if len(filters_dict) == 0:
+            # Avoid empty list of filters, ES 6.x doesn't like it
+            # In this case, ensure that order_query does not start with ,
+            if order_query.startswith(','):
+                order_query = order_query[1:]
+            query = """
+            {
+              %s
+            }
+            """ % (order_query)
+        else:
+            query = """
+            {
+                "query": {
+                    "bool": {
+                        "must": [%s]
+                    }
+                } %s
+            }
+            """ % (filters, order_query)
+
+        if self.scroll_slice:
+            # Read only one of the slices in which the scroll is splitted
+            query_dict = json.loads(query)
+            query_dict['slice'] = {"id": self.scroll_slice[0],
+                                   "max": self.scroll_slice[1]}
+            query = json.dumps(query_dict)
+
+        return query
@@ -23,17 +23,17 @@
 #   Alvaro del Castillo San Felix <acs@bitergia.com>
 #
 
+from concurrent.futures import ThreadPoolExecutor, ALL_COMPLETED, FIRST_COMPLETED, wait
 from datetime import datetime
 from dateutil import parser
 import json
 import logging
-import sys
 
 from time import time, sleep
 
 import requests
 
-from ..errors import ELKError
+from ..metrics import metrics
 from .utils import unixtime_to_datetime, grimoire_con
 
 
@@ -51,7 +51,12 @@ class ElasticWriteException(Exception):
 class ElasticSearch(object):
 
     max_items_bulk = 1000
+    max_bulk_bytes = 10 * 1024 * 1024  # max size of the body of a bulk request
     max_items_clause = 1000  # max items in search clause (refresh identities)
+    bulk_workers = 1  # concurrent bulk requests in bulk_upload (1 is serial)
+    bulk_queue_size = 2  # packs serialized ahead of the busy bulk workers
+    max_retries_429 = 8  # retries for a bulk rejected with 429 Too Many Requests
+    retry_429_seconds = 0.5  # initial wait for a rejected bulk, doubled each retry
 
     @classmethod
     def safe_index(cls, unique_id):
@@ -106,6 +111,7 @@ class ElasticSearch(object):
         self.index = self.safe_index(index)
         self.index_url = self.url + "/" + self.index
         self.wait_bulk_seconds = 2  # time to wait to complete a bulk operation
+        self.refresh_enabled = True  # use refresh, not polling, in bulk_upload_sync
 
         self.requests = grimoire_con(insecure)
 
@@ -134,47 +140,71 @@ class ElasticSearch(object):
             map_dict = mappings.get_elastic_mappings(es_major=self.major)
             self.create_mappings(map_dict)
 
-    def _safe_put_bulk(self, url, bulk_json):
-        """ Bulk PUT controlling unicode issues """
+    def _put_bulk(self, url, bulk_json):
+        """ Bulk PUT waiting and retrying while ES rejects it with 429 """
 
         headers = {"Content-Type": "application/x-ndjson"}
 
-        try:
-            res = self.requests.put(url, data=bulk_json, headers=headers)
-            res.raise_for_status()
-        except UnicodeEncodeError:
-            # Related to body.encode('iso-8859-1'). mbox data
-            logger.error("Encondig error ... converting bulk to iso-8859-1")
-            bulk_json = bulk_json.encode('iso-8859-1', 'ignore')
+        retries = 0
+        wait_seconds = self.retry_429_seconds
+        res = self.requests.put(url, data=bulk_json, headers=headers)
+        while res.status_code == 429 and retries < self.max_retries_429:
+            # ES bulk queue is full: backpressure before sending it again
+            logger.warning("Bulk rejected by ES (429), retrying in %.2f sec", wait_seconds)
+            sleep(wait_seconds)
+            retries += 1
+            wait_seconds *= 2
             res = self.requests.put(url, data=bulk_json, headers=headers)
-            res.raise_for_status()
+        res.raise_for_status()
+
+        return res
+
+    def _safe_put_bulk(self, url, bulk_json, failed=None):
+        """ Bulk PUT of the UTF-8 encoded actions, counting the failed ones
+
+        :param failed: list to which the position and status of the failed actions are appended
+        """
+
+        with metrics.time('bulk_seconds', index=self.index):
+            res = self._put_bulk(url, bulk_json)
+
+        metrics.inc('bulk_requests_total', index=self.index)
+        metrics.inc('bulk_bytes_total', len(bulk_json), index=self.index)
 
         result = res.json()
         failed_items = []
         if result['errors']:
             # Due to multiple errors that may be thrown when inserting bulk data, only the first error is returned
-            failed_items = [item['index'] for item in result['items'] if 'error' in item['index']]
+            results = self.get_bulk_results(result)
+            failed_items = [item for item in results if 'error' in item]
             error = str(failed_items[0]['error'])
+            if failed is not None:
+                failed.extend((pos, item.get('status')) for pos, item in enumerate(results)
+                              if 'error' in item)
 
             logger.error("Failed to insert data to ES: %s, %s", error, url)
 
+        # The failed items are not raised to avoid stopping ocean uploading processes
         inserted_items = len(result['items']) - len(failed_items)
-
-        # The exception is currently not thrown to avoid stopping ocean uploading processes
-        try:
-            if failed_items:
-                raise ELKError(cause=error)
-        except ELKError:
-            pass
+        if failed_items:
+            metrics.inc('bulk_errors_total', len(failed_items), index=self.index)
 
         return inserted_items
 
-    def bulk_upload(self, items, field_id):
-        ''' Upload in controlled packs items to ES using bulk API '''
+    @staticmethod
+    def get_bulk_results(result):
+        """ Get the result of each action from the response of a bulk request """
+
+        # Each item result is under its action: index or update
+        return [list(item.values())[0] for item in result['items']]
+
+    def bulk_upload(self, items, field_id, failed_ids=None):
+        ''' Upload in controlled packs items to ES using bulk API
+
+        :param failed_ids: list to which the ids of the items that couldn't be stored are appended
+        '''
 
-        current = 0
         new_items = 0  # total items added with bulk
-        bulk_json = ""
 
         if not items:
             return new_items
@@ -182,34 +212,105 @@ class ElasticSearch(object):
         url = self.index_url + '/items/_bulk'
 
         logger.debug("Adding items to %s (in %i packs)" % (url, self.max_items_bulk))
-        task_init = time()
 
-        for item in items:
-            if current >= self.max_items_bulk:
-                task_init = time()
-                new_items += self._safe_put_bulk(url, bulk_json)
-                current = 0
-                json_size = sys.getsizeof(bulk_json) / (1024 * 1024)
-                logger.debug("bulk packet sent (%.2f sec, %i total, %.2f MB)"
-                             % (time() - task_init, new_items, json_size))
-                bulk_json = ""
-            data_json = json.dumps(item)
-            bulk_json += '{"index" : {"_id" : "%s" } }\n' % (item[field_id])
-            bulk_json += data_json + "\n"  # Bulk document
-            current += 1
-        new_items += self._safe_put_bulk(url, bulk_json)
-        json_size = sys.getsizeof(bulk_json) / (1024 * 1024)
-        logger.debug("bulk packet sent (%.2f sec prev, %i total, %.2f MB)"
-                     % (time() - task_init, new_items, json_size))
-
-        return new_items
-
-    def bulk_upload_sync(self, items, field_id, sync=True):
+        with BulkWriter(self, url) as writer:
+            for item in items:
+                writer.add(item[field_id], item)
+
+        if failed_ids is not None:
+            failed_ids.extend(writer.failed_ids)
+
+        return writer.total
+
+    def scroll_hits(self, query, size=1000, scroll="10m"):
+        """ Get all the hits of a query to the index using a scroll
+
+        :param query: dict with the search body
+        :param size: number of hits of each scroll page
+        :returns: generator of hits
+        """
+
+        headers = {"Content-Type": "application/json"}
+
+        url = self.index_url + "/_search?scroll=%s&size=%i" % (scroll, size)
+        res = self.requests.post(url, data=json.dumps(query), headers=headers)
+        res.raise_for_status()
+        rjson = res.json()
+        scroll_id = rjson.get('_scroll_id')
+
+        try:
+            while rjson['hits']['hits']:
+                for hit in rjson['hits']['hits']:
+                    yield hit
+                scroll_data = {"scroll": scroll, "scroll_id": scroll_id}
+                res = self.requests.post(self.url + "/_search/scroll",
+                                         data=json.dumps(scroll_data), headers=headers)
+                res.raise_for_status()
+                rjson = res.json()
+                scroll_id = rjson.get('_scroll_id', scroll_id)
+        finally:
+            if scroll_id:
+                self.clear_scroll(scroll_id)
+
+    def clear_scroll(self, scroll_id):
+        """ Free the scroll context in ES """
+
+        url = self.url + "/_search/scroll"
+        headers = {"Content-Type": "application/json"}
+        data = json.dumps({"scroll_id": [scroll_id]})
+
+        try:
+            res = self.requests.delete(url, data=data, headers=headers)
+            if res.status_code not in [200, 404]:
+                logger.warning("Can't clear scroll in %s (%s)", url, res.status_code)
+        except Exception as ex:
+            logger.warning("Can't clear scroll in %s: %s", url, ex)
+
+    def refresh_index(self):
+        """ Make all the operations done in the index visible in searches
+
+        :returns: True if the refresh was done, False if ES refused it
+        """
+
+        res = self.requests.post(self.index_url + '/_refresh')
+        try:
+            res.raise_for_status()
+        except requests.exceptions.HTTPError:
+            logger.warning("Can't refresh %s (%s)", self.index_url, res.status_code)
+            return False
+
+        return True
+
+    def bulk_upload_sync(self, items, field_id, sync=True, failed_ids=None):
         """ Upload items in packs to ES using bulk API
-            and wait until the items appears in searches """
+            and wait until the items appears in searches
+
+        :param failed_ids: list to which the ids of the items that couldn't be stored are appended
+        """
+
+        # After a bulk upload the searches are not refreshed immediately.
+        # A refresh is requested once all the packs are uploaded, so the
+        # items are visible in searches when this method returns.
+
+        if not sync:
+            # No need to wait for each pack, so all packs can go in parallel
+            return self.bulk_upload(items, field_id, failed_ids)
+
+        if not self.refresh_enabled:
+            return self._bulk_upload_poll(items, field_id, failed_ids)
 
-        # After a bulk upload the searches are not refreshed immediately
-        # This method waits until the upload is visible in searches
+        total = self.bulk_upload(items, field_id, failed_ids)
+
+        if total and not self.refresh_index():
+            # Refresh not allowed in this ES, wait polling from now on
+            logger.warning("Polling %s to check that bulk data is indexed", self.index_url)
+            self.refresh_enabled = False
+
+        return total
+
+    def _bulk_upload_poll(self, items, field_id, failed_ids=None):
+        """ Upload items in packs to ES using bulk API
+            and wait polling until each pack appears in searches """
 
         def current_items():
             """ Current number of items in the index """
@@ -246,15 +347,14 @@ class ElasticSearch(object):
 
             if len(items_pack) >= max_items:
                 total_items = current_items()
-                total += self.bulk_upload(items_pack, field_id)
+                total += self.bulk_upload(items_pack, field_id, failed_ids)
                 items_pack = []
-                if sync:
-                    wait_index(total_items + max_items)
+                wait_index(total_items + max_items)
                 logger.debug('Total items already uploaded %i', total)
 
             items_pack.append(item)
 
-        total += self.bulk_upload(items_pack, field_id)
+        total += self.bulk_upload(items_pack, field_id, failed_ids)
 
         return total
 
@@ -297,44 +397,51 @@ class ElasticSearch(object):
                     logger.error("Mapping: " + str(mappings[_type]))
                     res.raise_for_status()
 
-            # By default all strings are not analyzed in ES < 6
-            if self.major == '2' or self.major == '5':
-                # Before version 6, strings were strings
-                not_analyze_strings = """
-                {
-                  "dynamic_templates": [
-                    { "notanalyzed": {
-                          "match": "*",
-                          "match_mapping_type": "string",
-                          "mapping": {
-                              "type":        "string",
-                              "index":       "not_analyzed"
-                          }
-                       }
-                    }
-                  ]
-                } """
-            else:
-                # After version 6, strings are keywords (not analyzed)
-                not_analyze_strings = """
-                {
-                  "dynamic_templates": [
-                    { "notanalyzed": {
-                          "match": "*",
-                          "match_mapping_type": "string",
-                          "mapping": {
-                              "type":        "keyword"
-                          }
-                       }
-                    }
-                  ]
-                } """
+            not_analyze_strings = self.get_not_analyze_strings(self.major)
             res = self.requests.put(url_map, data=not_analyze_strings, headers=headers)
             try:
                 res.raise_for_status()
             except requests.exceptions.HTTPError:
                 logger.warning("Can't add mapping %s: %s", url_map, self.global_mapping())
 
+    @staticmethod
+    def get_not_analyze_strings(es_major):
+        """ Mapping so all the strings are not analyzed by default """
+
+        if es_major == '2' or es_major == '5':
+            # Before version 6, strings were strings
+            not_analyze_strings = """
+            {
+              "dynamic_templates": [
+                { "notanalyzed": {
+                      "match": "*",
+                      "match_mapping_type": "string",
+                      "mapping": {
+                          "type":        "string",
+                          "index":       "not_analyzed"
+                      }
+                   }
+                }
+              ]
+            } """
+        else:
+            # After version 6, strings are keywords (not analyzed)
+            not_analyze_strings = """
+            {
+              "dynamic_templates": [
+                { "notanalyzed": {
+                      "match": "*",
+                      "match_mapping_type": "string",
+                      "mapping": {
+                          "type":        "keyword"
+                      }
+                   }
+                }
+              ]
+            } """
+
+        return not_analyze_strings
+
     def get_last_date(self, field, filters_=[]):
         '''
             :field: field with the data
@@ -362,11 +469,24 @@ class ElasticSearch(object):
             :offset: Return offset field insted of date field
         '''
 
-        last_value = None
-
         url = self.index_url
         url += "/_search"
 
+        data_json = self.get_last_item_query(field, filters_)
+
+        logger.debug("%s %s", url, data_json)
+
+        headers = {"Content-Type": "application/json"}
+
+        res = self.requests.post(url, data=data_json, headers=headers)
+        res.raise_for_status()
+
+        return self.get_last_item_value(res.json(), offset)
+
+    @staticmethod
+    def get_last_item_query(field, filters_=[]):
+        ''' Query with the max aggregation of field in the items matching filters_ '''
+
         data_query = ''
         if filters_ is None:
             filters_ = []
@@ -393,13 +513,13 @@ class ElasticSearch(object):
         { "size": 0, %s  %s
         } ''' % (data_query, data_agg)
 
-        logger.debug("%s %s", url, data_json)
+        return data_json
 
-        headers = {"Content-Type": "application/json"}
+    @staticmethod
+    def get_last_item_value(res_json, offset=False):
+        ''' Value of the max aggregation of get_last_item_query: a date or an offset '''
 
-        res = self.requests.post(url, data=data_json, headers=headers)
-        res.raise_for_status()
-        res_json = res.json()
+        last_value = None
 
         if 'aggregations' in res_json:
             last_value = res_json["aggregations"]["1"]["value"]
@@ -420,3 +540,178 @@ class ElasticSearch(object):
                             # last_value is in microsecs
                             last_value = unixtime_to_datetime(last_value / 1000)
         return last_value
+
+
+class BulkWriter(object):
+    """ Write documents to an index using the ES bulk API
+
+    The documents are encoded as they are added into a reusable buffer,
+    which is sent to ES when it reaches max_items_bulk documents or
+    max_bulk_bytes bytes, so large documents (mbox messages, gerrit
+    reviews) don't end up in huge bulk requests.
+
+    With more than one bulk_workers, the next pack is encoded while the
+    previous ones are in flight. At most bulk_workers + bulk_queue_size
+    packs are pending at any time, so memory is bounded and a slow
+    (or 429 rejecting) ES cluster slows down the producer of documents.
+
+    The documents of a pack rejected by ES with a transient error (429 or
+    5xx) are sent again one by one. The ones that can't be stored are
+    counted in failed, and their ids are in failed_ids.
+
+    :param elastic: ElasticSearch instance used to send the packs
+    :param url: bulk API url, by default the items bulk url of the index
+    """
+
+    def __init__(self, elastic, url=None):
+
+        self.elastic = elastic
+        self.url = url if url else elastic.index_url + '/items/_bulk'
+
+        self.buffer = bytearray()
+        self.current = 0  # documents in buffer
+        self.added = 0  # documents added to be sent
+        self.total = 0  # documents inserted in ES
+        self.failed = 0  # documents that couldn't be inserted in ES
+        self.failed_ids = []  # ids of the documents that couldn't be inserted in ES
+        self.total_bytes = 0  # bytes sent to ES
+
+        self.executor = None
+        self.pending = set()
+        if elastic.bulk_workers > 1:
+            self.executor = ThreadPoolExecutor(max_workers=elastic.bulk_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            # Don't send the documents of a failed process
+            if self.executor:
+                self.executor.shutdown()
+        else:
+            self.close()
+
+    def add(self, doc_id, doc):
+        """ Add a document to be indexed with doc_id """
+
+        self._add_action(self.index_action(doc_id, doc))
+
+    def update(self, doc_id, fields):
+        """ Add a partial update of some fields of the document doc_id """
+
+        data = '{"update" : {"_id" : "%s" } }\n' % (doc_id)
+        data += json.dumps({"doc": fields}) + "\n"
+        self._add_action(data.encode('utf-8'))
+
+    @staticmethod
+    def index_action(doc_id, doc):
+        """ Bulk action, UTF-8 encoded, indexing doc with doc_id """
+
+        data = '{"index" : {"_id" : "%s" } }\n' % (doc_id)
+        data += json.dumps(doc) + "\n"  # Bulk document
+        return data.encode('utf-8')
+
+    def _add_action(self, data):
+        if self.current >= self.elastic.max_items_bulk or \
+                (self.current and len(self.buffer) + len(data) > self.elastic.max_bulk_bytes):
+            self.flush()
+
+        self.buffer += data
+        self.current += 1
+        self.added += 1
+
+    def flush(self):
+        """ Send the buffered documents to ES """
+
+        if self.current == 0:
+            return
+
+        bulk_json = bytes(self.buffer)
+        del self.buffer[:]
+        self.current = 0
+        self.total_bytes += len(bulk_json)
+
+        if not self.executor:
+            self.__count(*self._put_bulk(bulk_json))
+            return
+
+        max_pending = self.elastic.bulk_workers + self.elastic.bulk_queue_size
+        if len(self.pending) >= max_pending:
+            self._wait_pending(FIRST_COMPLETED)
+        self.pending.add(self.executor.submit(self._put_bulk, bulk_json))
+
+    def close(self):
+        """ Send the pending documents and wait for all the packs
+
+        :returns: total number of documents inserted
+        """
+
+        self.flush()
+
+        if self.executor:
+            self._wait_pending()
+            self.executor.shutdown()
+            self.executor = None
+
+        return self.total
+
+    def _wait_pending(self, return_when=ALL_COMPLETED):
+        done, self.pending = wait(self.pending, return_when=return_when)
+        for future in done:
+            self.__count(*future.result())
+
+    def __count(self, inserted, failed_ids):
+        self.total += inserted
+        self.failed += len(failed_ids)
+        self.failed_ids.extend(failed_ids)
+
+    def _put_bulk(self, bulk_json):
+        """ Send a pack, retrying one by one its documents with transient errors
+
+        :returns: tuple with the number of documents inserted and the ids of the failed ones
+        """
+        task_init = time()
+        failed = []
+        inserted = self.elastic._safe_put_bulk(self.url, bulk_json, failed)
+        json_size = len(bulk_json) / (1024 * 1024)
+        logger.debug("bulk packet sent (%.2f sec, %i items, %.2f MB)",
+                     time() - task_init, inserted, json_size)
+
+        if not failed:
+            return inserted, []
+
+        retry, failed_ids = self.split_failed(bulk_json, failed)
+        if retry:
+            logger.warning("Retrying one by one %i of %i failed documents", len(retry), len(failed))
+            sleep(self.elastic.retry_429_seconds)
+        for doc_id, action in retry:
+            if self.elastic._safe_put_bulk(self.url, action):
+                inserted += 1
+            else:
+                failed_ids.append(doc_id)
+
+        return inserted, failed_ids
+
+    @staticmethod
+    def split_failed(bulk_json, failed):
+        """ Split the failed actions of a pack in the ones to send again and the other ones
+
+        The actions rejected with a transient error (429 or 5xx) can be sent again.
+
+        :param failed: position and status of the failed actions
+        :returns: tuple with the (id, action) to send again and the ids of the other actions
+        """
+
+        # Each action is two lines: the action and the document
+        lines = bulk_json.split(b"\n")
+        retry = []
+        failed_ids = []
+        for pos, status in failed:
+            doc_id = list(json.loads(lines[2 * pos].decode('utf-8')).values())[0]['_id']
+            if status == 429 or (status or 0) >= 500:
+                retry.append((doc_id, b"\n".join(lines[2 * pos:2 * pos + 2]) + b"\n"))
+            else:
+                failed_ids.append(doc_id)
+
+        return retry, failed_ids
@@ -0,0 +1,458 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Elastic Search asyncio utils
+#
+# Copyright (C) 2018 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+"""Asynchronous ElasticSearch client based on asyncio and aiohttp.
+
+It implements the operations of ElasticSearch needed to read raw items
+and write enriched items in the same event loop, so one process can
+enrich several repositories concurrently:
+
+    loop.run_until_complete(asyncio.gather(
+        enrich_items_async(ocean_backend1, enrich_backend1),
+        enrich_items_async(ocean_backend2, enrich_backend2)))
+
+p2o uses it with --enrich-async. It needs aiohttp
+(pip install grimoire-elk[async]).
+"""
+
+import asyncio
+import json
+import logging
+
+from .elastic import BulkWriter, ElasticSearch, ElasticConnectException, ElasticWriteException
+
+logger = logging.getLogger(__name__)
+
+try:
+    import aiohttp
+    AIOHTTP_LIBS = True
+except ImportError:
+    logger.info("aiohttp not available")
+    AIOHTTP_LIBS = False
+
+
+HEADERS_JSON = {"Content-Type": "application/json"}
+HEADERS_NDJSON = {"Content-Type": "application/x-ndjson"}
+
+
+class AsyncElasticSearch(object):
+    """ ElasticSearch index client for asyncio
+
+    The sizes of the bulk packs and the bulk concurrency are the ones
+    configured in ElasticSearch (max_items_bulk, max_bulk_bytes and
+    bulk_workers). All the bulk writers of a client share the same
+    bulk_workers slots. Use the create or from_elastic coroutines to get
+    a new instance, and close it when done or use it as an async context
+    manager:
+
+        async with await AsyncElasticSearch.create(url, index) as elastic:
+            ...
+    """
+
+    scroll_time = "10m"  # time to keep the scroll context between pages
+
+    def __init__(self, url, index, session):
+        self.url = url
+        self.index = ElasticSearch.safe_index(index)
+        self.index_url = self.url + "/" + self.index
+        self.session = session
+        self.major = None
+        # Created in the create and from_elastic coroutines, so it is in their loop
+        self.bulk_slots = asyncio.Semaphore(ElasticSearch.bulk_workers)
+
+    @classmethod
+    async def create(cls, url, index, mappings=None, clean=False,
+                     insecure=True, analyzers=None):
+        """ Create a client for index in url, creating the index if needed
+
+        The params are the same than in ElasticSearch.
+        """
+
+        elastic = cls(url, index, cls._create_session(insecure))
+
+        try:
+            await elastic._init_index(mappings, clean, analyzers)
+        except Exception:
+            await elastic.close()
+            raise
+
+        return elastic
+
+    @classmethod
+    async def from_elastic(cls, elastic, insecure=True):
+        """ Create a client for the index of an ElasticSearch instance
+
+        The index is already initialized by the ElasticSearch instance so
+        no request is done.
+        """
+
+        async_elastic = cls(elastic.url, elastic.index, cls._create_session(insecure))
+        async_elastic.major = elastic.major
+
+        return async_elastic
+
+    @staticmethod
+    def _create_session(insecure):
+
+        if not AIOHTTP_LIBS:
+            raise RuntimeError("Async ElasticSearch configured but aiohttp not available.")
+
+        connector = aiohttp.TCPConnector(ssl=False if insecure else None)
+        return aiohttp.ClientSession(connector=connector)
+
+    async def _init_index(self, mappings, clean, analyzers):
+
+        async with self.session.get(self.url) as res:
+            if res.status != 200:
+                logger.error("Didn't get 200 OK from url %s", self.url)
+                raise ElasticConnectException
+            try:
+                version = await res.json(content_type=None)
+                self.major = version['version']['number'].split('.')[0]
+            except Exception:
+                logger.error("Could not read proper welcome message from url %s", self.url)
+                raise ElasticConnectException
+
+        async with self.session.get(self.index_url) as res:
+            exists = res.status == 200
+
+        if exists and clean:
+            async with self.session.delete(self.index_url) as res:
+                res.raise_for_status()
+            exists = False
+            logger.info("Deleted index %s", self.index_url)
+
+        if not exists:
+            async with self.session.put(self.index_url, data=analyzers,
+                                        headers=HEADERS_JSON) as res:
+                if res.status != 200:
+                    logger.error("Can't create index %s (%s)", self.index_url, res.status)
+                    raise ElasticWriteException()
+            logger.info("Created index %s", self.index_url)
+
+        if mappings:
+            await self.create_mappings(mappings.get_elastic_mappings(es_major=self.major))
+
+    async def close(self):
+        await self.session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def create_mappings(self, mappings):
+
+        not_analyze_strings = ElasticSearch.get_not_analyze_strings(self.major)
+
+        for _type in mappings:
+            url_map = self.index_url + "/" + _type + "/_mapping"
+
+            if mappings[_type] != '{}':
+                async with self.session.put(url_map, data=mappings[_type],
+                                            headers=HEADERS_JSON) as res:
+                    if res.status != 200:
+                        logger.error("Error creating ES mappings %s", await res.text())
+                        res.raise_for_status()
+
+            async with self.session.put(url_map, data=not_analyze_strings,
+                                        headers=HEADERS_JSON) as res:
+                if res.status != 200:
+                    logger.warning("Can't add mapping %s: %s", url_map, not_analyze_strings)
+
+    async def _put_bulk(self, url, bulk_json):
+        """ Bulk PUT waiting and retrying while ES rejects it with 429 """
+
+        wait_seconds = ElasticSearch.retry_429_seconds
+        for retry in range(ElasticSearch.max_retries_429 + 1):
+            async with self.session.put(url, data=bulk_json, headers=HEADERS_NDJSON) as res:
+                if res.status != 429 or retry == ElasticSearch.max_retries_429:
+                    res.raise_for_status()
+                    return await res.json(content_type=None)
+            logger.warning("Bulk rejected by ES (429), retrying in %.2f sec", wait_seconds)
+            await asyncio.sleep(wait_seconds)
+            wait_seconds *= 2
+
+    async def _safe_put_bulk(self, url, bulk_json, failed=None):
+        """ Bulk PUT returning the number of inserted items
+
+        :param failed: list to which the position and status of the failed actions are appended
+        """
+
+        result = await self._put_bulk(url, bulk_json)
+
+        failed_items = []
+        if result['errors']:
+            results = ElasticSearch.get_bulk_results(result)
+            failed_items = [item for item in results if 'error' in item]
+            if failed is not None:
+                failed.extend((pos, item.get('status')) for pos, item in enumerate(results)
+                              if 'error' in item)
+
+            logger.error("Failed to insert data to ES: %s, %s", str(failed_items[0]['error']), url)
+
+        return len(result['items']) - len(failed_items)
+
+    async def bulk_upload_docs(self, docs, failed_ids=None):
+        """ Upload (id, doc) pairs in packs to ES using bulk API
+
+        :param failed_ids: list to which the ids of the docs that couldn't be stored are appended
+        """
+
+        async with AsyncBulkWriter(self) as writer:
+            for doc_id, doc in docs:
+                await writer.add(doc_id, doc)
+
+        if failed_ids is not None:
+            failed_ids.extend(writer.failed_ids)
+
+        return writer.total
+
+    async def bulk_upload(self, items, field_id, failed_ids=None):
+        """ Upload in controlled packs items to ES using bulk API """
+
+        return await self.bulk_upload_docs(((item[field_id], item) for item in items), failed_ids)
+
+    async def refresh_index(self):
+        """ Make all the operations done in the index visible in searches """
+
+        async with self.session.post(self.index_url + '/_refresh') as res:
+            return res.status == 200
+
+    async def search(self, query, size, scroll=True):
+        """ Search in the index, starting a scroll if scroll is True """
+
+        url = self.index_url + "/_search?size=%i" % size
+        if scroll:
+            url += "&scroll=%s" % self.scroll_time
+        async with self.session.post(url, data=query, headers=HEADERS_JSON) as res:
+            res.raise_for_status()
+            return await res.json(content_type=None)
+
+    async def scroll(self, scroll_id):
+        """ Get the next page of a scroll """
+
+        url = self.url + "/_search/scroll"
+        data = json.dumps({"scroll": self.scroll_time, "scroll_id": scroll_id})
+        async with self.session.post(url, data=data, headers=HEADERS_JSON) as res:
+            res.raise_for_status()
+            return await res.json(content_type=None)
+
+    async def clear_scroll(self, scroll_id):
+        """ Free the scroll context in ES """
+
+        url = self.url + "/_search/scroll"
+        data = json.dumps({"scroll_id": [scroll_id]})
+        async with self.session.delete(url, data=data, headers=HEADERS_JSON) as res:
+            if res.status not in [200, 404]:
+                logger.warning("Can't clear scroll in %s (%s)", self.url, res.status)
+
+    async def fetch_pages(self, query, size):
+        """ Generate the pages of items (_source of the hits) found with query
+
+        The next page is requested while the current one is processed.
+        """
+
+        rjson = await self.search(query, size)
+        scroll_id = rjson.get('_scroll_id')
+
+        try:
+            while rjson['hits']['hits']:
+                next_page = asyncio.ensure_future(self.scroll(scroll_id))
+                # Let the request start before the page is processed
+                await asyncio.sleep(0)
+                yield [hit['_source'] for hit in rjson['hits']['hits']]
+                rjson = await next_page
+                scroll_id = rjson.get('_scroll_id', scroll_id)
+        finally:
+            if scroll_id:
+                await self.clear_scroll(scroll_id)
+
+    async def get_last_date(self, field, filters_=[]):
+        return await self.get_last_item_field(field, filters_=filters_)
+
+    async def get_last_offset(self, field, filters_=[]):
+        return await self.get_last_item_field(field, filters_=filters_, offset=True)
+
+    async def get_last_item_field(self, field, filters_=[], offset=False):
+        """ Max value of field in the items matching filters_ """
+
+        query = ElasticSearch.get_last_item_query(field, filters_)
+
+        async with self.session.post(self.index_url + "/_search", data=query,
+                                     headers=HEADERS_JSON) as res:
+            res.raise_for_status()
+            res_json = await res.json(content_type=None)
+
+        return ElasticSearch.get_last_item_value(res_json, offset)
+
+
+class AsyncBulkWriter(object):
+    """ Write documents to an index using the ES bulk API from asyncio
+
+    It works like BulkWriter: the documents are encoded into a buffer sent
+    when it reaches max_items_bulk documents or max_bulk_bytes bytes, and
+    the documents of a pack rejected with a transient error are sent again
+    one by one. A pack is sent when one of the bulk_workers slots of the
+    client is free, so adding documents waits while all of them are busy.
+
+    :param elastic: AsyncElasticSearch instance used to send the packs
+    :param url: bulk API url, by default the items bulk url of the index
+    """
+
+    def __init__(self, elastic, url=None):
+
+        self.elastic = elastic
+        self.url = url if url else elastic.index_url + '/items/_bulk'
+
+        self.buffer = bytearray()
+        self.current = 0  # documents in buffer
+        self.added = 0  # documents added to be sent
+        self.total = 0  # documents inserted in ES
+        self.failed = 0  # documents that couldn't be inserted in ES
+        self.failed_ids = []  # ids of the documents that couldn't be inserted in ES
+        self.total_bytes = 0  # bytes sent to ES
+
+        self.pending = set()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            # Don't send the documents of a failed process
+            self.cancel()
+        else:
+            await self.close()
+
+    async def add(self, doc_id, doc):
+        """ Add a document to be indexed with doc_id """
+
+        data = BulkWriter.index_action(doc_id, doc)
+        if self.current >= ElasticSearch.max_items_bulk or \
+                (self.current and len(self.buffer) + len(data) > ElasticSearch.max_bulk_bytes):
+            await self.flush()
+
+        self.buffer += data
+        self.current += 1
+        self.added += 1
+
+    async def flush(self):
+        """ Send the buffered documents to ES once there is a free slot """
+
+        if self.current == 0:
+            return
+
+        bulk_json = bytes(self.buffer)
+        del self.buffer[:]
+        self.current = 0
+        self.total_bytes += len(bulk_json)
+
+        await self.elastic.bulk_slots.acquire()
+        done = {task for task in self.pending if task.done()}
+        self.pending -= done
+        for task in done:
+            task.result()  # raise the errors of the packs already sent
+        self.pending.add(asyncio.ensure_future(self._put_bulk(bulk_json)))
+
+    async def close(self):
+        """ Send the pending documents and wait for all the packs
+
+        :returns: total number of documents inserted
+        """
+
+        await self.flush()
+
+        try:
+            await asyncio.gather(*self.pending)
+        finally:
+            self.cancel()
+
+        return self.total
+
+    def cancel(self):
+        """ Cancel the packs in flight """
+
+        for task in self.pending:
+            task.cancel()
+        self.pending = set()
+
+    async def _put_bulk(self, bulk_json):
+        """ Send a pack, retrying one by one its documents with transient errors """
+
+        try:
+            failed = []
+            inserted = await self.elastic._safe_put_bulk(self.url, bulk_json, failed)
+            failed_ids = []
+            if failed:
+                retry, failed_ids = BulkWriter.split_failed(bulk_json, failed)
+                if retry:
+                    logger.warning("Retrying one by one %i of %i failed documents",
+                                   len(retry), len(failed))
+                    await asyncio.sleep(ElasticSearch.retry_429_seconds)
+                for doc_id, action in retry:
+                    if await self.elastic._safe_put_bulk(self.url, action):
+                        inserted += 1
+                    else:
+                        failed_ids.append(doc_id)
+        finally:
+            self.elastic.bulk_slots.release()
+
+        self.total += inserted
+        self.failed += len(failed_ids)
+        self.failed_ids.extend(failed_ids)
+
+
+async def enrich_items_async(ocean_backend, enrich_backend, events=False):
+    """ Enrich the raw items of ocean_backend in the index of enrich_backend
+
+    The raw items are read and the rich items written using asyncio, so
+    the next raw page and the previous bulk packs are in flight while
+    the items of the current page are enriched. The indexes must be
+    already initialized in the ElasticSearch of both backends.
+    """
+
+    field_id = enrich_backend.get_field_unique_id()
+    query = ocean_backend.get_elastic_items_query()
+
+    async with await AsyncElasticSearch.from_elastic(ocean_backend.elastic) as reader, \
+            await AsyncElasticSearch.from_elastic(enrich_backend.elastic) as writer:
+        try:
+            async with AsyncBulkWriter(writer) as bulk:
+                async for items in reader.fetch_pages(query, ocean_backend.scroll_size):
+                    if enrich_backend.sortinghat:
+                        enrich_backend.resolve_sh_identities(items)
+                    for item in items:
+                        if not events:
+                            await bulk.add(item[field_id], enrich_backend.get_rich_item(item))
+                        else:
+                            for doc_id, doc in enrich_backend.get_rich_events_docs(item):
+                                await bulk.add(doc_id, doc)
+        finally:
+            enrich_backend.resolve_sh_identities([])
+
+    if bulk.failed:
+        logger.error("%i items couldn't be stored in %s", bulk.failed, writer.index_url)
+    logger.info("Total items enriched in %s: %i", writer.index_url, bulk.total)
+
+    return bulk.total
@@ -23,21 +23,27 @@
 #   Alvaro del Castillo San Felix <acs@bitergia.com>
 #
 
+import bisect
+import contextlib
 import json
 import functools
+import itertools
 import logging
+import multiprocessing
+import os
 import sys
 
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime as dt
 
-from dateutil import parser
 from functools import lru_cache
 
 from ..elastic_items import ElasticItems
-from ..errors import ELKError
 
-from .utils import grimoire_con
+from .elastic import BulkWriter
+from .utils import grimoire_con, parse_date
 from .. import __version__
+from ..metrics import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -67,6 +73,28 @@ except ImportError:
 DEFAULT_PROJECT = 'Main'
 DEFAULT_DB_USER = 'root'
 
+_pool_enrich = None  # Enrich used by the rich items pool processes
+
+
+def _init_pool_process():
+    """ Forget in a pool process the SortingHat connections of its parent
+
+    The connections are not closed: they are still used by the parent.
+    """
+
+    if _pool_enrich and _pool_enrich.sortinghat:
+        engine = _pool_enrich.sh_db._engine
+        engine.pool = engine.pool.recreate()
+
+
+def _get_rich_items(task):
+    """ Get the rich items of a chunk of items in a pool process """
+
+    items, sh_batch = task
+    (_pool_enrich.sh_batch_ids, _pool_enrich.sh_batch_uuids,
+     _pool_enrich.sh_batch_profiles, _pool_enrich.sh_batch_enrollments) = sh_batch
+    return [_pool_enrich.get_rich_item(item) for item in items]
+
 
 def metadata(func):
     """Add metadata to an item.
@@ -92,6 +120,8 @@ class Enrich(ElasticItems):
 
     sh_db = None
     kibiter_version = None
+    enrich_workers = 1  # Processes used to compute the rich items
+    studies_workers = 1  # Studies run concurrently
     RAW_FIELDS_COPY = ["metadata__updated_on", "metadata__timestamp",
                        "offset", "origin", "tag", "uuid"]
 
@@ -133,6 +163,8 @@ class Enrich(ElasticItems):
             # self.__compare_projects_map(self.prjs_map, self.json_projects)
             pass
 
+        self.__build_projects_index()
+
         self.studies = []
 
         self.requests = grimoire_con()
@@ -149,6 +181,12 @@ class Enrich(ElasticItems):
         # Label used during enrichment for identities without a known affiliation
         self.unaffiliated_group = 'Unknown'
 
+        # SortingHat data of the identities in the pack being enriched
+        self.sh_batch_ids = {}
+        self.sh_batch_uuids = set()
+        self.sh_batch_profiles = {}
+        self.sh_batch_enrollments = {}
+
     def set_elastic_url(self, url):
         """ Elastic URL """
         self.elastic_url = url
@@ -203,6 +241,63 @@ class Enrich(ElasticItems):
                         ds_repo_to_prj[ds][repo] = project
         return ds_repo_to_prj
 
+    def __build_projects_index(self):
+        """ Index the repositories of the projects map to find quickly the
+        first one of a data source that contains an origin
+
+        The repositories of each data source are joined in a text, in the
+        same order than in the map, so the first repository containing the
+        origin is the one in which text.find(origin) falls.
+        """
+        self.prjs_index = {}  # ds -> (text, offsets, repos) or None
+        self.prjs_origin_cache = {}  # (ds, origin) -> project
+        self.prjs_index_map = self.prjs_map  # map indexed
+
+        if not self.prjs_map:
+            return
+
+        for ds in self.prjs_map:
+            repos = list(self.prjs_map[ds])
+            ds_repos = [str(repo) for repo in repos]  # discourse has category_id ints
+            if any('\n' in ds_repo for ds_repo in ds_repos):
+                self.prjs_index[ds] = None
+                continue
+            offsets = []
+            offset = 0
+            for ds_repo in ds_repos:
+                offsets.append(offset)
+                offset += len(ds_repo) + 1
+            self.prjs_index[ds] = ("\n".join(ds_repos), offsets, repos)
+
+    def __find_origin_project(self, ds_name, origin):
+        """ Find the project of the first repository containing origin """
+
+        if self.prjs_index_map is not self.prjs_map:
+            # The map has been changed since it was indexed
+            self.__build_projects_index()
+
+        try:
+            return self.prjs_origin_cache[(ds_name, origin)]
+        except KeyError:
+            pass
+
+        project = None
+        index = self.prjs_index.get(ds_name)
+        if index is not None and '\n' not in origin:
+            text, offsets, repos = index
+            pos = text.find(origin)
+            if pos >= 0 and repos:
+                repo = repos[bisect.bisect_right(offsets, pos) - 1]
+                project = self.prjs_map[ds_name][repo]
+        else:
+            for ds_repo in self.prjs_map[ds_name]:
+                if origin in str(ds_repo):
+                    project = self.prjs_map[ds_name][ds_repo]
+                    break
+
+        self.prjs_origin_cache[(ds_name, origin)] = project
+        return project
+
     def __compare_projects_map(self, db, json):
         # Compare the projects coming from db and from a json file in eclipse
         ds_map_db = {}
@@ -307,82 +402,236 @@ class Enrich(ElasticItems):
     def enrich_events(self, items):
         return self.enrich_items(items, events=True)
 
-    def enrich_items(self, ocean_backend, events=False):
-        max_items = self.elastic.max_items_bulk
-        current = 0
-        total = 0
-        bulk_json = ""
+    def get_rich_events_docs(self, item):
+        """ Get the (id, rich event) pairs of the rich events of the raw item """
 
+        for rich_event in self.get_rich_events(item):
+            yield ("%s_%s" % (item[self.get_field_unique_id()],
+                              rich_event[self.get_field_event_unique_id()]), rich_event)
+
+    def enrich_items(self, ocean_backend, events=False):
         items = ocean_backend.fetch()
 
         url = self.elastic.index_url + '/items/_bulk'
 
-        logger.debug("Adding items to %s (in %i packs)", url, max_items)
+        logger.debug("Adding items to %s (in %i packs)", url, self.elastic.max_items_bulk)
 
         if events:
             logger.debug("Adding events items")
+            nitems, inserted = self.enrich_docs(items, self.get_rich_events_docs, "events")
+            return inserted
+
+        with BulkWriter(self.elastic, url) as writer:
+            for item, rich_item in self.__get_rich_items(items):
+                writer.add(item[self.get_field_unique_id()], rich_item)
+
+        self.__log_writer("items", writer)
+        logger.debug("Added %i items to %s (%0.2f MB)", writer.total, url,
+                     writer.total_bytes / (1024 * 1024))
+
+        return writer.total
+
+    def enrich_docs(self, items, get_docs, kind="items"):
+        """ Write to the index the documents generated for each raw item
+
+        Engine for the enrichments with several documents per raw item
+        (events, reviews, answers ...). The documents are streamed to ES
+        with a bulk writer as they are generated.
+
+        :param items: raw items to enrich
+        :param get_docs: function returning the (doc_id, doc) pairs of a raw item
+        :param kind: kind of the documents, used in the logs and metrics
+        :returns: tuple with the number of raw items and of documents inserted
+        """
+        writers = {}
+        nitems = self.__write_docs(items, [(kind, get_docs)], writers)
+
+        return nitems, writers[kind].total
+
+    def enrich_items_multi(self, ocean_backend, outputs):
+        """ Enrich the raw items in one pass, generating several kinds of documents
+
+        Each kind of document is written to the index with its own bulk
+        writer as it is generated, so the memory used doesn't depend on
+        the number of items.
 
+        :param ocean_backend: backend with the raw items to enrich
+        :param outputs: list of (kind, get_docs), get_docs(item) returning
+            the (doc_id, doc) of the kind for a raw item
+        :returns: number of raw items enriched
+        """
+        return self.__write_docs(ocean_backend.fetch(), outputs, {})
+
+    def __write_docs(self, items, outputs, writers):
+        """ Write the documents of each kind of outputs, adding its writer to writers """
+
+        url = self.elastic.index_url + '/items/_bulk'
+
+        nitems = 0
+        with contextlib.ExitStack() as stack:
+            for kind, get_docs in outputs:
+                writers[kind] = stack.enter_context(BulkWriter(self.elastic, url))
+
+            for item in self.__resolve_packs(items):
+                nitems += 1
+                for kind, get_docs in outputs:
+                    for doc_id, doc in get_docs(item):
+                        writers[kind].add(doc_id, doc)
+
+        for kind, writer in writers.items():
+            logger.debug("Added %i %s to %s", writer.total, kind, url)
+            self.__log_writer(kind, writer)
+
+        return nitems
+
+    def __log_writer(self, kind, writer):
+        """ Report the documents of writer that couldn't be stored """
+
+        if writer.failed:
+            metrics.inc('docs_failed_total', writer.failed, index=self.elastic.index, kind=kind)
+        if writer.total != writer.added:
+            logger.error("%i/%i missing %s for %s", writer.added - writer.total,
+                         writer.added, kind, self.get_connector_name())
+
+    def __get_rich_items(self, items):
+        """ Yield each item with its rich item, in the order of the items """
+
+        if self.enrich_workers <= 1:
+            for item in self.__resolve_packs(items):
+                yield item, self.get_rich_item(item)
+            return
+
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            logger.warning("Can't use %i processes to enrich without fork", self.enrich_workers)
+            for item in self.__resolve_packs(items):
+                yield item, self.get_rich_item(item)
+            return
+
+        yield from self.__get_rich_items_pool(items)
+
+    def __get_rich_items_pool(self, items):
+        """ Yield each item with its rich item, computed in a pool of processes
+
+        Each bulk pack is split in chunks, one per process. The SortingHat
+        identities of the pack are resolved here and sent with the chunks,
+        so the processes only use their own SortingHat connection for the
+        identities not yet in SortingHat. The next pack is sent to the
+        pool before the rich items of the current one are returned.
+
+        The pool processes are forked from this one, so changes done by
+        get_rich_item to the state of the enrich (caches) are not kept.
+        If a pool process dies (killed, out of memory ...) the enrichment
+        fails with BrokenProcessPool.
+        """
+        global _pool_enrich
+
+        def submit(pool, pack):
+            if self.sortinghat:
+                self.resolve_sh_identities(pack)
+            sh_batch = (self.sh_batch_ids, self.sh_batch_uuids,
+                        self.sh_batch_profiles, self.sh_batch_enrollments)
+            chunk_size = -(-len(pack) // self.enrich_workers)
+            futures = [pool.submit(_get_rich_items, (pack[i:i + chunk_size], sh_batch))
+                       for i in range(0, len(pack), chunk_size)]
+            return pack, futures
+
+        pool_params = {}
+        if sys.version_info >= (3, 7):
+            pool_params['mp_context'] = multiprocessing.get_context('fork')
+            pool_params['initializer'] = _init_pool_process
+
+        _pool_enrich = self
+        items = iter(items)
+        pool = ProcessPoolExecutor(self.enrich_workers, **pool_params)
+        pending = None
+        try:
+            if self.sortinghat:
+                # Don't share the SortingHat connections with the pool processes
+                self.sh_db._engine.dispose()
+            # Without initializer (Python < 3.7) all the processes are forked on
+            # the first submit: do it before resolve_sh_identities connects again
+            pool.submit(os.getpid).result()
+
+            while True:
+                pack = list(itertools.islice(items, self.elastic.max_items_bulk))
+                current = pending
+                pending = submit(pool, pack) if pack else None
+                if current:
+                    pack_items, futures = current
+                    rich_items = itertools.chain.from_iterable(future.result() for future in futures)
+                    yield from zip(pack_items, rich_items)
+                if not pending:
+                    break
+        finally:
+            # Don't wait for the chunks not needed anymore
+            for future in pending[1] if pending else []:
+                future.cancel()
+            pool.shutdown()
+            _pool_enrich = None
+            self.resolve_sh_identities([])
+
+    def __resolve_packs(self, items):
+        """ Yield the items resolving the SH identities of each bulk pack first """
+
+        items = iter(items)
+        while True:
+            pack = list(itertools.islice(items, self.elastic.max_items_bulk))
+            if not pack:
+                break
+            if self.sortinghat:
+                self.resolve_sh_identities(pack)
+            for item in pack:
+                yield item
+        self.resolve_sh_identities([])
+
+    def resolve_sh_identities(self, items):
+        """ Load the SortingHat data of the identities in a pack of raw items
+
+        The ids, uuids, profiles and enrollments of all the identities are
+        read with a few queries, replacing the data of the previous pack.
+        Identities not yet in SortingHat are resolved one by one later.
+        """
+        self.sh_batch_ids = {}
+        self.sh_batch_uuids = set()
+        self.sh_batch_profiles = {}
+        self.sh_batch_enrollments = {}
+
+        if not items:
+            return
+
+        backend_name = self.get_connector_name()
+        ids = {}
         for item in items:
-            if current >= max_items:
+            try:
+                identities = list(self.get_identities(item))
+            except NotImplementedError:
+                return
+            for identity in identities:
+                key = self.__get_sh_key(identity)
+                if key in ids:
+                    continue
                 try:
-                    r = self.requests.put(url, headers=HEADERS_JSON, data=bulk_json)
-                    r.raise_for_status()
-                    json_size = sys.getsizeof(bulk_json) / (1024 * 1024)
-                    logger.debug("Added %i items to %s (%0.2f MB)", total, url, json_size)
-                except UnicodeEncodeError:
-                    # Why is requests encoding the POST data as ascii?
-                    logger.error("Unicode error in enriched items")
-                    logger.debug(bulk_json)
-                    safe_json = str(bulk_json.encode('ascii', 'ignore'), 'ascii')
-                    self.requests.put(url, headers=HEADERS_JSON, data=safe_json)
-                bulk_json = ""
-                current = 0
-
-            if not events:
-                rich_item = self.get_rich_item(item)
-                data_json = json.dumps(rich_item)
-                bulk_json += '{"index" : {"_id" : "%s" } }\n' % \
-                    (item[self.get_field_unique_id()])
-                bulk_json += data_json + "\n"  # Bulk document
-                current += 1
-                total += 1
-            else:
-                rich_events = self.get_rich_events(item)
-                for rich_event in rich_events:
-                    data_json = json.dumps(rich_event)
-                    bulk_json += '{"index" : {"_id" : "%s_%s" } }\n' % \
-                        (item[self.get_field_unique_id()],
-                         rich_event[self.get_field_event_unique_id()])
-                    bulk_json += data_json + "\n"  # Bulk document
-                    current += 1
-                    total += 1
-
-        if total == 0:
-            # No items enriched, nothing to upload to ES
-            return total
-
-        r = self.requests.put(url, data=bulk_json, headers=HEADERS_JSON)
-        r.raise_for_status()
-        result = r.json()
-
-        failed_items = []
-        if result['errors']:
-            # Due to multiple errors that may be thrown when inserting bulk data, only the first error is returned
-            failed_items = [item['index'] for item in result['items'] if 'error' in item['index']]
-            error = str(failed_items[0]['error'])
-
-            logger.error("Failed to enrich data ES: %s, %s", error, url)
-
-        inserted_items = len(result['items']) - len(failed_items)
-
-        # The exception is currently not thrown to avoid stopping elk uploading processes
-        try:
-            if failed_items:
-                raise ELKError(cause=error)
-        except ELKError:
-            pass
+                    ids[key] = utils.uuid(backend_name, email=key[0],
+                                          name=key[1], username=key[2])
+                except (ValueError, UnicodeEncodeError):
+                    continue
+
+        with metrics.time('sortinghat_seconds', call="resolve_pack"):
+            uuids = SortingHat.get_uuids_from_ids(self.sh_db, list(set(ids.values())))
+            for key, sh_id in ids.items():
+                if sh_id in uuids:
+                    self.sh_batch_ids[key] = {"id": sh_id, "uuid": uuids[sh_id]}
+
+            self.sh_batch_uuids = set(uuids.values())
+            self.sh_batch_profiles = SortingHat.get_profiles(self.sh_db, list(self.sh_batch_uuids))
+            self.sh_batch_enrollments = SortingHat.get_enrollments(self.sh_db, list(self.sh_batch_uuids))
+        metrics.inc('sortinghat_calls_total', call="resolve_pack")
 
-        return inserted_items
+        logger.debug("Resolved %i SH identities of %i items", len(self.sh_batch_ids), len(items))
+
+    @staticmethod
+    def __get_sh_key(identity):
+        return (identity.get('email'), identity.get('name'), identity.get('username'))
 
     def get_connector_name(self):
         """ Find the name for the current connector """
@@ -405,6 +654,10 @@ class Enrich(ElasticItems):
         """ Return the identities from an item """
         raise NotImplementedError
 
+    def prefetch_identities(self, items):
+        """ Prepare the data needed to get the identities of a pack of items """
+        pass
+
     def get_email_domain(self, email):
         domain = None
         try:
@@ -473,7 +726,7 @@ class Enrich(ElasticItems):
 
         grimoire_date = None
         try:
-            grimoire_date = parser.parse(creation_date).isoformat()
+            grimoire_date = parse_date(creation_date).isoformat()
         except Exception as ex:
             pass
 
@@ -527,11 +780,7 @@ class Enrich(ElasticItems):
                     project = self.prjs_map[ds_name][eitem['origin']]
                 elif ds_name in self.prjs_map:
                     # Try to find origin as part of the keys
-                    for ds_repo in self.prjs_map[ds_name]:
-                        ds_repo = str(ds_repo)  # discourse has category_id ints
-                        if eitem['origin'] in ds_repo:
-                            project = self.prjs_map[ds_name][ds_repo]
-                            break
+                    project = self.__find_origin_project(ds_name, eitem['origin'])
 
         if project is None:
             project = DEFAULT_PROJECT
@@ -564,6 +813,10 @@ class Enrich(ElasticItems):
 
     def is_bot(self, uuid):
         bot = False
+        if uuid in self.sh_batch_uuids:
+            if uuid in self.sh_batch_profiles:
+                bot = self.sh_batch_profiles[uuid]['is_bot']
+            return bot
         u = self.get_unique_identity(uuid)
         if u.profile:
             bot = u.profile.is_bot
@@ -575,16 +828,19 @@ class Enrich(ElasticItems):
         if item_date and item_date.tzinfo:
             item_date = (item_date - item_date.utcoffset()).replace(tzinfo=None)
 
-        enrollments = self.get_enrollments(uuid)
+        if uuid in self.sh_batch_uuids:
+            enrollments = self.sh_batch_enrollments.get(uuid, [])
+        else:
+            enrollments = [(enrollment.start, enrollment.end, enrollment.organization.name)
+                           for enrollment in self.get_enrollments(uuid)]
         enroll = self.unaffiliated_group
-        if len(enrollments) > 0:
-            for enrollment in enrollments:
-                if not item_date:
-                    enroll = enrollment.organization.name
-                    break
-                elif item_date >= enrollment.start and item_date <= enrollment.end:
-                    enroll = enrollment.organization.name
-                    break
+        for start, end, org_name in enrollments:
+            if not item_date:
+                enroll = org_name
+                break
+            elif item_date >= start and item_date <= end:
+                enroll = org_name
+                break
         return enroll
 
     def __get_item_sh_fields_empty(self, rol):
@@ -643,6 +899,12 @@ class Enrich(ElasticItems):
     def get_profile_sh(self, uuid):
         profile = {}
 
+        if uuid in self.sh_batch_uuids:
+            if uuid in self.sh_batch_profiles:
+                profile['name'] = self.sh_batch_profiles[uuid]['name']
+                profile['email'] = self.sh_batch_profiles[uuid]['email']
+            return profile
+
         u = self.get_unique_identity(uuid)
         if u.profile:
             profile['name'] = u.profile.name
@@ -663,7 +925,7 @@ class Enrich(ElasticItems):
         if not roles:
             roles = [author_field]
 
-        date = parser.parse(eitem[self.get_field_date()])
+        date = parse_date(eitem[self.get_field_date()])
 
         for rol in roles:
             if rol + "_id" not in eitem:
@@ -712,9 +974,9 @@ class Enrich(ElasticItems):
             roles = [author_field]
 
         if not date_field:
-            item_date = parser.parse(item[self.get_field_date()])
+            item_date = parse_date(item[self.get_field_date()])
         else:
-            item_date = parser.parse(item[date_field])
+            item_date = parse_date(item[date_field])
 
         users_data = self.get_users_data(item)
 
@@ -733,22 +995,32 @@ class Enrich(ElasticItems):
 
     @lru_cache()
     def get_enrollments(self, uuid):
+        metrics.inc('sortinghat_calls_total', call="enrollments")
         return api.enrollments(self.sh_db, uuid)
 
     @lru_cache()
     def get_unique_identity(self, uuid):
+        metrics.inc('sortinghat_calls_total', call="unique_identities")
         return api.unique_identities(self.sh_db, uuid)[0]
 
     @lru_cache()
     def get_uuid_from_id(self, sh_id):
         """ Get the SH identity uuid from the id """
+        metrics.inc('sortinghat_calls_total', call="uuid_from_id")
         return SortingHat.get_uuid_from_id(self.sh_db, sh_id)
 
     def get_sh_ids(self, identity, backend_name):
         """ Return the Sorting Hat id and uuid for an identity """
+        key = self.__get_sh_key(identity)
+        if key in self.sh_batch_ids:
+            metrics.inc('sortinghat_lookups_total', source="batch")
+            return self.sh_batch_ids[key]
         # Convert the dict to tuple so it is hashable
         identity_tuple = tuple(identity.items())
+        misses = self.__get_sh_ids_cache.cache_info().misses
         sh_ids = self.__get_sh_ids_cache(identity_tuple, backend_name)
+        if self.__get_sh_ids_cache.cache_info().misses == misses:
+            metrics.inc('sortinghat_lookups_total', source="cache")
         return sh_ids
 
     @lru_cache()
@@ -760,6 +1032,10 @@ class Enrich(ElasticItems):
         if not self.sortinghat:
             raise RuntimeError("Sorting Hat not active during enrich")
 
+        # Only the lookups not in the cache get here
+        metrics.inc('sortinghat_lookups_total', source="sortinghat")
+        metrics.inc('sortinghat_calls_total', call="add_identity")
+
         iden = {}
         sh_ids = {"id": None, "uuid": None}
 
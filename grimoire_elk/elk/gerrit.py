@@ -24,11 +24,11 @@
 #
 
 from datetime import datetime
-from dateutil import parser
 import logging
 import time
 
 from .enrich import Enrich, metadata
+from .utils import parse_date
 from ..elastic_mapping import Mapping as BaseMapping
 
 
@@ -210,10 +210,10 @@ class GerritEnrich(Enrich):
         eitem["patchsets"] = len(review["patchSets"])
 
         # Time to add the time diffs
-        createdOn_date = parser.parse(review['createdOn'])
+        createdOn_date = parse_date(review['createdOn'])
         if len(review["patchSets"]) > 0:
-            createdOn_date = parser.parse(review["patchSets"][0]['createdOn'])
-        lastUpdated_date = parser.parse(review['lastUpdated'])
+            createdOn_date = parse_date(review["patchSets"][0]['createdOn'])
+        lastUpdated_date = parse_date(review['lastUpdated'])
         seconds_day = float(60 * 60 * 24)
         if eitem['status'] in ['MERGED', 'ABANDONED']:
             timeopen = \
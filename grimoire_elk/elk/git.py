@@ -30,10 +30,12 @@ import sys
 
 import requests
 
-from dateutil import parser
-
+from .elastic import BulkWriter
 from .enrich import Enrich, metadata
+from .github_logins import GitHubLoginsCache, GitHubLoginsResolver
+from .utils import parse_date
 from ..elastic_mapping import Mapping as BaseMapping
+from ..studies import study, STUDIES_DATE_FIELD
 
 try:
     from .sortinghat import SortingHat
@@ -94,6 +96,10 @@ class GitEnrich(Enrich):
 
     roles = ['Author', 'Commit']
 
+    github_logins_cache_file = None  # File to persist the GitHub logins between runs
+    github_workers = 1  # Concurrent requests to the GitHub API
+    demography_authors_page = 1000  # Authors processed at once in the demography study
+
     def __init__(self, db_sortinghat=None, db_projects_map=None, json_projects_map=None,
                  db_user='', db_password='', db_host='', pair_programming=False):
         super().__init__(db_sortinghat, db_projects_map, json_projects_map,
@@ -103,16 +109,18 @@ class GitEnrich(Enrich):
 
         # GitHub API management
         self.github_token = None
-        self.github_logins = {}
+        self.github_logins = GitHubLoginsCache(self.github_logins_cache_file)
         self.github_logins_committer_not_found = 0
         self.github_logins_author_not_found = 0
-        self.rate_limit = None
-        self.rate_limit_reset_ts = None
-        self.min_rate_to_sleep = 100  # if pending rate < 100 sleep
+        self.github_resolver = None
+        self.min_rate_to_sleep = 100  # if pending rate < 100 defer the logins until the reset
         self.pair_programming = pair_programming
 
     def set_github_token(self, token):
         self.github_token = token
+        self.github_resolver = GitHubLoginsResolver(self.requests, token,
+                                                    workers=self.github_workers,
+                                                    min_rate_to_sleep=self.min_rate_to_sleep)
 
     def get_field_author(self):
         return "Author"
@@ -151,10 +159,7 @@ class GitEnrich(Enrich):
 
         def add_sh_github_identity(user, user_field, rol):
             """ Add a new github identity to SH if it does not exists """
-            github_repo = None
-            if GITHUB in item['origin']:
-                github_repo = item['origin'].replace(GITHUB, '')
-                github_repo = re.sub('.git$', '', github_repo)
+            github_repo = self.get_github_repo(item)
             if not github_repo:
                 return
 
@@ -233,6 +238,71 @@ class GitEnrich(Enrich):
     def get_project_repository(self, eitem):
         return eitem['origin']
 
+    @staticmethod
+    def get_github_repo(item):
+        """ Get the owner/name of the GitHub repository of a raw item """
+
+        github_repo = None
+        if GITHUB in item['origin']:
+            github_repo = item['origin'].replace(GITHUB, '')
+            github_repo = re.sub('.git$', '', github_repo)
+        return github_repo
+
+    def prefetch_identities(self, items):
+        """ Get from GitHub the logins of the users of a pack of items
+
+        The commits of the users not in SortingHat nor in the logins cache
+        are read from the GitHub API concurrently. The users of the commits
+        not read because of the rate limit are left unresolved, so they are
+        looked up again in the next packs. The cache is saved every
+        save_every new logins and when the enrichment ends.
+        """
+        if not self.github_token:
+            return
+
+        pending = {}  # user -> (rol, commit)
+        for item in items:
+            github_repo = self.get_github_repo(item)
+            if not github_repo:
+                continue
+            commit = (github_repo, item['data']['commit'])
+            for user_field, rol in [('Author', 'author'), ('Commit', 'committer')]:
+                user_data = item['data'][user_field]
+                if not user_data or user_data in self.github_logins or user_data in pending:
+                    continue
+                if self.pair_programming and self.AUTHOR_P2P_REGEX.match(user_data):
+                    continue
+                if self.sortinghat:
+                    user = self.get_sh_identity(user_data)
+                    sh_identity = SortingHat.get_github_commit_username(self.sh_db, user, SH_GIT_COMMIT)
+                    if sh_identity:
+                        self.github_logins[user_data] = sh_identity['username']
+                        continue
+                pending[user_data] = (rol, commit)
+
+        if pending:
+            commits_json = self.github_resolver.get_commits([commit for _, commit in pending.values()])
+            for user_data, (rol, commit) in pending.items():
+                if commits_json[commit] is not None:
+                    self.__add_github_login(user_data, rol, commits_json[commit])
+            logger.debug("Read %i commits from GitHub for %i users", len(commits_json), len(pending))
+
+    def __add_github_login(self, user, rol, commit_json):
+        """ Add to the cache the login of the user with rol in a commit """
+
+        if not commit_json.get('author'):
+            self.github_logins_author_not_found += 1
+        if not commit_json.get('committer'):
+            self.github_logins_committer_not_found += 1
+
+        login = GitHubLoginsResolver.get_login(commit_json, rol)
+
+        self.github_logins[user] = login
+        logger.debug("%s is %s in github (not found %i authors %i committers )", user, login,
+                     self.github_logins_author_not_found,
+                     self.github_logins_committer_not_found)
+        return login
+
     def get_github_login(self, user, rol, commit_hash, repo):
         """ rol: author or committer """
         login = None
@@ -240,64 +310,9 @@ class GitEnrich(Enrich):
             login = self.github_logins[user]
         except KeyError:
             # Get the login from github API
-            GITHUB_API_URL = "https://api.github.com"
-            commit_url = GITHUB_API_URL + "/repos/%s/commits/%s" % (repo, commit_hash)
-            headers = {'Authorization': 'token ' + self.github_token}
-
-            r = self.requests.get(commit_url, headers=headers)
-
-            try:
-                r.raise_for_status()
-            except requests.exceptions.ConnectionError as ex:
-                # Connection error
-                logger.error("Can't get github login for %s in %s because a connection error ", repo, commit_hash)
-                return login
-
-            self.rate_limit = int(r.headers['X-RateLimit-Remaining'])
-            self.rate_limit_reset_ts = int(r.headers['X-RateLimit-Reset'])
-            logger.debug("Rate limit pending: %s", self.rate_limit)
-            if self.rate_limit <= self.min_rate_to_sleep:
-                seconds_to_reset = self.rate_limit_reset_ts - int(time.time()) + 1
-                if seconds_to_reset < 0:
-                    seconds_to_reset = 0
-                cause = "GitHub rate limit exhausted."
-                logger.info("%s Waiting %i secs for rate limit reset.", cause, seconds_to_reset)
-                time.sleep(seconds_to_reset)
-                # Retry once we have rate limit
-                r = self.requests.get(commit_url, headers=headers)
-
-            try:
-                r.raise_for_status()
-            except requests.exceptions.HTTPError as ex:
-                # commit not found probably or rate limit exhausted
-                logger.error("Can't find commit %s %s", commit_url, ex)
-                return login
-
-            commit_json = r.json()
-            author_login = None
-            if 'author' in commit_json and commit_json['author']:
-                author_login = commit_json['author']['login']
-            else:
-                self.github_logins_author_not_found += 1
-
-            user_login = None
-            if 'committer' in commit_json and commit_json['committer']:
-                user_login = commit_json['committer']['login']
-            else:
-                self.github_logins_committer_not_found += 1
-
-            if rol == "author":
-                login = author_login
-            elif rol == "committer":
-                login = user_login
-            else:
-                logger.error("Wrong rol: %s" % (rol))
-                raise RuntimeError
-
-            self.github_logins[user] = login
-            logger.debug("%s is %s in github (not found %i authors %i committers )", user, login,
-                         self.github_logins_author_not_found,
-                         self.github_logins_committer_not_found)
+            commit_json = self.github_resolver.get_commit(repo, commit_hash)
+            if commit_json is not None:
+                login = self.__add_github_login(user, rol, commit_json)
 
         return login
 
@@ -330,8 +345,8 @@ class GitEnrich(Enrich):
                 eitem[map_fields[fn]] = None
         eitem['hash_short'] = eitem['hash'][0:6]
         # Enrich dates
-        author_date = parser.parse(commit["AuthorDate"])
-        commit_date = parser.parse(commit["CommitDate"])
+        author_date = parse_date(commit["AuthorDate"])
+        commit_date = parse_date(commit["CommitDate"])
         eitem["author_date"] = author_date.replace(tzinfo=None).isoformat()
         eitem["commit_date"] = commit_date.replace(tzinfo=None).isoformat()
         eitem["utc_author"] = (author_date - author_date.utcoffset()).replace(tzinfo=None).isoformat()
@@ -567,133 +582,147 @@ class GitEnrich(Enrich):
 
         return total
 
-    def enrich_demography(self, enrich_backend, no_incremental=False):
+    @study()
+    def enrich_demography(self, enrich_backend, no_incremental=False, from_date=None):
+        """ Add to the commits the first and last commit dates of its author
+
+        Only the authors with commits enriched since from_date, or not yet
+        processed by the study without it, are updated, unless no_incremental.
+        The authors are read in pages and, for each page, the dates of all
+        its authors are got in one query and only the commits whose dates
+        change are updated, partially.
+
+        :returns: number of commits updated
+        """
 
         logger.info("Doing demography enrich for %s", self.elastic.index_url)
-        time.sleep(1)  # HACK: Wait until git enrich index has been written
+        if not self.elastic.refresh_index():
+            time.sleep(1)  # HACK: Wait until git enrich index has been written
 
         date_field = self.get_incremental_date()
 
         # Don't use commits before DEMOGRAPHY_COMMIT_MIN_DATE
-        filters = '''
-        {"range":
-            {"%s": {"gte": "%s"}}
-        }
-        ''' % (date_field, DEMOGRAPHY_COMMIT_MIN_DATE)
-
-        # Only commits not already processed by demography study so it
-        # must not contains the extra fields author_min_date/author_max_date
-        query = """
-        "query": {
-            "bool": {
-                "must": [%s],
-                "must_not": [
-                    {"exists": {
-                        "field": "author_min_date"
-                    }},
-                    {"exists": {
-                        "field": "author_max_date"
-                    }}
-                ]
-            }
-        },
-        """ % (filters)
+        commits_filter = {"range": {date_field: {"gte": DEMOGRAPHY_COMMIT_MIN_DATE}}}
+
+        # Only authors with commits not already processed by demography study
+        # so they don't contain the extra fields author_min_date/author_max_date
+        authors_query = {"bool": {"must": [commits_filter]}}
+        if from_date:
+            authors_query["bool"]["must"].append({"range": {STUDIES_DATE_FIELD: {"gte": from_date}}})
+        elif not no_incremental:
+            authors_query["bool"]["must_not"] = [{"exists": {"field": "author_min_date"}},
+                                                 {"exists": {"field": "author_max_date"}}]
+
+        nauthors = 0
+        ncommits = 0
+        try:
+            with BulkWriter(self.elastic) as writer:
+                for authors in self.__get_demography_authors(authors_query):
+                    dates = self.__get_demography_dates(authors, commits_filter)
+                    ncommits += self.__update_demography(writer, authors, dates)
+                    nauthors += len(authors)
+                    logger.info("Authors processed %i, commits updated %i", nauthors, ncommits)
+        except requests.exceptions.HTTPError as ex:
+            logger.error("Error getting authors min and max date. Demography aborted.")
+            logger.error(ex)
+            raise
+
+        logger.debug("Completed demography enrich from %s" % (self.elastic.index_url))
+
+        return ncommits
+
+    def __get_demography_authors(self, query):
+        """ Get the authors of the commits of a query in pages of authors
+
+        A composite aggregation is used to page all the authors. ES versions
+        without it (before 6.1) get up to 10000 authors with a terms one.
+        """
+
+        page = self.demography_authors_page
+        composite = {"composite": {"size": page,
+                                   "sources": [{"author": {"terms": {"field": "Author"}}}]}}
+        es_query = {"query": query, "size": 0, "aggs": {"author": composite}}
+
+        if self.elastic.major not in ['2', '5']:
+            while True:
+                r = self.requests.post(self.elastic.index_url + "/_search",
+                                       data=json.dumps(es_query), headers=HEADER_JSON,
+                                       verify=False)
+                if r.status_code == 400 and 'after' not in composite['composite']:
+                    logger.warning("Composite aggregation not supported in %s", self.elastic.url)
+                    break
+                r.raise_for_status()
+                agg = r.json()['aggregations']['author']
+                authors = [bucket['key']['author'] for bucket in agg['buckets']]
+                if authors:
+                    yield authors
+                if len(authors) < page or 'after_key' not in agg:
+                    return
+                composite['composite']['after'] = agg['after_key']
 
-        # First, get the min and max commit date for all the authors
         # Limit aggregations: https://github.com/elastic/elasticsearch/issues/18838
         # 10000 seems to be a sensible number of the number of people in git
-        es_query = """
-        {
-          %s
-          "size": 0,
-          "aggs": {
-            "author": {
-              "terms": {
-                "field": "Author",
-                "size": 10000
-              },
-              "aggs": {
-                "min": {
-                  "min": {
-                    "field": "utc_commit"
-                  }
-                },
-                "max": {
-                  "max": {
-                    "field": "utc_commit"
-                  }
+        es_query['aggs']['author'] = {"terms": {"field": "Author", "size": 10000}}
+        r = self.requests.post(self.elastic.index_url + "/_search",
+                               data=json.dumps(es_query), headers=HEADER_JSON,
+                               verify=False)
+        r.raise_for_status()
+        authors = [bucket['key'] for bucket in r.json()['aggregations']['author']['buckets']]
+        for i in range(0, len(authors), page):
+            yield authors[i:i + page]
+
+    def __get_demography_dates(self, authors, commits_filter):
+        """ Get the min and max commit dates of a list of authors
+
+        :returns: dict with the (min, max) dates of each author
+        """
+
+        es_query = {
+            "query": {"bool": {"must": [commits_filter, {"terms": {"Author": authors}}]}},
+            "size": 0,
+            "aggs": {
+                "author": {
+                    "terms": {"field": "Author", "size": len(authors)},
+                    "aggs": {
+                        "min": {"min": {"field": "utc_commit"}},
+                        "max": {"max": {"field": "utc_commit"}}
+                    }
                 }
-              }
             }
-          }
         }
-        """ % (query)
-
-        logger.debug(es_query)
 
         r = self.requests.post(self.elastic.index_url + "/_search",
-                               data=es_query, headers=HEADER_JSON,
+                               data=json.dumps(es_query), headers=HEADER_JSON,
                                verify=False)
-        try:
-            r.raise_for_status()
-        except requests.exceptions.HTTPError as ex:
-            logger.error("Error getting authors mix and max date. Demography aborted.")
-            logger.error(ex)
-            return
+        r.raise_for_status()
 
-        authors = r.json()['aggregations']['author']['buckets']
-
-        author_items = []  # items from author with new date fields added
-        nauthors_done = 0
-        author_query = """
-        {
-            "query": {
-                "bool": {
-                    "must": [
-                        {"term":
-                            { "Author" : ""  }
-                        }
-                        ]
-                }
-            }
+        dates = {}
+        for bucket in r.json()['aggregations']['author']['buckets']:
+            dates[bucket['key']] = (bucket['min']['value_as_string'],
+                                    bucket['max']['value_as_string'])
+            logger.debug("%s: %s %s", bucket['key'], *dates[bucket['key']])
 
-        }
+        return dates
+
+    def __update_demography(self, writer, authors, dates):
+        """ Update the dates of the commits of the authors that changed
+
+        :returns: number of commits updated
         """
-        author_query_json = json.loads(author_query)
-
-        for author in authors:
-            # print("%s: %s %s" % (author['key'], author['min']['value_as_string'], author['max']['value_as_string']))
-            # Time to add all the commits (items) from this author
-            author_query_json['query']['bool']['must'][0]['term']['Author'] = author['key']
-            author_query_str = json.dumps(author_query_json)
-            r = self.requests.post(self.elastic.index_url + "/_search?size=10000",
-                                   data=author_query_str, headers=HEADER_JSON,
-                                   verify=False)
-
-            if "hits" not in r.json():
-                logger.error("Can't find commits for %s", author['key'])
-                logger.error(r.json())
-                logger.error(author_query)
+
+        query = {"query": {"terms": {"Author": authors}},
+                 "_source": ["Author", "author_min_date", "author_max_date"]}
+
+        updated = 0
+        for hit in self.elastic.scroll_hits(query, size=self.elastic.max_items_bulk):
+            commit = hit['_source']
+            if commit.get('Author') not in dates:
+                continue
+            min_date, max_date = dates[commit['Author']]
+            if commit.get('author_min_date') == min_date and commit.get('author_max_date') == max_date:
                 continue
-            for item in r.json()["hits"]["hits"]:
-                new_item = item['_source']
-                new_item["author_max_date"] = author['max']['value_as_string']
-                if "author_min_date" not in new_item or not new_item['author_min_date']:
-                    new_item["author_min_date"] = author['min']['value_as_string']
-                # In p2p the ids are created during enrichment
-                new_item["_item_id"] = item['_id']
-                author_items.append(new_item)
-
-            if len(author_items) >= self.elastic.max_items_bulk:
-                self.elastic.bulk_upload(author_items, "_item_id")
-                author_items = []
-
-            nauthors_done += 1
-            logger.debug("%s: %s %s", author['key'],
-                         author['min']['value_as_string'],
-                         author['max']['value_as_string'])
-            logger.info("Authors processed %i/%i", nauthors_done, len(authors))
-
-        self.elastic.bulk_upload(author_items, "_item_id")
+            # In p2p the ids are created during enrichment
+            writer.update(hit['_id'], {"author_min_date": min_date, "author_max_date": max_date})
+            updated += 1
 
-        logger.debug("Completed demography enrich from %s" % (self.elastic.index_url))
+        return updated
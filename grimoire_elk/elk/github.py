@@ -31,11 +31,13 @@ from datetime import datetime
 
 from .utils import get_time_diff_days
 
+from .elastic import BulkWriter
 from .enrich import Enrich, metadata
 from ..elastic_mapping import Mapping as BaseMapping
 
 
 GITHUB = 'https://github.com/'
+HEADER_JSON = {"Content-Type": "application/json"}
 logger = logging.getLogger(__name__)
 
 
@@ -94,18 +96,37 @@ class GitHubEnrich(Enrich):
 
     roles = ['assignee_data', 'user_data']
 
+    maps_api_url = 'https://maps.googleapis.com/maps/api/geocode/json'
+    location_not_found_days = 30  # days before looking again for a location not found
+
     def __init__(self, db_sortinghat=None, db_projects_map=None, json_projects_map=None,
                  db_user='', db_password='', db_host=''):
         super().__init__(db_sortinghat, db_projects_map, json_projects_map,
                          db_user, db_password, db_host)
         self.users = {}  # cache users
         self.location = {}  # cache users location
-        self.location_not_found = []  # location not found in map api
+        self.geolocations = {}  # geo points of the locations
+        self.location_not_found = set()  # location not found in map api
+        # Locations found or not found during this enrichment
+        self.geolocations_new = set()
+        self.location_not_found_new = set()
 
     def set_elastic(self, elastic):
         self.elastic = elastic
         # Recover cache data from Elastic
-        self.geolocations = self.geo_locationsfrom__es()
+        self.geolocations = {}
+        self.location_not_found = set()
+        now = datetime.utcnow()
+        for location, geolocation in self.geo_locationsfrom__es().items():
+            if geolocation.get('not_found'):
+                # Locations not found expire so they are looked for again
+                days = get_time_diff_days(geolocation.get('not_found_on'), now)
+                if days is not None and days < self.location_not_found_days:
+                    self.location_not_found.add(location)
+            else:
+                self.geolocations[location] = geolocation
+        logger.debug("Geolocations cache: %i found, %i not found",
+                     len(self.geolocations), len(self.location_not_found))
 
     def get_field_author(self):
         return "user_data"
@@ -167,18 +188,23 @@ class GitHubEnrich(Enrich):
             pass
 
         else:
-            url = 'https://maps.googleapis.com/maps/api/geocode/json'
             params = {'sensor': 'false', 'address': location}
-            r = self.requests.get(url, params=params)
+            r = self.requests.get(self.maps_api_url, params=params)
 
+            status = None
             try:
                 logger.debug("Using Maps API to find %s" % (location))
                 r_json = r.json()
+                status = r_json.get('status')
                 geo_code = r_json['results'][0]['geometry']['location']
             except Exception:
-                if location not in self.location_not_found:
+                if status == "ZERO_RESULTS":
                     logger.debug("Can't find geocode for " + location)
-                    self.location_not_found.append(location)
+                    self.location_not_found.add(location)
+                    self.location_not_found_new.add(location)
+                else:
+                    # Quota, auth or network errors: the location is looked for again
+                    logger.warning("Maps API error looking for %s: %s", location, status)
 
             if geo_code:
                 geo_point = {
@@ -186,72 +212,87 @@ class GitHubEnrich(Enrich):
                     "lon": geo_code['lng']
                 }
                 self.geolocations[location] = geo_point
+                self.geolocations_new.add(location)
 
         return geo_point
 
     def get_github_cache(self, kind, key_):
         """ Get cache data for items of _type using key_ as the cache dict key """
 
-        cache = {}
-        res_size = 100  # best size?
-        from_ = 0
+        return {item[key_]: item for item in self.get_github_cache_items(kind)}
 
-        index_github = "github/" + kind
+    def get_github_cache_items(self, kind):
+        """ Get the cache items of _type, reading them with a scroll """
 
-        url = self.elastic.url + "/" + index_github
-        url += "/_search" + "?" + "size=%i" % res_size
-        r = self.requests.get(url)
+        res_size = 1000
+        scroll = "5m"
+
+        url = self.elastic.url + "/github/" + kind + "/_search"
+        url += "?scroll=%s&size=%i" % (scroll, res_size)
+        r = self.requests.post(url, data=json.dumps({"query": {"match_all": {}}}),
+                               headers=HEADER_JSON)
         type_items = r.json()
 
         if 'hits' not in type_items:
             logger.info("No github %s data in ES" % (kind))
+            return
 
-        else:
+        scroll_id = type_items.get('_scroll_id')
+        try:
             while len(type_items['hits']['hits']) > 0:
                 for hit in type_items['hits']['hits']:
-                    item = hit['_source']
-                    cache[item[key_]] = item
-                from_ += res_size
-                r = self.requests.get(url + "&from=%i" % from_)
+                    yield hit['_source']
+                scroll_data = {"scroll": scroll, "scroll_id": scroll_id}
+                r = self.requests.post(self.elastic.url + "/_search/scroll",
+                                       data=json.dumps(scroll_data), headers=HEADER_JSON)
                 type_items = r.json()
                 if 'hits' not in type_items:
                     break
-
-        return cache
+                scroll_id = type_items.get('_scroll_id', scroll_id)
+        finally:
+            if scroll_id:
+                self.clear_scroll(scroll_id)
 
     def geo_locationsfrom__es(self):
-        return self.get_github_cache("geolocations", "location")
+        """ Get the geolocations cache, with the geo point of the locations found
+        after being not found, which have both entries """
+
+        cache = {}
+        for item in self.get_github_cache_items("geolocations"):
+            if item['location'] not in cache or not item.get('not_found'):
+                cache[item['location']] = item
+        return cache
 
     def geo_locations_to_es(self):
-        max_items = self.elastic.max_items_bulk
-        current = 0
-        bulk_json = ""
+        """ Add to the geolocations cache in ES the locations found, or not
+        found, during this enrichment """
 
         url = self.elastic.url + "/github/geolocations/_bulk"
 
-        logger.debug("Adding geoloc to %s (in %i packs)" % (url, max_items))
-
-        for loc in self.geolocations:
-            if current >= max_items:
-                self.requests.put(url, data=bulk_json)
-                bulk_json = ""
-                current = 0
-
-            geopoint = self.geolocations[loc]
-            location = geopoint.copy()
-            location["location"] = loc
-            # First upload the raw issue data to ES
-            data_json = json.dumps(location)
-            # Don't include in URL non ascii codes
-            safe_loc = str(loc.encode('ascii', 'ignore'), 'ascii')
-            geo_id = str("%s-%s-%s" % (location["lat"], location["lon"],
-                                       safe_loc))
-            bulk_json += '{"index" : {"_id" : "%s" } }\n' % (geo_id)
-            bulk_json += data_json + "\n"  # Bulk document
-            current += 1
-
-        self.requests.put(url, data=bulk_json)
-
+        logger.debug("Adding %i geoloc and %i not found to %s", len(self.geolocations_new),
+                     len(self.location_not_found_new), url)
+
+        with BulkWriter(self.elastic, url) as writer:
+            for loc in self.geolocations_new:
+                geopoint = self.geolocations[loc]
+                location = geopoint.copy()
+                location["location"] = loc
+                # Don't include in URL non ascii codes
+                safe_loc = str(loc.encode('ascii', 'ignore'), 'ascii')
+                geo_id = str("%s-%s-%s" % (location["lat"], location["lon"],
+                                           safe_loc))
+                writer.add(geo_id, location)
+            not_found_on = datetime.utcnow().isoformat()
+            for loc in self.location_not_found_new:
+                safe_loc = str(loc.encode('ascii', 'ignore'), 'ascii')
+                writer.add("not_found-%s" % safe_loc, {"location": loc, "not_found": True,
+                                                       "not_found_on": not_found_on})
+
+        self.geolocations_new = set()
+        self.location_not_found_new = set()
+
+        if writer.failed:
+            logger.error("%i/%i geolocations not added to %s", writer.failed, writer.added, url)
         logger.debug("Adding geoloc to ES Done")
 
     def get_project_repository(self, eitem):
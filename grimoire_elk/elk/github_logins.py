@@ -0,0 +1,198 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# GitHub logins of git commit authors: persistent cache and resolver
+#
+# Copyright (C) 2018 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+import json
+import logging
+import os
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+GITHUB_API_URL = "https://api.github.com"
+
+logger = logging.getLogger(__name__)
+
+
+class GitHubLoginsCache(object):
+    """ Cache of the GitHub logins of git users, optionally stored in a file
+
+    The users without login in GitHub are also cached (negative entries).
+    The entries expire after ttl seconds, negative_ttl for negative ones.
+    """
+
+    ttl = 30 * 24 * 3600
+    negative_ttl = 24 * 3600
+    save_every = 100  # Save the file after this number of new entries
+
+    def __init__(self, cache_file=None):
+        self.cache_file = cache_file
+        self.logins = {}  # user -> [login, timestamp]
+        self.lock = threading.Lock()
+        self.pending = 0  # new entries not yet saved
+
+        if self.cache_file and os.path.exists(self.cache_file):
+            with open(self.cache_file) as f:
+                self.logins = json.load(f)
+            logger.debug("Loaded %i GitHub logins from %s", len(self.logins), self.cache_file)
+
+    def __is_valid(self, entry):
+        login, timestamp = entry
+        ttl = self.ttl if login else self.negative_ttl
+        return time.time() - timestamp < ttl
+
+    def __contains__(self, user):
+        entry = self.logins.get(user)
+        return entry is not None and self.__is_valid(entry)
+
+    def __getitem__(self, user):
+        if user not in self:
+            raise KeyError(user)
+        return self.logins[user][0]
+
+    def __setitem__(self, user, login):
+        with self.lock:
+            self.logins[user] = [login, time.time()]
+            self.pending += 1
+        if self.pending >= self.save_every:
+            self.save()
+
+    def __len__(self):
+        return len(self.logins)
+
+    def save(self):
+        """ Write the cache to its file if there are new entries """
+
+        with self.lock:
+            if not self.cache_file or not self.pending:
+                return
+            cache_file_tmp = self.cache_file + '.tmp'
+            with open(cache_file_tmp, 'w') as f:
+                json.dump(self.logins, f)
+            os.replace(cache_file_tmp, self.cache_file)
+            self.pending = 0
+        logger.debug("Saved %i GitHub logins to %s", len(self.logins), self.cache_file)
+
+
+class GitHubLoginsResolver(object):
+    """ Read commits from the GitHub API to find the logins of its users
+
+    The commits are read with up to workers concurrent requests. The rate
+    limit is shared between them: once the remaining requests are below
+    min_rate_to_sleep, the commits are not read (None) until the rate limit
+    reset, so the enrichment doesn't stop. Its logins are not cached, so
+    they are resolved once the rate limit is reset.
+    """
+
+    def __init__(self, session, token, api_url=GITHUB_API_URL, workers=1,
+                 min_rate_to_sleep=100):
+        self.session = session
+        self.headers = {'Authorization': 'token ' + token}
+        self.api_url = api_url
+        self.workers = workers
+        self.min_rate_to_sleep = min_rate_to_sleep
+        self.rate_limit = None
+        self.rate_limit_reset_ts = None
+        self.deferred = 0  # commits not read waiting for the rate limit reset
+        self.lock = threading.Lock()
+
+    def __update_rate_limit(self, response):
+        if 'X-RateLimit-Remaining' not in response.headers:
+            return
+        with self.lock:
+            self.rate_limit = int(response.headers['X-RateLimit-Remaining'])
+            reset_ts = int(response.headers['X-RateLimit-Reset'])
+            if reset_ts != self.rate_limit_reset_ts:
+                self.deferred = 0
+            self.rate_limit_reset_ts = reset_ts
+        logger.debug("Rate limit pending: %s", self.rate_limit)
+
+    def __is_rate_limited(self):
+        """ Check if the requests must wait for the rate limit reset, deferring the commit """
+
+        with self.lock:
+            if self.rate_limit is None or self.rate_limit > self.min_rate_to_sleep:
+                return False
+            seconds_to_reset = self.rate_limit_reset_ts - int(time.time()) + 1
+            if seconds_to_reset <= 0:
+                self.rate_limit = None
+                return False
+            if not self.deferred:
+                logger.info("GitHub rate limit exhausted. Commits not read until the reset in %i secs.",
+                            seconds_to_reset)
+            self.deferred += 1
+            return True
+
+    def get_commit(self, repo, commit_hash):
+        """ Get the JSON of a commit, or None if it can not be read """
+
+        commit_url = self.api_url + "/repos/%s/commits/%s" % (repo, commit_hash)
+
+        if self.__is_rate_limited():
+            return None
+
+        try:
+            r = self.session.get(commit_url, headers=self.headers)
+            self.__update_rate_limit(r)
+            if r.status_code == 403 and self.rate_limit == 0:
+                # Rate limit exhausted: the commit is read again after the reset
+                logger.debug("Commit %s not read until the rate limit reset", commit_url)
+                return None
+            r.raise_for_status()
+        except requests.exceptions.ConnectionError:
+            logger.error("Can't get github login for %s in %s because a connection error ", repo, commit_hash)
+            return None
+        except requests.exceptions.HTTPError as ex:
+            # commit not found probably or rate limit exhausted
+            logger.error("Can't find commit %s %s", commit_url, ex)
+            return None
+
+        return r.json()
+
+    def get_commits(self, commits):
+        """ Get the JSON of a list of (repo, commit hash) commits
+
+        :returns: dict with the JSON, or None, of each commit
+        """
+        commits = list(dict.fromkeys(commits))
+
+        if self.workers <= 1 or len(commits) <= 1:
+            jsons = [self.get_commit(repo, commit_hash) for repo, commit_hash in commits]
+        else:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                jsons = list(executor.map(lambda commit: self.get_commit(*commit), commits))
+
+        return dict(zip(commits, jsons))
+
+    @staticmethod
+    def get_login(commit_json, rol):
+        """ Get the login of the author or committer of a commit JSON """
+
+        if rol not in ['author', 'committer']:
+            logger.error("Wrong rol: %s" % (rol))
+            raise RuntimeError
+        if rol in commit_json and commit_json[rol]:
+            return commit_json[rol]['login']
+        return None
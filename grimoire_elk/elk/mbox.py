@@ -22,7 +22,6 @@
 #   Alvaro del Castillo San Felix <acs@bitergia.com>
 #
 
-import json
 import logging
 
 from dateutil import parser
@@ -31,7 +30,8 @@ import email.utils
 
 from .enrich import Enrich, metadata
 from ..elastic_mapping import Mapping as BaseMapping
-from .mbox_study_kip import kafka_kip, MAX_LINES_FOR_VOTE
+from .mbox_study_kip import kafka_kip, KIP_FILTER, MAX_LINES_FOR_VOTE
+from ..studies import study
 
 
 logger = logging.getLogger(__name__)
@@ -221,38 +221,14 @@ class MBoxEnrich(Enrich):
         return total
 
     def enrich_items_old(self, items):
-        max_items = self.elastic.max_items_bulk
-        current = 0
-        total = 0
-        bulk_json = ""
-
-        url = self.elastic.index_url + '/items/_bulk'
-
-        logger.debug("Adding items to %s (in %i packs)" % (url, max_items))
-
-        for item in items:
-            if current >= max_items:
-                self.requests.put(url, data=bulk_json)
-                bulk_json = ""
-                current = 0
-
+        def get_docs(item):
             rich_item = self.get_rich_item(item)
-            data_json = json.dumps(rich_item)
-            bulk_json += '{"index" : {"_id" : "%s" } }\n' % \
-                (rich_item[self.get_field_unique_id()])
-            bulk_json += data_json + "\n"  # Bulk document
-            current += 1
-            total += 1
-        try:
-            self.requests.put(url, data=bulk_json)
-        except UnicodeEncodeError:
-            # Related to body.encode('iso-8859-1'). mbox data
-            logger.error("Encoding error ... converting bulk to iso-8859-1")
-            bulk_json = bulk_json.encode('iso-8859-1', 'ignore')
-            self.requests.put(url, data=bulk_json)
+            yield rich_item[self.get_field_unique_id()], rich_item
 
-        return total
+        nitems, inserted = self.enrich_docs(items, get_docs)
+
+        return nitems
 
-    def kafka_kip(self, enrich_backend, no_incremental=False):
-        # KIP study is not incremental
-        kafka_kip(self)
+    @study(filters=[KIP_FILTER])
+    def kafka_kip(self, enrich_backend, no_incremental=False, from_date=None):
+        return kafka_kip(self, no_incremental, from_date)
@@ -28,16 +28,43 @@ from datetime import datetime
 
 from dateutil import parser
 
+from .elastic import BulkWriter
 from .utils import get_time_diff_days
+from ..studies import STUDIES_DATE_FIELD
 
 logger = logging.getLogger(__name__)
 
 MAX_LINES_FOR_VOTE = 10
 
+# Only the messages with KIP in its subject can be KIP messages
+KIP_FILTER = {"wildcard": {"Subject": "*KIP*"}}
 
-def kafka_kip(enrich):
+# Fields computed by the study
+KIP_FIELDS = ["kip", "kip_type", "kip_is_vote", "kip_is_discuss", "kip_vote", "kip_binding",
+              "kip_status", "kip_discuss_time_days", "kip_discuss_inactive_days",
+              "kip_voting_time_days", "kip_voting_inactive_days", "kip_is_first_discuss",
+              "kip_is_first_vote", "kip_is_last_discuss", "kip_is_last_vote", "kip_result",
+              "kip_start_end", "kip_final_status"]
 
-    """ Kafka Improvement Proposals process study """
+# Final status of the KIPs which are closed
+KIP_CLOSED_STATUS = ["adopted", "discarded"]
+
+
+def kafka_kip(enrich, no_incremental=False, from_date=None):
+    """ Kafka Improvement Proposals process study
+
+    The messages with a KIP in its subject are read in one scroll, the
+    state of each KIP is built in memory and only the fields of the
+    messages that change are updated.
+
+    Unless no_incremental, only the KIPs with messages enriched since
+    from_date, or not yet processed by the study without it, and the open
+    KIPs, whose inactive days and status change with time, are computed
+    again. The inactive days of the closed KIPs are the ones of the run
+    that computed them.
+
+    :returns: number of messages updated
+    """
 
     def extract_vote_and_binding(body):
         """ Extracts the vote and binding for a KIP process included in message body """
@@ -221,230 +248,243 @@ def kafka_kip(enrich):
 
         return result
 
-    def add_kip_final_status_field(enrich):
-        """ Add kip final status field """
+    def add_kip_fields(eitem):
+        """ Add extra fields needed for kip analysis, collecting the dates and votes of its kip """
 
-        total = 0
-
-        for eitem in enrich.fetch():
-            if "kip" not in eitem:
-                # It is not a KIP message
-                continue
+        kip_fields = {
+            "kip_is_vote": 0,
+            "kip_is_discuss": 0,
+            "kip_vote": 0,
+            "kip_binding": 0,
+            "kip": 0,
+            "kip_type": "general"
+        }
 
-            if eitem['kip'] in enrich.kips_final_status:
-                eitem.update({"kip_final_status":
-                              enrich.kips_final_status[eitem['kip']]})
+        kip = extract_kip(eitem['Subject'])
+        if kip not in kips_dates:
+            kips_dates[kip] = {}
+        if kip not in kips_scores:
+            kips_scores[kip] = []
+
+        kip_date = parser.parse(eitem["email_date"])
+
+        # Analyze the subject to fill the kip fields
+        if '[discuss]' in eitem['Subject'].lower() or \
+           '[kip-discussion]' in eitem['Subject'].lower() or \
+           '[discussion]' in eitem['Subject'].lower():
+            kip_fields['kip_is_discuss'] = 1
+            kip_fields['kip_type'] = "discuss"
+            kip_fields['kip'] = kip
+            # Update kip discuss dates
+            if "kip_min_discuss" not in kips_dates[kip]:
+                kips_dates[kip].update({
+                    "kip_min_discuss": kip_date,
+                    "kip_max_discuss": kip_date
+                })
+            else:
+                if kips_dates[kip]["kip_min_discuss"] >= kip_date:
+                    kips_dates[kip]["kip_min_discuss"] = kip_date
+                if kips_dates[kip]["kip_max_discuss"] <= kip_date:
+                    kips_dates[kip]["kip_max_discuss"] = kip_date
+
+        if '[vote]' in eitem['Subject'].lower():
+            kip_fields['kip_is_vote'] = 1
+            kip_fields['kip_type'] = "vote"
+            kip_fields['kip'] = kip
+            if 'body_extract' in eitem:
+                (vote, binding) = extract_vote_and_binding(eitem['body_extract'])
+                kips_scores[kip] += [(vote, binding)]
+                kip_fields['kip_vote'] = vote
+                kip_fields['kip_binding'] = binding
+            else:
+                logger.debug("Message %s without body", eitem['Subject'])
+            # Update kip discuss dates
+            if "kip_min_vote" not in kips_dates[kip]:
+                kips_dates[kip].update({
+                    "kip_min_vote": kip_date,
+                    "kip_max_vote": kip_date
+                })
             else:
-                logger.warning("No final status for kip: %i", eitem['kip'])
-                eitem.update({"kip_final_status": None})
-            yield eitem
-            total += 1
+                if kips_dates[kip]["kip_min_vote"] >= kip_date:
+                    kips_dates[kip]["kip_min_vote"] = kip_date
+                if kips_dates[kip]["kip_max_vote"] <= kip_date:
+                    kips_dates[kip]["kip_max_vote"] = kip_date
 
-        logger.info("Total eitems with kafka final status kip field %i", total)
+        eitem.update(kip_fields)
 
-    def add_kip_time_status_fields(enrich):
-        """ Add kip fields with final status and times """
+    def add_kip_time_status_fields(eitem):
+        """ Add kip fields with status and times, once the dates and votes of all kips are known """
 
-        total = 0
         max_inactive_days = 90  # days
 
-        enrich.kips_final_status = {}  # final status for each kip
-
-        for eitem in enrich.fetch():
-            # kip_status: adopted (closed), discussion (open), voting (open),
-            #             inactive (open), discarded (closed)
-            # kip_start_end: discuss_start, discuss_end, voting_start, voting_end
-            kip_fields = {
-                "kip_status": None,
-                "kip_discuss_time_days": None,
-                "kip_discuss_inactive_days": None,
-                "kip_voting_time_days": None,
-                "kip_voting_inactive_days": None,
-                "kip_is_first_discuss": 0,
-                "kip_is_first_vote": 0,
-                "kip_is_last_discuss": 0,
-                "kip_is_last_vote": 0,
-                "kip_result": None,
-                "kip_start_end": None
-            }
-
-            if "kip" not in eitem:
-                # It is not a KIP message
-                continue
-            kip = eitem["kip"]
-            kip_date = parser.parse(eitem["email_date"])
-
-            if eitem['kip_is_discuss']:
-                kip_fields["kip_discuss_time_days"] = \
-                    get_time_diff_days(enrich.kips_dates[kip]['kip_min_discuss'],
-                                       enrich.kips_dates[kip]['kip_max_discuss'])
-
-                # Detect first and last discuss messages
-                if kip_date == enrich.kips_dates[kip]['kip_min_discuss']:
-                    kip_fields['kip_is_first_discuss'] = 1
-                    kip_fields['kip_start_end'] = 'discuss_start'
-                elif kip_date == enrich.kips_dates[kip]['kip_max_discuss']:
-                    kip_fields['kip_is_last_discuss'] = 1
-                    kip_fields['kip_start_end'] = 'discuss_end'
-
-                # Detect discussion status
-                if "kip_min_vote" not in enrich.kips_dates[kip]:
-                    kip_fields['kip_status'] = 'discussion'
-                max_discuss_date = enrich.kips_dates[kip]['kip_max_discuss']
-                kip_fields['kip_discuss_inactive_days'] = \
-                    get_time_diff_days(max_discuss_date.replace(tzinfo=None),
-                                       datetime.utcnow())
-
-            if eitem['kip_is_vote']:
-                kip_fields["kip_voting_time_days"] = \
-                    get_time_diff_days(enrich.kips_dates[kip]['kip_min_vote'],
-                                       enrich.kips_dates[kip]['kip_max_vote'])
-
-                # Detect first and last discuss messages
-                if kip_date == enrich.kips_dates[kip]['kip_min_vote']:
-                    kip_fields['kip_is_first_vote'] = 1
-                    kip_fields['kip_start_end'] = 'voting_start'
-                elif kip_date == enrich.kips_dates[kip]['kip_max_vote']:
-                    kip_fields['kip_is_last_vote'] = 1
-                    kip_fields['kip_start_end'] = 'voting_end'
-
-                # Detect discussion status
-                kip_fields['kip_status'] = 'voting'
-                max_vote_date = enrich.kips_dates[kip]['kip_max_vote']
-                kip_fields['kip_voting_inactive_days'] = \
-                    get_time_diff_days(max_vote_date.replace(tzinfo=None),
-                                       datetime.utcnow())
-
-                # Now check if there is a result from enrich.kips_scores
-                kip_fields['kip_result'] = lazy_result(enrich.kips_scores[kip])
-
-                if kip_fields['kip_result'] == 1:
-                    kip_fields['kip_status'] = 'adopted'
-                elif kip_fields['kip_result'] == -1:
-                    kip_fields['kip_status'] = 'discarded'
-
-            # And now change the status inactive
-            if kip_fields['kip_status'] not in ['adopted', 'discarded']:
-                inactive_days = kip_fields['kip_discuss_inactive_days']
-
-                if inactive_days and inactive_days > max_inactive_days:
-                    kip_fields['kip_status'] = 'inactive'
-
-                inactive_days = kip_fields['kip_voting_inactive_days']
-                if inactive_days and inactive_days > max_inactive_days:
-                    kip_fields['kip_status'] = 'inactive'
-
-            # The final status is in the kip_is_last_discuss or kip_is_last_vote
-            # It will be filled in the next enrichment round
-            eitem.update(kip_fields)
-            if eitem['kip'] not in enrich.kips_final_status:
-                enrich.kips_final_status[kip] = None
-            if eitem['kip_is_last_discuss'] and not enrich.kips_final_status[kip]:
-                enrich.kips_final_status[kip] = kip_fields['kip_status']
-            if eitem['kip_is_last_vote']:
-                enrich.kips_final_status[kip] = kip_fields['kip_status']
-
-            yield eitem
-            total += 1
-
-        logger.info("Total eitems with kafka extra kip fields %i", total)
-
-    def add_kip_fields(enrich):
-        """ Add extra fields needed for kip analysis"""
-
-        total = 0
-
-        enrich.kips_dates = {
-            0: {
-                "kip_min_discuss": None,
-                "kip_max_discuss": None,
-                "kip_min_vote": None,
-                "kip_max_vote": None,
-            }
+        # kip_status: adopted (closed), discussion (open), voting (open),
+        #             inactive (open), discarded (closed)
+        # kip_start_end: discuss_start, discuss_end, voting_start, voting_end
+        kip_fields = {
+            "kip_status": None,
+            "kip_discuss_time_days": None,
+            "kip_discuss_inactive_days": None,
+            "kip_voting_time_days": None,
+            "kip_voting_inactive_days": None,
+            "kip_is_first_discuss": 0,
+            "kip_is_first_vote": 0,
+            "kip_is_last_discuss": 0,
+            "kip_is_last_vote": 0,
+            "kip_result": None,
+            "kip_start_end": None
         }
 
-        enrich.kips_scores = {}
-
-        # First iteration
-        for eitem in enrich.fetch():
-            kip_fields = {
-                "kip_is_vote": 0,
-                "kip_is_discuss": 0,
-                "kip_vote": 0,
-                "kip_binding": 0,
-                "kip": 0,
-                "kip_type": "general"
-            }
-
-            kip = extract_kip(eitem['Subject'])
-            if not kip:
-                # It is not a KIP message
-                continue
-            if kip not in enrich.kips_dates:
-                enrich.kips_dates[kip] = {}
-            if kip not in enrich.kips_scores:
-                enrich.kips_scores[kip] = []
-
-            kip_date = parser.parse(eitem["email_date"])
-
-            # Analyze the subject to fill the kip fields
-            if '[discuss]' in eitem['Subject'].lower() or \
-               '[kip-discussion]'in eitem['Subject'].lower() or \
-               '[discussion]'in eitem['Subject'].lower():
-                kip_fields['kip_is_discuss'] = 1
-                kip_fields['kip_type'] = "discuss"
-                kip_fields['kip'] = kip
-                # Update kip discuss dates
-                if "kip_min_discuss" not in enrich.kips_dates[kip]:
-                    enrich.kips_dates[kip].update({
-                        "kip_min_discuss": kip_date,
-                        "kip_max_discuss": kip_date
-                    })
-                else:
-                    if enrich.kips_dates[kip]["kip_min_discuss"] >= kip_date:
-                        enrich.kips_dates[kip]["kip_min_discuss"] = kip_date
-                    if enrich.kips_dates[kip]["kip_max_discuss"] <= kip_date:
-                        enrich.kips_dates[kip]["kip_max_discuss"] = kip_date
-
-            if '[vote]' in eitem['Subject'].lower():
-                kip_fields['kip_is_vote'] = 1
-                kip_fields['kip_type'] = "vote"
-                kip_fields['kip'] = kip
-                if 'body_extract' in eitem:
-                    (vote, binding) = extract_vote_and_binding(eitem['body_extract'])
-                    enrich.kips_scores[kip] += [(vote, binding)]
-                    kip_fields['kip_vote'] = vote
-                    kip_fields['kip_binding'] = binding
-                else:
-                    logger.debug("Message %s without body", eitem['Subject'])
-                # Update kip discuss dates
-                if "kip_min_vote" not in enrich.kips_dates[kip]:
-                    enrich.kips_dates[kip].update({
-                        "kip_min_vote": kip_date,
-                        "kip_max_vote": kip_date
-                    })
-                else:
-                    if enrich.kips_dates[kip]["kip_min_vote"] >= kip_date:
-                        enrich.kips_dates[kip]["kip_min_vote"] = kip_date
-                    if enrich.kips_dates[kip]["kip_max_vote"] <= kip_date:
-                        enrich.kips_dates[kip]["kip_max_vote"] = kip_date
-
-            eitem.update(kip_fields)
-            yield eitem
-            total += 1
-
-        logger.info("Total eitems with kafka kip fields %i", total)
+        kip = eitem["kip"]
+        kip_date = parser.parse(eitem["email_date"])
+
+        if eitem['kip_is_discuss']:
+            kip_fields["kip_discuss_time_days"] = \
+                get_time_diff_days(kips_dates[kip]['kip_min_discuss'],
+                                   kips_dates[kip]['kip_max_discuss'])
+
+            # Detect first and last discuss messages
+            if kip_date == kips_dates[kip]['kip_min_discuss']:
+                kip_fields['kip_is_first_discuss'] = 1
+                kip_fields['kip_start_end'] = 'discuss_start'
+            elif kip_date == kips_dates[kip]['kip_max_discuss']:
+                kip_fields['kip_is_last_discuss'] = 1
+                kip_fields['kip_start_end'] = 'discuss_end'
+
+            # Detect discussion status
+            if "kip_min_vote" not in kips_dates[kip]:
+                kip_fields['kip_status'] = 'discussion'
+            max_discuss_date = kips_dates[kip]['kip_max_discuss']
+            kip_fields['kip_discuss_inactive_days'] = \
+                get_time_diff_days(max_discuss_date.replace(tzinfo=None),
+                                   datetime.utcnow())
+
+        if eitem['kip_is_vote']:
+            kip_fields["kip_voting_time_days"] = \
+                get_time_diff_days(kips_dates[kip]['kip_min_vote'],
+                                   kips_dates[kip]['kip_max_vote'])
+
+            # Detect first and last discuss messages
+            if kip_date == kips_dates[kip]['kip_min_vote']:
+                kip_fields['kip_is_first_vote'] = 1
+                kip_fields['kip_start_end'] = 'voting_start'
+            elif kip_date == kips_dates[kip]['kip_max_vote']:
+                kip_fields['kip_is_last_vote'] = 1
+                kip_fields['kip_start_end'] = 'voting_end'
+
+            # Detect discussion status
+            kip_fields['kip_status'] = 'voting'
+            max_vote_date = kips_dates[kip]['kip_max_vote']
+            kip_fields['kip_voting_inactive_days'] = \
+                get_time_diff_days(max_vote_date.replace(tzinfo=None),
+                                   datetime.utcnow())
+
+            # Now check if there is a result from kips_scores
+            kip_fields['kip_result'] = lazy_result(kips_scores[kip])
+
+            if kip_fields['kip_result'] == 1:
+                kip_fields['kip_status'] = 'adopted'
+            elif kip_fields['kip_result'] == -1:
+                kip_fields['kip_status'] = 'discarded'
+
+        # And now change the status inactive
+        if kip_fields['kip_status'] not in ['adopted', 'discarded']:
+            inactive_days = kip_fields['kip_discuss_inactive_days']
+
+            if inactive_days and inactive_days > max_inactive_days:
+                kip_fields['kip_status'] = 'inactive'
+
+            inactive_days = kip_fields['kip_voting_inactive_days']
+            if inactive_days and inactive_days > max_inactive_days:
+                kip_fields['kip_status'] = 'inactive'
+
+        # The final status is in the kip_is_last_discuss or kip_is_last_vote
+        eitem.update(kip_fields)
+        if kip not in kips_final_status:
+            kips_final_status[kip] = None
+        if eitem['kip_is_last_discuss'] and not kips_final_status[kip]:
+            kips_final_status[kip] = kip_fields['kip_status']
+        if eitem['kip_is_last_vote']:
+            kips_final_status[kip] = kip_fields['kip_status']
+
+    def add_kip_final_status_field(eitem):
+        """ Add kip final status field, once the status of all kips is known """
+
+        if eitem['kip'] in kips_final_status:
+            eitem["kip_final_status"] = kips_final_status[eitem['kip']]
+        else:
+            logger.warning("No final status for kip: %i", eitem['kip'])
+            eitem["kip_final_status"] = None
+
+    def get_kip_messages(query, fields):
+        """ Get the _id and fields of the messages with a KIP in its subject """
+
+        es_query = {"query": query, "_source": fields}
+        for hit in enrich.elastic.scroll_hits(es_query):
+            eitem = hit['_source']
+            if extract_kip(eitem.get('Subject')):
+                yield hit['_id'], eitem
 
     logger.debug("Doing kafka_kip study from %s", enrich.elastic.index_url)
 
-    # First iteration with the basic fields
-    eitems = add_kip_fields(enrich)
-    enrich.elastic.bulk_upload_sync(eitems, enrich.get_field_unique_id())
-
-    # Second iteration with the final time and status fields
-    eitems = add_kip_time_status_fields(enrich)
-    enrich.elastic.bulk_upload_sync(eitems, enrich.get_field_unique_id())
-
-    # Third iteration to compute the end status field for all KIPs
-    eitems = add_kip_final_status_field(enrich)
-    enrich.elastic.bulk_upload_sync(eitems, enrich.get_field_unique_id())
+    query = {"bool": {"filter": [KIP_FILTER]}}
+
+    if not no_incremental:
+        if from_date:
+            new_messages = {"range": {STUDIES_DATE_FIELD: {"gte": from_date}}}
+        else:
+            # Messages not already processed by the study, without the kip fields
+            new_messages = {"bool": {"must_not": {"exists": {"field": "kip_type"}}}}
+        kips = set()
+        for _, eitem in get_kip_messages({"bool": {"filter": [KIP_FILTER, new_messages]}}, ['Subject']):
+            kips.add(extract_kip(eitem['Subject']))
+        logger.info("KIPs with new messages: %i", len(kips))
+        # Discuss and vote messages already processed whose KIP is still open.
+        # The general messages (kip 0) don't have the final status of a KIP.
+        open_messages = {"bool": {"filter": [{"range": {"kip": {"gt": 0}}}],
+                                  "must_not": {"terms": {"kip_final_status": KIP_CLOSED_STATUS}}}}
+        open_kips = set()
+        for _, eitem in get_kip_messages({"bool": {"filter": [KIP_FILTER, open_messages]}}, ['Subject', 'kip']):
+            open_kips.add(eitem['kip'])
+        logger.info("Open KIPs: %i", len(open_kips))
+        kips |= open_kips
+        if not kips:
+            logger.info("No new KIP messages nor open KIPs in %s", enrich.elastic.index_url)
+            return 0
+        # All the messages of these KIPs must be computed again
+        query["bool"]["filter"].append({"bool": {"should": [{"terms": {"kip": sorted(kips)}},
+                                                            new_messages]}})
+
+    kips_dates = {
+        0: {
+            "kip_min_discuss": None,
+            "kip_max_discuss": None,
+            "kip_min_vote": None,
+            "kip_max_vote": None,
+        }
+    }
+    kips_scores = {}
+    kips_final_status = {}  # final status for each kip
+
+    # Only the fields needed and the ones computed are read
+    messages = []
+    for doc_id, eitem in get_kip_messages(query, ['Subject', 'email_date', 'body_extract'] + KIP_FIELDS):
+        current = {field: eitem.get(field) for field in KIP_FIELDS}
+        add_kip_fields(eitem)
+        eitem.pop('body_extract', None)
+        messages.append((doc_id, eitem, current))
+
+    for doc_id, eitem, current in messages:
+        add_kip_time_status_fields(eitem)
+
+    total = 0
+    with BulkWriter(enrich.elastic) as writer:
+        for doc_id, eitem, current in messages:
+            add_kip_final_status_field(eitem)
+            changed = {field: eitem[field] for field in KIP_FIELDS if eitem[field] != current[field]}
+            if changed:
+                writer.update(doc_id, changed)
+                total += 1
+
+    logger.info("Total kafka kip messages %i, updated %i", len(messages), total)
+
+    return total
@@ -22,7 +22,6 @@
 #   Alvaro del Castillo San Felix <acs@bitergia.com>
 #
 
-import json
 import logging
 
 from dateutil import parser
@@ -231,32 +230,14 @@ class MediaWikiEnrich(Enrich):
         else:
             super(MediaWikiEnrich, self).enrich_items(items)
 
+    def get_rich_item_reviews_docs(self, item):
+        """ Get the (id, rich review) pairs of the revisions of the raw item """
+
+        for enrich_review in self.get_rich_item_reviews(item):
+            yield enrich_review[self.get_field_unique_id_review()], enrich_review
+
     def enrich_events(self, ocean_backend):
-        max_items = self.elastic.max_items_bulk
-        current = 0
-        bulk_json = ""
-        total = 0
-        nitems = 0
-
-        url = self.elastic.index_url + '/items/_bulk'
-
-        logger.debug("Adding items to %s (in %i packs)" % (url, max_items))
-
-        items = ocean_backend.fetch()
-        for item in items:
-            nitems += 1
-            rich_item_reviews = self.get_rich_item_reviews(item)
-            for enrich_review in rich_item_reviews:
-                if current >= max_items:
-                    self.requests.put(url, data=bulk_json)
-                    bulk_json = ""
-                    current = 0
-                data_json = json.dumps(enrich_review)
-                bulk_json += '{"index" : {"_id" : "%s" } }\n' % \
-                    (enrich_review[self.get_field_unique_id_review()])
-                bulk_json += data_json + "\n"  # Bulk document
-                current += 1
-                total += 1
-        self.requests.put(url, data=bulk_json)
+        nitems, inserted = self.enrich_docs(ocean_backend.fetch(),
+                                            self.get_rich_item_reviews_docs, "reviews")
 
         return nitems
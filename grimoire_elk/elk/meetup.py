@@ -356,39 +356,18 @@ class MeetupEnrich(Enrich):
         return "id"
 
     def enrich_items(self, ocean_backend):
-        items = ocean_backend.fetch()
-
-        super(MeetupEnrich, self).enrich_items(ocean_backend)
-
-        # And now for each item we want also the rsvps and comments items
-        items = ocean_backend.fetch()
-        ncom = 0
-        nrsvps = 0
-        nitems = 0
-        rich_item_comments = []
-        rich_item_rsvps = []
-
-        for item in items:
-            nitems += 1
-            rich_item_comments += self.get_rich_item_comments(item)
-            rich_item_rsvps += self.get_rich_item_rsvps(item)
-
-        if rich_item_comments:
-            ncom += self.elastic.bulk_upload(rich_item_comments,
-                                             self.get_field_unique_id_comment())
-
-            if ncom != len(rich_item_comments):
-                missing = len(rich_item_comments) - ncom
-                logger.error("%s/%s missing comments for Meetup",
-                             str(missing), str(len(rich_item_comments)))
-
-        if rich_item_rsvps:
-            nrsvps += self.elastic.bulk_upload(rich_item_rsvps,
-                                               self.get_field_unique_id_rsvps())
-
-            if nrsvps != len(rich_item_rsvps):
-                missing = len(rich_item_rsvps) - nrsvps
-                logger.error("%s/%s missing rsvps for Meetup",
-                             str(missing), str(len(rich_item_rsvps)))
-
-        return nitems
+        # The events, with its rsvps and comments, in one pass
+        def get_events(item):
+            return [(item[self.get_field_unique_id()], self.get_rich_item(item))]
+
+        def get_comments(item):
+            return [(comment[self.get_field_unique_id_comment()], comment)
+                    for comment in self.get_rich_item_comments(item)]
+
+        def get_rsvps(item):
+            return [(rsvp[self.get_field_unique_id_rsvps()], rsvp)
+                    for rsvp in self.get_rich_item_rsvps(item)]
+
+        outputs = [("events", get_events), ("comments", get_comments), ("rsvps", get_rsvps)]
+
+        return self.enrich_items_multi(ocean_backend, outputs)
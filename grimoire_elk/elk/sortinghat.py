@@ -24,11 +24,14 @@
 #
 
 from datetime import datetime
+import itertools
 import logging
 import traceback
 
-from sortinghat import api
-from sortinghat.db.model import Identity
+from sqlalchemy import func
+
+from sortinghat import api, utils
+from sortinghat.db.model import Enrollment, Identity, Organization, Profile, UniqueIdentity
 from sortinghat.exceptions import AlreadyExistsError, WrappedValueError
 
 
@@ -37,6 +40,8 @@ logger = logging.getLogger(__name__)
 
 class SortingHat(object):
 
+    bulk_size = 1000  # Max number of identities loaded in a transaction
+
     @classmethod
     def get_uuid_from_id(cls, db, sh_id):
         uuid = None
@@ -49,6 +54,63 @@ class SortingHat(object):
                 uuid = identities[0].uuid
         return uuid
 
+    @classmethod
+    def get_uuids_from_ids(cls, db, sh_ids):
+        """ Get the uuids for a list of SH identity ids in one query
+
+        :returns: dict with the uuid of each id found
+        """
+        uuids = {}
+
+        if not sh_ids:
+            return uuids
+
+        with db.connect() as session:
+            query = session.query(Identity.id, Identity.uuid).\
+                filter(Identity.id.in_(sh_ids))
+            for sh_id, uuid in query.all():
+                uuids[sh_id] = uuid
+        return uuids
+
+    @classmethod
+    def get_profiles(cls, db, uuids):
+        """ Get the profiles for a list of uuids in one query
+
+        :returns: dict with name, email and is_bot of each uuid with profile
+        """
+        profiles = {}
+
+        if not uuids:
+            return profiles
+
+        with db.connect() as session:
+            query = session.query(Profile.uuid, Profile.name, Profile.email, Profile.is_bot).\
+                filter(Profile.uuid.in_(uuids))
+            for uuid, name, email, is_bot in query.all():
+                profiles[uuid] = {"name": name, "email": email, "is_bot": is_bot}
+        return profiles
+
+    @classmethod
+    def get_enrollments(cls, db, uuids):
+        """ Get the enrollments for a list of uuids in one query
+
+        :returns: dict with the list of (start, end, organization name) of
+                  each uuid, in the same order than api.enrollments
+        """
+        enrollments = {}
+
+        if not uuids:
+            return enrollments
+
+        with db.connect() as session:
+            query = session.query(Enrollment.uuid, Enrollment.start, Enrollment.end, Organization.name).\
+                join(Organization, Enrollment.organization_id == Organization.id).\
+                filter(Enrollment.uuid.in_(uuids)).\
+                order_by(Enrollment.uuid, Organization.name, Enrollment.start, Enrollment.end)
+            for uuid, start, end, name in query.all():
+                enrollments.setdefault(uuid, []).append((start, end, name))
+        return enrollments
+
     @classmethod
     def get_github_commit_username(cls, db, identity, source):
         user = None
@@ -108,14 +170,125 @@ class SortingHat(object):
 
     @classmethod
     def add_identities(cls, db, identities, backend):
-        """ Load identities list from backend in Sorting Hat """
+        """ Load identities list from backend in Sorting Hat
+
+        The identities are loaded in chunks of bulk_size. For each chunk the
+        existing ids are read in one query and only the new identities,
+        profiles and enrollments are inserted, all in one transaction.
+        """
 
         logger.info("Adding the identities to SortingHat")
 
         total = 0
 
-        for identity in identities:
-            cls.add_identity(db, identity, backend)
-            total += 1
+        identities = iter(identities)
+        while True:
+            chunk = list(itertools.islice(identities, cls.bulk_size))
+            if not chunk:
+                break
+            try:
+                cls.add_identities_chunk(db, chunk, backend)
+            except Exception as ex:
+                logger.warning("Can not load %i identities in bulk (%s). Adding them one by one.",
+                               len(chunk), ex)
+                for identity in chunk:
+                    cls.add_identity(db, identity, backend)
+            total += len(chunk)
 
         logger.info("Total identities added to SH: %i", total)
+
+        return total
+
+    @classmethod
+    def add_identities_chunk(cls, db, identities, backend):
+        """ Add a list of identities to Sorting Hat in one transaction
+
+        :returns: number of new identities
+        """
+        chunk = {}
+        chunk_companies = {}
+        for identity in identities:
+            try:
+                sh_id = utils.uuid(backend, email=identity['email'],
+                                   name=identity['name'], username=identity['username'])
+            except ValueError:
+                logger.warning("Trying to add a None identity. Ignoring it.")
+                continue
+            chunk.setdefault(sh_id, identity)
+            if identity.get('company'):
+                sh_companies = chunk_companies.setdefault(sh_id, [])
+                if identity['company'] not in sh_companies:
+                    sh_companies.append(identity['company'])
+
+        if not chunk:
+            return 0
+
+        with db.connect() as session:
+            uuids = {}
+            query = session.query(Identity.id, Identity.uuid).\
+                filter(Identity.id.in_(list(chunk)))
+            for sh_id, uuid in query.all():
+                uuids[sh_id] = uuid
+            # An unique identity with the id of the identity is also
+            # considered already added, as api.add_identity does
+            query = session.query(UniqueIdentity.uuid).\
+                filter(UniqueIdentity.uuid.in_([sh_id for sh_id in chunk if sh_id not in uuids]))
+            for uuid, in query.all():
+                uuids[uuid] = uuid
+
+            last_modified = datetime.utcnow()
+            new_ids = [sh_id for sh_id in chunk if sh_id not in uuids]
+            for sh_id in new_ids:
+                identity = chunk[sh_id]
+                uidentity = UniqueIdentity(uuid=sh_id)
+                uidentity.last_modified = last_modified
+                session.add(uidentity)
+                new_identity = Identity(id=sh_id, uuid=sh_id, name=identity['name'],
+                                        email=identity['email'], username=identity['username'],
+                                        source=backend)
+                new_identity.last_modified = last_modified
+                session.add(new_identity)
+                profile_name = identity['name'] if identity['name'] else identity['username']
+                session.add(Profile(uuid=sh_id, name=profile_name if profile_name else None,
+                                    email=identity['email'] if identity['email'] else None))
+                uuids[sh_id] = sh_id
+            session.flush()
+
+            companies = {}  # uuids of each company, in the order of the identities
+            for sh_id, names in chunk_companies.items():
+                for name in names:
+                    companies.setdefault(name, []).append(uuids[sh_id])
+            if companies:
+                cls.__add_organizations(session, companies, last_modified)
+
+        logger.debug("Added %i new identities of %i to SH", len(new_ids), len(chunk))
+
+        return len(new_ids)
+
+    @classmethod
+    def __add_organizations(cls, session, companies, last_modified):
+        """ Add the new companies, enrolling the first of its uuids for the whole period
+
+        As in add_identity, where api.add_organization fails for the
+        existing organizations, no one is enrolled in the companies that
+        already exist.
+        """
+
+        # Organization names are case insensitive in SortingHat
+        query = session.query(func.lower(Organization.name)).\
+            filter(func.lower(Organization.name).in_([name.lower() for name in companies]))
+        existing = set(name for name, in query.all())
+
+        for name, org_uuids in companies.items():
+            if name.lower() in existing:
+                continue
+            existing.add(name.lower())
+            org = Organization(name=name)
+            session.add(org)
+            session.flush()
+            uuid = org_uuids[0]
+            session.add(Enrollment(uuid=uuid, organization_id=org.id,
+                                   start=api.MIN_PERIOD_DATE, end=api.MAX_PERIOD_DATE))
+            session.query(UniqueIdentity).filter(UniqueIdentity.uuid == uuid).\
+                update({UniqueIdentity.last_modified: last_modified},
+                       synchronize_session=False)
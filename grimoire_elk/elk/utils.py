@@ -24,9 +24,11 @@
 #
 
 import datetime
+import functools
 import inspect
 import json
 import logging
+import re
 
 import requests
 
@@ -83,6 +85,90 @@ def get_repository_filter(perceval_backend, perceval_backend_name,
     return filter_
 
 
+# Strings parsed with the fast path of parse_date, the formats used by Perceval
+ISO_DATE_PATTERN = re.compile(r"^(\d{4})-(\d{2})-(\d{2})"
+                              r"(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:\.(\d{1,6}))?)?"
+                              r"\s?(Z|[+-]\d{2}(?::?\d{2})?)?)?$")
+RFC_DATE_PATTERN = re.compile(r"^(?:(?:Mon|Tue|Wed|Thu|Fri|Sat|Sun),?\s+)?"
+                              r"(\d{1,2})\s+([A-Z][a-z]{2})\s+(\d{4})\s+"
+                              r"(\d{2}):(\d{2})(?::(\d{2}))?\s+([+-]\d{4})$")
+GIT_DATE_PATTERN = re.compile(r"^(?:Mon|Tue|Wed|Thu|Fri|Sat|Sun)\s+([A-Z][a-z]{2})\s+(\d{1,2})\s+"
+                              r"(\d{2}):(\d{2}):(\d{2})\s+(\d{4})\s+([+-]\d{4})$")
+MONTHS = {month: number for number, month in
+          enumerate(["Jan", "Feb", "Mar", "Apr", "May", "Jun",
+                     "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"], 1)}
+DATES_CACHE_SIZE = 10000
+
+
+def _parse_tz(offset):
+    """ Convert a Z, +HH, +HHMM or +HH:MM offset to a dateutil tzinfo """
+
+    if offset is None:
+        return None
+    if offset == 'Z':
+        return tz.tzutc()
+    offset = offset.replace(':', '')
+    seconds = int(offset[1:3]) * 3600 + int(offset[3:5] or 0) * 60
+    if seconds == 0:
+        return tz.tzutc()
+    return tz.tzoffset(None, -seconds if offset[0] == '-' else seconds)
+
+
+def _parse_date_fast(date):
+    """ Parse the ISO-8601 and RFC-2822 dates emitted by Perceval
+
+    :returns: the datetime or None if the format is not a known one
+    """
+    match = ISO_DATE_PATTERN.match(date)
+    if match:
+        year, month, day, hour, minute, second, fraction, offset = match.groups()
+        microsecond = int(fraction.ljust(6, '0')) if fraction else 0
+        return datetime.datetime(int(year), int(month), int(day),
+                                 int(hour or 0), int(minute or 0), int(second or 0),
+                                 microsecond, _parse_tz(offset))
+
+    match = RFC_DATE_PATTERN.match(date)
+    if match:
+        day, month, year, hour, minute, second, offset = match.groups()
+    else:
+        match = GIT_DATE_PATTERN.match(date)
+        if not match:
+            return None
+        month, day, hour, minute, second, year, offset = match.groups()
+    if month not in MONTHS:
+        return None
+    return datetime.datetime(int(year), MONTHS[month], int(day),
+                             int(hour), int(minute), int(second or 0),
+                             0, _parse_tz(offset))
+
+
+@functools.lru_cache(maxsize=DATES_CACHE_SIZE)
+def _parse_date_cache(date):
+    parsed = None
+    try:
+        parsed = _parse_date_fast(date)
+    except ValueError:
+        # Out of range values: let dateutil report them
+        pass
+    if parsed is None:
+        parsed = parser.parse(date)
+    return parsed
+
+
+def parse_date(date):
+    """ Parse a date string with the same result than dateutil parser.parse
+
+    The ISO-8601 and RFC-2822 formats used by Perceval are parsed directly
+    and the rest with dateutil. The last parsed strings are memoized.
+
+    :param date: string with the date
+    :returns: a datetime object
+    """
+    if not isinstance(date, str):
+        return parser.parse(date)
+    return _parse_date_cache(date)
+
+
 def get_time_diff_days(start, end):
     ''' Number of days between two dates in UTC format  '''
 
@@ -90,9 +176,9 @@ def get_time_diff_days(start, end):
         return None
 
     if type(start) is not datetime.datetime:
-        start = parser.parse(start).replace(tzinfo=None)
+        start = parse_date(start).replace(tzinfo=None)
     if type(end) is not datetime.datetime:
-        end = parser.parse(end).replace(tzinfo=None)
+        end = parse_date(end).replace(tzinfo=None)
 
     seconds_day = float(60 * 60 * 24)
     diff_days = (end - start).total_seconds() / seconds_day
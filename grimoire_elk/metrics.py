@@ -0,0 +1,167 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Metrics of the stages of the raw and enriched indexing
+#
+# Copyright (C) 2018 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+import json
+import logging
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+
+logger = logging.getLogger(__name__)
+
+METRICS_PREFIX = 'gelk_'
+
+# Buckets in seconds of the latency histograms
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0, 30.0, 60.0, 300.0, float('inf'))
+
+
+class Metrics(object):
+    """ Counters and latency histograms of the stages of a run
+
+    Each metric has a name and optional labels (backend, stage ...).
+    They can be exported as JSON or in the Prometheus text format, to
+    be read by the node exporter textfile collector.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [bucket counts, sum, count]
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def __key(name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def reset(self):
+        """ Remove all the metrics """
+
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        """ Add value to the counter name """
+
+        key = self.__key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """ Add a value, a latency in seconds, to the histogram name """
+
+        key = self.__key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            histogram = self.histograms[key]
+            for i, bucket in enumerate(self.buckets):
+                if value <= bucket:
+                    histogram[0][i] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextmanager
+    def time(self, name, **labels):
+        """ Observe in the histogram name the seconds of a block """
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def to_json(self):
+        """ Get the metrics as a JSON serializable dict """
+
+        with self.lock:
+            counters = [{"name": name, "labels": dict(labels), "value": value}
+                        for (name, labels), value in sorted(self.counters.items())]
+            histograms = []
+            for (name, labels), (counts, total, count) in sorted(self.histograms.items()):
+                buckets = {str(bucket): bucket_count for bucket, bucket_count in zip(self.buckets, counts)}
+                histograms.append({"name": name, "labels": dict(labels), "buckets": buckets,
+                                   "sum": total, "count": count})
+
+        return {"counters": counters, "histograms": histograms}
+
+    @staticmethod
+    def __labels(labels, extra=()):
+        labels = list(labels) + list(extra)
+        if not labels:
+            return ''
+        values = ['%s="%s"' % (label, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                  for label, value in labels]
+        return '{' + ','.join(values) + '}'
+
+    def to_prometheus(self):
+        """ Get the metrics in the Prometheus text exposition format """
+
+        lines = []
+        with self.lock:
+            types_done = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                name = METRICS_PREFIX + name
+                if name not in types_done:
+                    lines.append("# TYPE %s counter" % name)
+                    types_done.add(name)
+                lines.append("%s%s %s" % (name, self.__labels(labels), value))
+
+            for (name, labels), (counts, total, count) in sorted(self.histograms.items()):
+                name = METRICS_PREFIX + name
+                if name not in types_done:
+                    lines.append("# TYPE %s histogram" % name)
+                    types_done.add(name)
+                cumulative = 0
+                for bucket, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    le = '+Inf' if bucket == float('inf') else repr(bucket)
+                    lines.append("%s_bucket%s %i" % (name, self.__labels(labels, [('le', le)]), cumulative))
+                lines.append("%s_sum%s %s" % (name, self.__labels(labels), total))
+                lines.append("%s_count%s %i" % (name, self.__labels(labels), count))
+
+        return "\n".join(lines) + "\n"
+
+    def save(self, metrics_file):
+        """ Write the metrics to a file, JSON if its extension is .json
+        and in Prometheus text format otherwise """
+
+        if metrics_file.endswith('.json'):
+            data = json.dumps(self.to_json(), indent=4, sort_keys=True)
+        else:
+            data = self.to_prometheus()
+
+        # Readers of the file must not find it half written
+        metrics_file_tmp = metrics_file + '.tmp'
+        with open(metrics_file_tmp, 'w') as f:
+            f.write(data)
+        os.replace(metrics_file_tmp, metrics_file)
+
+        logger.info("Metrics saved to %s", metrics_file)
+
+
+metrics = Metrics()  # Metrics of the current run
@@ -33,6 +33,7 @@ from datetime import datetime
 from ..elk.utils import unixtime_to_datetime, get_repository_filter
 from ..elastic_items import ElasticItems
 from ..elastic_mapping import Mapping
+from ..metrics import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -131,16 +132,17 @@ class ElasticOcean(ElasticItems):
         item['metadata__timestamp'] = timestamp.isoformat()
 
     def feed(self, from_date=None, from_offset=None, category=None, latest_items=None, arthur_items=None):
-        """ Feed data in Elastic from Perceval or Arthur """
+        """ Feed data in Elastic from Perceval or Arthur
+
+        :returns: list of the items that couldn't be stored in Elastic
+        """
 
         if self.fetch_cache:
             items = self.perceval_backend.fetch_from_cache()
-            self.feed_items(items)
-            return
+            return self.feed_items(items)
         elif arthur_items:
             items = arthur_items
-            self.feed_items(items)
-            return
+            return self.feed_items(items)
 
         if from_date and from_offset:
             raise RuntimeError("Can't not feed using from_date and from_offset.")
@@ -201,12 +203,17 @@ class ElasticOcean(ElasticItems):
             else:
                 items = self.perceval_backend.fetch()
 
-        self.feed_items(items)
+        return self.feed_items(items)
 
     def feed_items(self, items):
+        """ Store the items in Elastic
+
+        :returns: list of the items that couldn't be stored
+        """
         task_init = datetime.now()
 
         items_pack = []  # to feed item in packs
+        failed = []  # items not stored
         drop = 0
         added = 0
 
@@ -218,25 +225,33 @@ class ElasticOcean(ElasticItems):
             if self.project:
                 item['project'] = self.project
             if len(items_pack) >= self.elastic.max_items_bulk:
-                self._items_to_es(items_pack)
+                self._items_to_es(items_pack, failed)
                 items_pack = []
             if not self.drop_item(item):
                 items_pack.append(item)
                 added += 1
             else:
                 drop += 1
-        self._items_to_es(items_pack)
+        self._items_to_es(items_pack, failed)
 
         total_time_min = (datetime.now() - task_init).total_seconds() / 60
 
+        backend_name = self.get_connector_name()
+        metrics.inc('ocean_items_total', added, backend=backend_name)
+        metrics.inc('ocean_items_dropped_total', drop, backend=backend_name)
+        metrics.observe('stage_seconds', total_time_min * 60, stage="feed_items", backend=backend_name)
+
         logger.debug("Added %i items to ocean", added)
         logger.debug("Dropped %i items using drop_item filter" % (drop))
         logger.info("Finished in %.2f min" % (total_time_min))
 
-        return self
+        return failed
+
+    def _items_to_es(self, json_items, failed=None):
+        """ Append items JSON to ES (data source state)
 
-    def _items_to_es(self, json_items):
-        """ Append items JSON to ES (data source state) """
+        :param failed: list to which the items that couldn't be stored are appended
+        """
 
         if len(json_items) == 0:
             return
@@ -246,7 +261,12 @@ class ElasticOcean(ElasticItems):
 
         field_id = self.get_field_unique_id()
 
-        inserted = self.elastic.bulk_upload_sync(json_items, field_id)
+        failed_ids = []
+        inserted = self.elastic.bulk_upload_sync(json_items, field_id, failed_ids=failed_ids)
+
+        if failed is not None and failed_ids:
+            failed_ids = set(failed_ids)
+            failed.extend(item for item in json_items if str(item[field_id]) in failed_ids)
 
         if len(json_items) != inserted:
             missing = len(json_items) - inserted
@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Runner of the studies of the enriched indexes
+#
+# Copyright (C) 2018 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+import json
+import logging
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from time import time
+
+from dateutil import parser
+
+from .metrics import metrics
+
+
+logger = logging.getLogger(__name__)
+
+STUDIES_INDEX = "gelk_studies"  # index with the checkpoints of the studies
+STUDIES_DATE_FIELD = "metadata__enriched_on"  # date of the new enriched items
+
+HEADER_JSON = {"Content-Type": "application/json"}
+
+
+def study(date_field=STUDIES_DATE_FIELD, filters=None):
+    """ Declare the inputs of a study: the enriched items matching the
+    ES filters, which are new if its date_field is after the checkpoint.
+
+    The study is called with the from_date of the items not yet processed,
+    None if all of them must be processed, and returns the number of items
+    processed.
+    """
+    def decorator(func):
+        func.study_date_field = date_field
+        func.study_filters = filters if filters else []
+        return func
+    return decorator
+
+
+class StudyCheckpoints(object):
+    """ Checkpoints of the studies of an enriched index
+
+    The checkpoint of a study is the last date of its input items when it
+    was last run. They are stored in the index STUDIES_INDEX, one document
+    for each enriched index and study.
+    """
+
+    def __init__(self, elastic, index=STUDIES_INDEX):
+        self.elastic = elastic
+        self.url = elastic.url + '/' + index + '/items/'
+
+    def __doc_id(self, study_name):
+        return self.elastic.index + '_' + study_name
+
+    def get(self, study_name):
+        """ Get the checkpoint of a study, None if it has never run """
+
+        res = self.elastic.requests.get(self.url + self.__doc_id(study_name))
+        if res.status_code == 404:
+            return None
+        res.raise_for_status()
+
+        return res.json()['_source']['checkpoint']
+
+    def set(self, study_name, checkpoint, processed, seconds):
+        """ Store the checkpoint of a study with the stats of its run """
+
+        doc = {
+            "index": self.elastic.index,
+            "study": study_name,
+            "checkpoint": checkpoint,
+            "processed": processed,
+            "seconds": seconds,
+            "updated_on": datetime.utcnow().isoformat()
+        }
+        res = self.elastic.requests.put(self.url + self.__doc_id(study_name),
+                                        data=json.dumps(doc), headers=HEADER_JSON)
+        res.raise_for_status()
+
+    def get_last_date(self, date_field, filters):
+        """ Get the last date of the items of the enriched index matching filters """
+
+        query = {
+            "size": 0,
+            "query": {"bool": {"filter": filters}},
+            "aggs": {"last_date": {"max": {"field": date_field}}}
+        }
+        res = self.elastic.requests.post(self.elastic.index_url + "/_search",
+                                         data=json.dumps(query), headers=HEADER_JSON)
+        res.raise_for_status()
+
+        last_date = res.json()['aggregations']['last_date']
+        if last_date.get('value') is None:
+            return None
+
+        return last_date['value_as_string']
+
+
+def run_study(enrich_backend, study_func, checkpoints, no_incremental=False):
+    """ Run a study, only for the new items if it has a checkpoint
+
+    :returns: number of items processed, None if the study failed
+    """
+
+    study_name = study_func.__name__
+    backend_name = enrich_backend.get_connector_name()
+
+    try:
+        last_date = None
+        kwargs = {}
+        if hasattr(study_func, 'study_date_field'):
+            last_date = checkpoints.get_last_date(study_func.study_date_field,
+                                                  study_func.study_filters)
+            from_date = None if no_incremental else checkpoints.get(study_name)
+            if from_date and (not last_date or parser.parse(last_date) <= parser.parse(from_date)):
+                logger.info("Study %s of %s: no new items since %s", study_name,
+                            enrich_backend.elastic.index_url, from_date)
+                return 0
+            kwargs['from_date'] = from_date
+
+        logger.info("Starting study: %s (no_incremental %s, from %s)", study_name,
+                    no_incremental, kwargs.get('from_date'))
+        start = time()
+        with metrics.time('stage_seconds', stage="study", backend=backend_name, study=study_name):
+            processed = study_func(enrich_backend, no_incremental, **kwargs)
+        seconds = time() - start
+        processed = processed if processed else 0
+
+        metrics.inc('study_items_total', processed, backend=backend_name, study=study_name)
+        logger.info("Study %s of %s: %i items processed in %.2f s", study_name,
+                    enrich_backend.elastic.index_url, processed, seconds)
+
+        if last_date:
+            checkpoints.set(study_name, last_date, processed, seconds)
+    except Exception:
+        logger.error("Problem executing study %s: %s", study_name, traceback.format_exc())
+        metrics.inc('study_errors_total', backend=backend_name, study=study_name)
+        return None
+
+    return processed
+
+
+def run_studies(enrich_backend, no_incremental=False):
+    """ Run the studies of an enriched backend
+
+    The studies must be independent: up to enrich_backend.studies_workers
+    of them run concurrently, each one with its own scroll and bulk
+    writer. A study failing doesn't stop the other ones, and its
+    checkpoint is not updated so its items are processed again the
+    next time.
+
+    :returns: dict with the items processed by each study, None if it failed
+    """
+
+    checkpoints = StudyCheckpoints(enrich_backend.elastic)
+
+    def run(study_func):
+        return run_study(enrich_backend, study_func, checkpoints, no_incremental)
+
+    studies = enrich_backend.studies
+    workers = min(enrich_backend.studies_workers, len(studies))
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(run, studies))
+    else:
+        results = [run(study_func) for study_func in studies]
+
+    return {study_func.__name__: processed for study_func, processed in zip(studies, results)}
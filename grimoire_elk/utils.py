@@ -318,6 +318,12 @@ def get_params_parser():
                         help="Filter raw items with prefix filter. Format: field:value field:value ...")
     parser.add_argument("--events-enrich", dest='events_enrich', action='store_true',
                         help="Enrich events in items")
+    parser.add_argument("--enrich-slices", dest='enrich_slices', default=1, type=int,
+                        help="Enrich the raw items in slices, each one in its own process")
+    parser.add_argument("--enrich-workers", dest='enrich_workers', default=1, type=int,
+                        help="Number of processes to compute the enriched items")
+    parser.add_argument("--enrich-async", dest='enrich_async', action='store_true',
+                        help="Read raw items and write enriched items with asyncio (needs Python 3.6 and aiohttp)")
     parser.add_argument('--index', help="Ocean index name")
     parser.add_argument('--index-enrich', dest="index_enrich", help="Ocean enriched index name")
     parser.add_argument('--db-user', help="User for db connection (default to root)",
@@ -336,14 +342,30 @@ def get_params_parser():
     parser.add_argument('--author_id', nargs='*', help="Field author_ids to be refreshed")
     parser.add_argument('--author_uuid', nargs='*', help="Field author_uuids to be refreshed")
     parser.add_argument('--github-token', help="If provided, github usernames will be retrieved in git enrich.")
+    parser.add_argument('--github-logins-cache', dest='github_logins_cache',
+                        help="JSON file to keep the github usernames between git enrich executions.")
+    parser.add_argument('--github-workers', dest='github_workers', default=1, type=int,
+                        help="Number of concurrent requests to GitHub API in git enrich.")
     parser.add_argument('--jenkins-rename-file', help="CSV mapping file with nodes renamed schema.")
     parser.add_argument('--studies', action='store_true', help="Execute studies after enrichment.")
     parser.add_argument('--only-studies', action='store_true', help="Execute only studies.")
+    parser.add_argument('--studies-workers', dest='studies_workers', default=1, type=int,
+                        help="Number of studies to execute concurrently.")
     parser.add_argument('--bulk-size', default=1000, type=int,
                         help="Number of items per bulk request to Elasticsearch.")
+    parser.add_argument('--bulk-bytes', default=10 * 1024 * 1024, type=int,
+                        help="Max size in bytes of each bulk request to Elasticsearch.")
+    parser.add_argument('--bulk-workers', default=1, type=int,
+                        help="Number of concurrent bulk requests to Elasticsearch.")
     parser.add_argument('--scroll-size', default=100, type=int,
                         help="Number of items to get from Elasticsearch when scrolling.")
+    parser.add_argument('--scroll-prefetch', default=0, type=int,
+                        help="Number of pages to read ahead from Elasticsearch when scrolling.")
+    parser.add_argument('--search-after', action='store_true',
+                        help="Use search_after instead of scroll to read items from Elasticsearch.")
     parser.add_argument('--arthur', action='store_true', help="Read items from arthur redis queue")
+    parser.add_argument('--metrics-file', dest='metrics_file',
+                        help="File to save the metrics of the run: JSON if .json, Prometheus text otherwise")
     parser.add_argument('--pair-programming', action='store_true', help="Do pair programming in git enrich")
     parser.add_argument('backend', help=argparse.SUPPRESS)
     parser.add_argument('backend_args', nargs=argparse.REMAINDER,
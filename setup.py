@@ -65,13 +65,15 @@ setup(name="grimoire-elk",
           'License :: OSI Approved :: GNU General Public License v3 or later (GPLv3+)',
           'Programming Language :: Python :: 3',
           'Programming Language :: Python :: 3.4',
-          'Programming Language :: Python :: 3.5'],
+          'Programming Language :: Python :: 3.5',
+          'Programming Language :: Python :: 3.6'],
       keywords="development repositories analytics",
       packages=['grimoire_elk', 'grimoire_elk.elk', 'grimoire_elk.ocean'],
       python_requires='>=3.4',
       setup_requires=['wheel'],
       extras_require={'sortinghat': ['sortinghat'],
-                      'mysql': ['PyMySQL']},
+                      'mysql': ['PyMySQL'],
+                      'async': ['aiohttp; python_version >= "3.6"']},
       tests_require=['httpretty==0.8.6'],
       test_suite='tests',
       scripts=["utils/p2o.py"],
@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Benchmark of the raw and enriched indexing of the test data
+#
+# Copyright (C) 2018 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+"""
+Benchmark of the connectors using the items in tests/data
+
+The items of each connector are fed to its raw index with feed_items and
+then enriched with enrich_items. ES is replaced by an in-process server
+which keeps the indexes in memory, so the results measure GrimoireELK.
+
+For each connector and stage the items/s, time and peak RSS are reported,
+and saved as JSON to compare them with the ones of other commits:
+
+    tests$ ./benchmark.py --items 10000 --output after.json --compare before.json
+"""
+
+import argparse
+import copy
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+if '..' not in sys.path:
+    sys.path.insert(0, '..')
+
+from grimoire_elk.utils import get_connectors, get_elastic
+
+
+DATA_DIR = 'data'
+ES_VERSION = '6.1.0'
+STAGES = ['ocean', 'enrich']
+
+logger = logging.getLogger(__name__)
+
+
+class StubElasticSearch(ThreadingMixIn, HTTPServer):
+    """ In-process ES server keeping the indexes in memory
+
+    It supports the API used in the raw and enriched indexing: indexes,
+    mappings, bulk, scroll searches returning all the documents of the
+    index, mget, count and refresh. Queries and aggregations are ignored.
+    The geocoding requests of the enrichers are also answered, with no
+    results, so the benchmark doesn't use any external service.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubElasticSearchHandler)
+        self.indexes = {}  # index -> {doc id: JSON source}
+        self.scrolls = {}  # scroll id -> (index, ids, position, size)
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%i' % self.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+    def bulk(self, index, body):
+        """ Run the actions of a bulk request """
+
+        with self.lock:
+            return self.__bulk(index, body)
+
+    def __bulk(self, index, body):
+        docs = self.indexes.setdefault(index, {})
+        lines = iter(body.splitlines())
+        items = []
+        for line in lines:
+            if not line.strip():
+                continue
+            action, meta = list(json.loads(line).items())[0]
+            doc_id = str(meta['_id'])
+            if action == 'delete':
+                docs.pop(doc_id, None)
+            elif action == 'update':
+                fields = json.loads(next(lines))['doc']
+                doc = json.loads(docs.get(doc_id, '{}'))
+                doc.update(fields)
+                docs[doc_id] = json.dumps(doc)
+            else:
+                docs[doc_id] = next(lines)
+            items.append({action: {"_id": doc_id, "status": 200}})
+        return {"took": 1, "errors": False, "items": items}
+
+    def search(self, index, size, scroll):
+        """ First page of a search of all the documents of index """
+
+        with self.lock:
+            ids = list(self.indexes.get(index, {}))
+            scroll_id = None
+            if scroll:
+                scroll_id = str(len(self.scrolls) + 1)
+                self.scrolls[scroll_id] = (index, ids, 0, size)
+        return self.page(index, ids, 0, size, scroll_id)
+
+    def scroll(self, scroll_id):
+        """ Next page of a scroll """
+
+        with self.lock:
+            index, ids, position, size = self.scrolls[scroll_id]
+            position += size
+            self.scrolls[scroll_id] = (index, ids, position, size)
+        return self.page(index, ids, position, size, scroll_id)
+
+    def page(self, index, ids, position, size, scroll_id):
+        docs = self.indexes.get(index, {})
+        hits = ['{"_index": %s, "_id": %s, "_source": %s}' % (json.dumps(index), json.dumps(doc_id), docs[doc_id])
+                for doc_id in ids[position:position + size] if doc_id in docs]
+        response = '{"_scroll_id": %s, "hits": {"total": %i, "hits": [%s]}, ' \
+                   '"aggregations": {"1": {"value": null}}}' % (json.dumps(scroll_id), len(ids), ",".join(hits))
+        return response
+
+
+class StubElasticSearchHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def __send(self, body, status=200):
+        if not isinstance(body, str):
+            body = json.dumps(body)
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def __read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length).decode('utf-8', 'replace') if length else ''
+
+    def __handle(self, method):
+        server = self.server
+        url = urllib.parse.urlparse(self.path)
+        params = urllib.parse.parse_qs(url.query)
+        parts = [part for part in url.path.split('/') if part]
+        body = self.__read_body()
+
+        if not parts:
+            return self.__send({"version": {"number": ES_VERSION}, "tagline": "You Know, for Search"})
+
+        if parts[0] == 'maps':
+            # Locations are not geocoded, to not use the Google Maps API
+            return self.__send({"results": [], "status": "ZERO_RESULTS"})
+
+        if parts[0] == '_search' and parts[1:] == ['scroll']:
+            if method == 'DELETE':
+                return self.__send({"succeeded": True})
+            return self.__send(server.scroll(json.loads(body)['scroll_id']))
+
+        index = parts[0]
+        endpoint = parts[-1] if len(parts) > 1 else None
+
+        if endpoint is None:
+            if method in ['GET', 'HEAD']:
+                status = 200 if index in server.indexes else 404
+                return self.__send({}, status)
+            if method == 'PUT':
+                server.indexes.setdefault(index, {})
+            elif method == 'DELETE':
+                server.indexes.pop(index, None)
+            return self.__send({"acknowledged": True})
+
+        if endpoint == '_bulk':
+            return self.__send(server.bulk(index, body))
+        if endpoint == '_search':
+            if index not in server.indexes:
+                return self.__send({"error": "index_not_found_exception"}, 404)
+            size = int(params.get('size', [10])[0])
+            return self.__send(server.search(index, size, params.get('scroll')))
+        if endpoint == '_count':
+            return self.__send({"count": len(server.indexes.get(index, {}))})
+        if endpoint == '_mget':
+            docs = server.indexes.get(index, {})
+            found = ['{"_id": %s, "found": true, "_source": %s}' % (json.dumps(doc['_id']), docs[doc['_id']])
+                     if doc['_id'] in docs else '{"_id": %s, "found": false}' % json.dumps(doc['_id'])
+                     for doc in json.loads(body)['docs']]
+            return self.__send('{"docs": [%s]}' % ",".join(found))
+
+        # Mappings, settings, refresh and other index operations
+        return self.__send({"acknowledged": True})
+
+    def do_GET(self):
+        self.__handle('GET')
+
+    def do_HEAD(self):
+        self.__handle('HEAD')
+
+    def do_POST(self):
+        self.__handle('POST')
+
+    def do_PUT(self):
+        self.__handle('PUT')
+
+    def do_DELETE(self):
+        self.__handle('DELETE')
+
+    def log_message(self, *args):
+        pass
+
+
+def read_items(connector, nitems=None):
+    """ Read the items of a connector test data, copying them up to nitems """
+
+    with open(os.path.join(DATA_DIR, connector + ".json")) as f:
+        items = json.load(f)
+
+    if not nitems or not items:
+        return items
+
+    all_items = []
+    ncopy = 0
+    while len(all_items) < nitems:
+        for item in items[:nitems - len(all_items)]:
+            item = copy.deepcopy(item)
+            if ncopy:
+                # Copies are new items in the indexes
+                id_field = 'uuid' if 'uuid' in item else 'id'
+                item[id_field] = "%s-%i" % (item[id_field], ncopy)
+            all_items.append(item)
+        ncopy += 1
+
+    return all_items
+
+
+def max_rss_mb():
+    """ Peak resident memory of the process in MB """
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_stage(stage, nitems):
+    """ Run a stage of a connector and get its metrics """
+
+    start = time.time()
+    stage()
+    seconds = time.time() - start
+
+    return {"items": nitems,
+            "seconds": round(seconds, 3),
+            "items_per_second": round(nitems / seconds, 1) if seconds else None,
+            "max_rss_mb": round(max_rss_mb(), 1)}
+
+
+def benchmark_connector(url, connector, classes, nitems=None):
+    """ Index and enrich the test data of a connector
+
+    The peak RSS of each stage is the one of the process until its end.
+    """
+
+    items = read_items(connector, nitems)
+
+    for item in items:
+        if 'updated_on' not in item:
+            # twitter comes from logstash
+            item.setdefault('uuid', item['id'])
+            item['updated_on'] = item['timestamp'] = time.time()
+
+    ocean_backend = classes[1](None)
+    elastic_ocean = get_elastic(url, "bench_" + connector, True, ocean_backend)
+    ocean_backend.set_elastic(elastic_ocean)
+
+    enrich_backend = classes[2]()
+    if hasattr(enrich_backend, 'maps_api_url'):
+        enrich_backend.maps_api_url = url + '/maps/api/geocode/json'
+    elastic_enrich = get_elastic(url, "bench_" + connector + "_enrich", True, enrich_backend)
+    enrich_backend.set_elastic(elastic_enrich)
+
+    return {
+        "ocean": run_stage(lambda: ocean_backend.feed_items(items), len(items)),
+        "enrich": run_stage(lambda: enrich_backend.enrich_items(ocean_backend), len(items))
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, previous):
+    """ Print the items/s of each stage compared with previous results """
+
+    print("%-16s %-7s %12s %12s %8s" % ("connector", "stage", "before", "after", "ratio"))
+    for connector, stages in sorted(results['connectors'].items()):
+        for stage in STAGES:
+            metrics = stages[stage]
+            before = previous['connectors'].get(connector, {}).get(stage, {}).get('items_per_second')
+            after = metrics.get('items_per_second')
+            ratio = "%.2f" % (after / before) if before and after else "-"
+            print("%-16s %-7s %12s %12s %8s" % (connector, stage, before, after, ratio))
+
+
+def get_params():
+    parser = argparse.ArgumentParser(usage="usage: benchmark.py [options]",
+                                     description="Benchmark the connectors with the test data")
+    parser.add_argument('-g', '--debug', action='store_true')
+    parser.add_argument('--connectors', nargs='*', help="Connectors to benchmark (all by default)")
+    parser.add_argument('--items', type=int, help="Items for each connector, copying the test data")
+    parser.add_argument('--output', help="JSON file to save the results")
+    parser.add_argument('--compare', help="JSON file with previous results to compare with")
+
+    return parser.parse_args()
+
+
+def main():
+    args = get_params()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING,
+                        format='%(asctime)s %(message)s')
+
+    connectors = get_connectors()
+    names = args.connectors if args.connectors else sorted(connectors)
+
+    server = StubElasticSearch()
+    server.start()
+
+    results = {"commit": git_commit(), "date": datetime.now().isoformat(),
+               "items": args.items, "connectors": {}}
+    try:
+        for name in names:
+            if not os.path.exists(os.path.join(DATA_DIR, name + ".json")):
+                logger.warning("No test data for %s", name)
+                continue
+            try:
+                results['connectors'][name] = benchmark_connector(server.url, name,
+                                                                  connectors[name], args.items)
+            except Exception as ex:
+                logger.error("Benchmark of %s failed: %s", name, ex)
+                continue
+            # Free the memory of the indexes of the connector
+            server.indexes.clear()
+            server.scrolls.clear()
+            for stage in STAGES:
+                metrics = results['connectors'][name][stage]
+                print("%-16s %-7s %8i items %9.3f s %10.1f items/s %8.1f MB" %
+                      (name, stage, metrics['items'], metrics['seconds'],
+                       metrics['items_per_second'] or 0, metrics['max_rss_mb']))
+    finally:
+        server.stop()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Stub ElasticSearch server for the tests of the asyncio client
+#
+# Copyright (C) 2018 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+import asyncio
+import json
+
+from aiohttp import web
+
+
+class StubElasticSearch(object):
+    """ Minimal ES server with one index, its bulk, search and scroll APIs
+
+    The documents whose id is in rejected are rejected with 429 the first
+    time they are sent, and the ones in invalid always with 400.
+    """
+
+    def __init__(self, items, page_size):
+        self.items = items
+        self.page_size = page_size
+        self.docs = {}
+        self.scrolls_cleared = 0
+        self.bulk_requests = 0
+        self.bulk_running = 0
+        self.max_bulk_running = 0  # max bulk requests handled at the same time
+        self.rejected = set()
+        self.invalid = set()
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get('/', self.info)
+        app.router.add_get('/{index}', self.info)
+        app.router.add_put('/{index}/items/_bulk', self.bulk)
+        app.router.add_post('/{index}/_search', self.search)
+        app.router.add_post('/_search/scroll', self.scroll)
+        app.router.add_delete('/_search/scroll', self.clear_scroll)
+        return app
+
+    def page(self, start):
+        hits = [{"_source": item} for item in self.items[start:start + self.page_size]]
+        return web.json_response({"_scroll_id": str(start + self.page_size),
+                                  "hits": {"hits": hits}})
+
+    async def info(self, request):
+        return web.json_response({"version": {"number": "6.1.0"}})
+
+    async def bulk(self, request):
+        self.bulk_requests += 1
+        self.bulk_running += 1
+        self.max_bulk_running = max(self.max_bulk_running, self.bulk_running)
+        try:
+            lines = (await request.text()).splitlines()
+            # Let the other requests in flight arrive
+            await asyncio.sleep(0.01)
+        finally:
+            self.bulk_running -= 1
+
+        items = []
+        for action, doc in zip(lines[0::2], lines[1::2]):
+            doc_id = json.loads(action)["index"]["_id"]
+            if doc_id in self.rejected:
+                self.rejected.remove(doc_id)
+                items.append({"index": {"_id": doc_id, "status": 429,
+                                        "error": "es_rejected_execution_exception"}})
+            elif doc_id in self.invalid:
+                items.append({"index": {"_id": doc_id, "status": 400,
+                                        "error": "mapper_parsing_exception"}})
+            else:
+                self.docs[doc_id] = json.loads(doc)
+                items.append({"index": {"_id": doc_id, "status": 201}})
+        errors = any('error' in item['index'] for item in items)
+        return web.json_response({"errors": errors, "items": items})
+
+    async def search(self, request):
+        return self.page(0)
+
+    async def scroll(self, request):
+        data = await request.json()
+        return self.page(int(data['scroll_id']))
+
+    async def clear_scroll(self, request):
+        self.scrolls_cleared += 1
+        return web.json_response({"succeeded": True})
+
+
+def record_scrolls(scroll, scroll_ids):
+    """ Wrap the scroll coroutine of the client, recording the scrolls started """
+
+    async def recorded_scroll(self, scroll_id):
+        scroll_ids.append(scroll_id)
+        return await scroll(self, scroll_id)
+
+    return recorded_scroll
+
+
+async def read_pages(elastic, query, size):
+    """ Read all the pages of a query with an AsyncElasticSearch """
+
+    pages = []
+    async for page in elastic.fetch_pages(query, size):
+        pages.append(page)
+    return pages
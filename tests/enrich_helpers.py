@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Helpers for the tests enriching the items of the test data
+#
+# Copyright (C) 2018 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+import json
+import os
+import sys
+
+import httpretty
+
+if '..' not in sys.path:
+    sys.path.insert(0, '..')
+
+from grimoire_elk.elk.utils import unixtime_to_datetime
+
+
+class ItemsBackend(object):
+    """ Raw backend returning a list of items, counting the fetches """
+
+    def __init__(self, items):
+        self.items = items
+        self.fetches = 0
+
+    def fetch(self):
+        self.fetches += 1
+        return iter(self.items)
+
+
+def read_items(connector):
+    """ Read the raw items of a connector from the test data """
+
+    with open(os.path.join('data', connector + '.json')) as f:
+        items = json.load(f)
+    for item in items:
+        item['metadata__updated_on'] = unixtime_to_datetime(item['updated_on']).isoformat()
+        item['metadata__timestamp'] = unixtime_to_datetime(item['timestamp']).isoformat()
+    return items
+
+
+class BulkRecorder(object):
+    """ httpretty callback for the bulk API recording the documents stored
+
+    The documents whose id is in rejected are rejected with 429 the first
+    time they are sent, and the ones in invalid always with 400.
+    """
+
+    def __init__(self):
+        self.docs = []  # (id, document) stored, in order
+        self.sizes = []  # documents of each bulk request
+        self.rejected = set()
+        self.invalid = set()
+
+    @property
+    def docs_by_id(self):
+        return dict(self.docs)
+
+    def __call__(self, request, uri, headers):
+        lines = [line for line in request.body.decode('utf-8').split('\n') if line]
+        items = []
+        for action, doc in zip(lines[0::2], lines[1::2]):
+            doc_id = json.loads(action)["index"]["_id"]
+            if doc_id in self.rejected:
+                self.rejected.remove(doc_id)
+                items.append({"index": {"_id": doc_id, "status": 429,
+                                        "error": "es_rejected_execution_exception"}})
+            elif doc_id in self.invalid:
+                items.append({"index": {"_id": doc_id, "status": 400,
+                                        "error": "mapper_parsing_exception"}})
+            else:
+                self.docs.append((doc_id, json.loads(doc)))
+                items.append({"index": {"_id": doc_id, "status": 201}})
+        self.sizes.append(len(items))
+        errors = any('error' in item['index'] for item in items)
+        return (200, headers, json.dumps({"errors": errors, "items": items}))
+
+
+def register_index(url, index):
+    """ Register in httpretty an ES 6 server with index, recording its bulk requests
+
+    :returns: the BulkRecorder of the index
+    """
+
+    bulk = BulkRecorder()
+    httpretty.register_uri(httpretty.GET, url,
+                           body=json.dumps({"version": {"number": "6.1.0"}}))
+    httpretty.register_uri(httpretty.GET, url + '/' + index, body="{}")
+    httpretty.register_uri(httpretty.PUT, url + '/' + index + '/items/_bulk', body=bulk)
+
+    return bulk
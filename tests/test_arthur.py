@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import sys
+import unittest
+
+from unittest import mock
+
+import httpretty
+
+if '..' not in sys.path:
+    sys.path.insert(0, '..')
+
+from grimoire_elk.arthur import (enrich_items_slices, get_items_from_uuids, get_slices_results,
+                                 load_identities, refresh_identities, refresh_projects,
+                                 refresh_uuids_items, update_items)
+from grimoire_elk.elk.elastic import ElasticSearch
+from grimoire_elk.elk.enrich import Enrich, SORTINGHAT_LIBS
+from grimoire_elk.ocean.elastic import ElasticOcean
+
+if SORTINGHAT_LIBS:
+    from grimoire_elk.elk.sortinghat import SortingHat
+
+
+def matches(doc, query):
+    """ Check if a doc matches the queries used to read the items """
+
+    if 'bool' in query:
+        must = query['bool'].get('must', [])
+        should = query['bool'].get('should', [])
+        return all(matches(doc, clause) for clause in must) and \
+            (not should or any(matches(doc, clause) for clause in should))
+    if 'terms' in query:
+        field, values = list(query['terms'].items())[0]
+        return doc.get(field) in values
+    raise ValueError("Query not supported %s" % query)
+
+
+class StubIndex(object):
+    """ ES index registered in httpretty, with its documents in docs
+
+    The searches are recorded in queries and the bulk actions, as
+    (action, doc_id, body), in actions. The slices of the sliced scrolls,
+    also the ones read from forked processes, are put in the slices queue.
+    """
+
+    def __init__(self, url, index):
+        self.docs = {}
+        self.queries = []
+        self.actions = []
+        self.refreshes = 0
+        self.slices = multiprocessing.get_context('fork').Queue()
+
+        index_url = url + '/' + index
+        httpretty.register_uri(httpretty.GET, index_url, body="{}")
+        httpretty.register_uri(httpretty.POST, index_url + '/_search', body=self.search)
+        httpretty.register_uri(httpretty.POST, index_url + '/_mget', body=self.mget)
+        httpretty.register_uri(httpretty.POST, index_url + '/_refresh', body=self.refresh)
+        httpretty.register_uri(httpretty.PUT, index_url + '/items/_bulk', body=self.bulk)
+
+    def search(self, request, uri, headers):
+        body = json.loads(request.body.decode('utf-8'))
+        query = body.get('query')
+        self.queries.append(query)
+        hits = [{"_id": doc_id, "_source": doc} for doc_id, doc in sorted(self.docs.items())
+                if not query or matches(doc, query)]
+        if 'slice' in body:
+            self.slices.put(body['slice'])
+            hits = hits[body['slice']['id']::body['slice']['max']]
+        return (200, headers, json.dumps({"_scroll_id": "1", "hits": {"hits": hits}}))
+
+    def mget(self, request, uri, headers):
+        ids = [doc['_id'] for doc in json.loads(request.body.decode('utf-8'))['docs']]
+        docs = [{"_id": doc_id, "found": True, "_source": self.docs[doc_id]}
+                if doc_id in self.docs else {"_id": doc_id, "found": False} for doc_id in ids]
+        return (200, headers, json.dumps({"docs": docs}))
+
+    def refresh(self, request, uri, headers):
+        self.refreshes += 1
+        return (200, headers, "{}")
+
+    def bulk(self, request, uri, headers):
+        lines = [line for line in request.body.decode('utf-8').split('\n') if line]
+        items = []
+        for action, body in zip(lines[0::2], lines[1::2]):
+            action, params = list(json.loads(action).items())[0]
+            body = json.loads(body)
+            doc_id = params['_id']
+            self.actions.append((action, doc_id, body))
+            if action == 'update':
+                self.docs[doc_id].update(body['doc'])
+            else:
+                self.docs[doc_id] = body
+            items.append({action: {"_id": doc_id, "status": 200}})
+        return (200, headers, json.dumps({"errors": False, "items": items}))
+
+
+class RawBackend(object):
+    """ Ocean backend with only the raw index """
+
+    def __init__(self, elastic):
+        self.elastic = elastic
+
+
+class IdentitiesEnrich(Enrich):
+    """ Enrich with author and committer identities
+
+    The uuids of the SortingHat ids are read from sh_uuids instead of
+    from SortingHat. Enriching the item failing_uuid fails, and enriching
+    the item dying_uuid kills the process.
+    """
+
+    roles = ['author', 'committer']
+    failing_uuid = None
+    dying_uuid = None
+
+    def __init__(self, sh_uuids):
+        super().__init__()
+        self.sh_uuids = sh_uuids
+
+    def get_connector_name(self):
+        return "git"
+
+    def get_field_author(self):
+        return "author"
+
+    def get_fields_uuid(self):
+        return ["author_uuid", "committer_uuid"]
+
+    def get_project_repository(self, eitem):
+        return eitem['origin']
+
+    def get_item_sh_fields(self, identity=None, item_date=None, sh_id=None, rol='author'):
+        return {rol + "_uuid": self.sh_uuids[sh_id]}
+
+    def get_identities(self, item):
+        for rol in self.roles:
+            yield {"name": None, "email": None, "username": item[rol]}
+
+    def get_rich_item(self, item):
+        if item['uuid'] == self.failing_uuid:
+            raise ValueError("Item %s can't be enriched" % item['uuid'])
+        if item['uuid'] == self.dying_uuid:
+            os._exit(1)
+        eitem = {field: item[field] for field in ['uuid', 'origin', 'metadata__updated_on']}
+        for rol in self.roles:
+            eitem[rol + "_id"] = item[rol]
+            eitem.update(self.get_item_sh_fields(sh_id=item[rol], rol=rol))
+        return eitem
+
+
+class TestRefresh(unittest.TestCase):
+    """Unit tests for the refresh of the enriched items"""
+
+    def setUp(self):
+        self.url = 'http://es6.com'
+
+        httpretty.enable()
+        httpretty.register_uri(httpretty.GET, self.url,
+                               body=json.dumps({"version": {"number": "6.1.0"}}))
+        httpretty.register_uri(httpretty.POST, self.url + '/_search/scroll',
+                               body=json.dumps({"_scroll_id": "1", "hits": {"hits": []}}))
+        httpretty.register_uri(httpretty.DELETE, self.url + '/_search/scroll', body="{}")
+        self.raw = StubIndex(self.url, 'git_raw')
+        self.enriched = StubIndex(self.url, 'git_enrich')
+
+        self.sh_uuids = {"1": "uuid1", "2": "uuid2", "3": "uuid3", "4": "uuid4"}
+        self.enrich = IdentitiesEnrich(self.sh_uuids)
+        self.enrich.set_elastic(ElasticSearch(self.url, 'git_enrich'))
+        self.ocean = RawBackend(ElasticSearch(self.url, 'git_raw'))
+
+        for uuid, author, committer in [("a", "1", "1"), ("b", "1", "2"), ("c", "2", "3"),
+                                        ("d", "3", "3"), ("e", "4", "4")]:
+            item = {"uuid": uuid, "origin": "https://repo", "author": author,
+                    "committer": committer, "metadata__updated_on": "2018-01-01T00:00:00+00:00"}
+            self.raw.docs[uuid] = item
+            self.enriched.docs[uuid] = self.enrich.get_rich_item(item)
+
+    def tearDown(self):
+        httpretty.disable()
+        httpretty.reset()
+
+    def merge(self, uuid, new_uuid):
+        """ Merge in the stub SortingHat the identities of uuid into new_uuid """
+
+        for sh_id in self.sh_uuids:
+            if self.sh_uuids[sh_id] == uuid:
+                self.sh_uuids[sh_id] = new_uuid
+
+    def test_get_items_from_uuids(self):
+        """Test that the raw items including the uuids in any role are read once"""
+
+        self.enrich.elastic.max_items_clause = 2
+        del self.raw.docs["d"]
+
+        items = list(get_items_from_uuids(["uuid3", "uuid2", "uuid3", "uuid1"],
+                                          self.enrich, self.ocean))
+
+        self.assertListEqual([item['uuid'] for item in items], ["a", "b", "c"])
+        terms = [query['bool']['should'][0]['terms']['author_uuid'] for query in self.enriched.queries]
+        self.assertListEqual(terms, [["uuid1", "uuid2"], ["uuid3"]])
+
+    def test_refresh_uuids_items(self):
+        """Test that the items of the merged uuids are enriched again in any role"""
+
+        self.merge("uuid3", "uuid2")
+
+        total = refresh_uuids_items(self.ocean, self.enrich, ["uuid3", "uuid2"])
+
+        self.assertEqual(total, 3)
+        self.assertListEqual([(action, doc_id) for action, doc_id, _ in self.enriched.actions],
+                             [("index", "b"), ("index", "c"), ("index", "d")])
+        self.assertEqual(self.enriched.docs["c"]["committer_uuid"], "uuid2")
+        self.assertEqual(self.enriched.docs["d"]["author_uuid"], "uuid2")
+        self.assertEqual(self.enriched.docs["e"]["author_uuid"], "uuid4")
+
+    def test_refresh_identities_uuid(self):
+        """Test that the identities refresh by uuid doesn't enrich the raw items"""
+
+        self.merge("uuid3", "uuid2")
+
+        updates = list(refresh_identities(self.enrich, {"name": "author_uuid", "value": ["uuid3"]}))
+
+        self.assertListEqual(updates, [("d", {"author_uuid": "uuid2", "committer_uuid": "uuid2"})])
+        self.assertListEqual(self.raw.queries, [])
+        self.assertListEqual(self.enriched.actions, [])
+
+    def test_update_items_identities(self):
+        """Test that only the changed identities fields are updated"""
+
+        self.merge("uuid3", "uuid2")
+
+        total = update_items(self.enrich, refresh_identities(self.enrich))
+
+        self.assertEqual(total, 2)
+        self.assertListEqual(self.enriched.actions,
+                             [("update", "c", {"doc": {"committer_uuid": "uuid2"}}),
+                              ("update", "d", {"doc": {"author_uuid": "uuid2", "committer_uuid": "uuid2"}})])
+        self.assertEqual(self.enriched.refreshes, 1)
+
+    def test_update_items_identities_filter(self):
+        """Test that only the changed items matching the filter are updated"""
+
+        self.merge("uuid3", "uuid2")
+        self.merge("uuid4", "uuid1")
+
+        filter_author = {"name": "author_uuid", "value": ["uuid3", "uuid1"]}
+        total = update_items(self.enrich, refresh_identities(self.enrich, filter_author))
+
+        self.assertEqual(total, 1)
+        self.assertListEqual(self.enriched.actions,
+                             [("update", "d", {"doc": {"author_uuid": "uuid2", "committer_uuid": "uuid2"}})])
+
+    def test_update_items_unchanged(self):
+        """Test that nothing is sent when no item changes"""
+
+        total = update_items(self.enrich, refresh_identities(self.enrich))
+
+        self.assertEqual(total, 0)
+        self.assertListEqual(self.enriched.actions, [])
+        self.assertEqual(self.enriched.refreshes, 0)
+
+    def test_update_items_projects(self):
+        """Test that only the changed project fields are updated"""
+
+        self.enrich.prjs_map = {"git": {"https://repo": "grimoire.elk"}}
+        for doc in self.enriched.docs.values():
+            doc.update({"project": "Main", "project_1": "Main"})
+        self.enriched.docs["a"].update({"project": "grimoire.elk", "project_1": "grimoire",
+                                        "project_2": "grimoire.elk"})
+        self.enriched.docs["e"]["origin"] = "https://other"
+
+        total = update_items(self.enrich, refresh_projects(self.enrich))
+
+        self.assertEqual(total, 3)
+        fields = {"project": "grimoire.elk", "project_1": "grimoire", "project_2": "grimoire.elk"}
+        self.assertListEqual(self.enriched.actions,
+                             [("update", doc_id, {"doc": fields}) for doc_id in ["b", "c", "d"]])
+        self.assertEqual(self.enriched.docs["e"]["project"], "Main")
+
+
+class ExitedProcess(object):
+    """ Process of a slice which has exited with exitcode """
+
+    def __init__(self, exitcode):
+        self.exitcode = exitcode
+
+
+class TestEnrichSlices(unittest.TestCase):
+    """Unit tests for the enrichment in slices"""
+
+    def setUp(self):
+        self.url = 'http://es6.com'
+
+        httpretty.enable()
+        httpretty.register_uri(httpretty.GET, self.url,
+                               body=json.dumps({"version": {"number": "6.1.0"}}))
+        httpretty.register_uri(httpretty.POST, self.url + '/_search/scroll',
+                               body=json.dumps({"_scroll_id": "1", "hits": {"hits": []}}))
+        httpretty.register_uri(httpretty.DELETE, self.url + '/_search/scroll', body="{}")
+        self.raw = StubIndex(self.url, 'git_raw')
+        StubIndex(self.url, 'git_enrich')
+
+        self.enrich = IdentitiesEnrich({str(i): "uuid%i" % i for i in range(10)})
+        self.enrich.set_elastic(ElasticSearch(self.url, 'git_enrich'))
+        self.ocean = ElasticOcean(None)
+        self.ocean.set_elastic(ElasticSearch(self.url, 'git_raw'))
+
+        for i in range(10):
+            uuid = "%02i" % i
+            self.raw.docs[uuid] = {"uuid": uuid, "origin": "https://repo", "author": str(i),
+                                   "committer": str(i), "metadata__updated_on": "2018-01-01T00:00:00+00:00"}
+
+    def tearDown(self):
+        httpretty.disable()
+        httpretty.reset()
+
+    def read_slices(self):
+        slices = []
+        while True:
+            try:
+                slices.append(self.raw.slices.get(timeout=1))
+            except queue.Empty:
+                return sorted(slices, key=lambda slice: slice['id'])
+
+    def test_enrich_items_slices(self):
+        """Test that each process enriches the items of its slice"""
+
+        total = enrich_items_slices(self.ocean, self.enrich, 3)
+
+        self.assertEqual(total, 10)
+        self.assertListEqual(self.read_slices(), [{"id": i, "max": 3} for i in range(3)])
+
+    def test_enrich_items_slices_failed(self):
+        """Test that the enrichment fails if a slice fails"""
+
+        self.enrich.failing_uuid = "04"
+
+        with self.assertRaisesRegex(RuntimeError, r"slices \[1\]"):
+            enrich_items_slices(self.ocean, self.enrich, 3)
+        self.assertEqual(len(self.read_slices()), 3)
+
+    def test_enrich_items_slices_died(self):
+        """Test that the enrichment fails if the process of a slice dies"""
+
+        self.enrich.dying_uuid = "05"
+
+        with mock.patch('grimoire_elk.arthur.SLICES_CHECK_SECONDS', 0.1):
+            with self.assertRaisesRegex(RuntimeError, r"slices \[2\]"):
+                enrich_items_slices(self.ocean, self.enrich, 3)
+
+    def test_get_slices_results(self):
+        """Test that a slice whose process exits without result has None"""
+
+        workers = {0: ExitedProcess(0), 1: ExitedProcess(1), 2: ExitedProcess(None)}
+        results = queue.Queue()
+        results.put((0, 4))
+        results.put((2, 3))
+
+        with mock.patch('grimoire_elk.arthur.SLICES_CHECK_SECONDS', 0.1):
+            totals = get_slices_results(workers, results)
+
+        self.assertDictEqual(totals, {0: 4, 1: None, 2: 3})
+
+
+@unittest.skipIf(not SORTINGHAT_LIBS, "SortingHat not available")
+class TestLoadIdentities(unittest.TestCase):
+    """Unit tests for the load of the identities in SortingHat"""
+
+    def setUp(self):
+        self.enrich = IdentitiesEnrich({})
+        self.items = [{"uuid": uuid, "author": author, "committer": committer}
+                      for uuid, author, committer in [("a", "1", "1"), ("b", "1", "2"), ("c", "2", "3"),
+                                                      ("d", "3", "3"), ("e", "4", "4"), ("f", "1", "4")]]
+
+    def load_identities(self):
+        """ Load the identities of the items, returning the total and the chunks added """
+
+        chunks = []
+
+        def add_identities(db, identities, backend):
+            chunks.append([identity['username'] for identity in identities])
+            return len(identities)
+
+        with mock.patch.object(SortingHat, 'bulk_size', 2), \
+                mock.patch.object(SortingHat, 'add_identities', side_effect=add_identities):
+            total = load_identities(self.items, self.enrich)
+
+        return total, chunks
+
+    def test_load_identities(self):
+        """Test that each identity is sent once, even if it is found again in other chunks"""
+
+        total, chunks = self.load_identities()
+
+        self.assertEqual(total, 4)
+        self.assertListEqual(chunks, [["1", "2"], ["3", "4"]])
+
+    def test_load_identities_seen(self):
+        """Test that only the keys of the last identities are remembered"""
+
+        with mock.patch('grimoire_elk.arthur.LOAD_IDENTITIES_SEEN', 2):
+            total, chunks = self.load_identities()
+
+        self.assertEqual(total, 5)
+        self.assertListEqual(chunks, [["1", "2"], ["3", "4"], ["1"]])
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    unittest.main()
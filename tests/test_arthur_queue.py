@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+import logging
+import pickle
+import sys
+import time
+import unittest
+
+try:
+    import fakeredis
+    FAKEREDIS_LIBS = True
+except ImportError:
+    FAKEREDIS_LIBS = False
+
+if '..' not in sys.path:
+    sys.path.insert(0, '..')
+
+from grimoire_elk.arthur_queue import ArthurQueue
+
+
+QUEUE = 'items'
+
+
+@unittest.skipIf(not FAKEREDIS_LIBS, "fakeredis not available")
+class TestArthurQueue(unittest.TestCase):
+    """Unit tests for the consumer of the arthur items queue"""
+
+    def setUp(self):
+        self.conn = fakeredis.FakeStrictRedis()
+        self.conn.flushall()
+        self.timestamp = time.time() - 60
+        for i in range(10):
+            tag = "git" if i % 3 else "github"
+            item = {"tag": tag, "uuid": str(i), "timestamp": self.timestamp + i}
+            self.conn.rpush(QUEUE, pickle.dumps(item))
+
+    def test_batches(self):
+        """Test that the items of the tag are read in order and the other ones kept"""
+
+        queue = ArthurQueue(self.conn, QUEUE, "git", batch_size=4)
+        uuids = []
+        for items in queue.batches():
+            self.assertLessEqual(len(items), 4)
+            self.assertGreaterEqual(self.conn.llen(queue.pending_queue), len(items))
+            uuids.extend(item['uuid'] for item in items)
+            queue.ack()
+
+        self.assertListEqual(uuids, ["1", "2", "4", "5", "7", "8"])
+        self.assertEqual(queue.stats["items"], 6)
+        self.assertEqual(queue.stats["batches"], 3)
+        self.assertEqual(queue.stats["queue_length"], 0)
+        self.assertGreaterEqual(queue.stats["lag_seconds"], 50)
+        self.assertEqual(self.conn.llen(QUEUE), 0)
+        self.assertEqual(self.conn.llen(queue.pending_queue), 0)
+
+        # The items of other tags are read from its own list
+        queue = ArthurQueue(self.conn, QUEUE, "github", batch_size=4)
+        uuids = [item['uuid'] for items in queue.batches() for item in items]
+        self.assertListEqual(uuids, ["0", "3", "6", "9"])
+
+    def test_not_acknowledged(self):
+        """Test that a batch not stored is read again"""
+
+        queue = ArthurQueue(self.conn, QUEUE, "git", batch_size=4)
+        batches = queue.batches()
+        first = next(batches)
+        batches.close()
+        self.assertEqual(self.conn.llen(queue.pending_queue), 4)
+
+        queue = ArthurQueue(self.conn, QUEUE, "git", batch_size=4)
+        self.assertEqual(self.conn.llen(queue.pending_queue), 0)
+        uuids = []
+        for items in queue.batches():
+            uuids.extend(item['uuid'] for item in items)
+            queue.ack()
+
+        self.assertListEqual(uuids[:len(first)], [item['uuid'] for item in first])
+        self.assertListEqual(uuids, ["1", "2", "4", "5", "7", "8"])
+
+    def test_failed(self):
+        """Test that the items not stored are read again in the next run"""
+
+        queue = ArthurQueue(self.conn, QUEUE, "git", batch_size=4)
+        uuids = []
+        for items in queue.batches():
+            uuids.extend(item['uuid'] for item in items)
+            queue.ack([item for item in items if item['uuid'] in ["2", "7"]])
+
+        self.assertListEqual(uuids, ["1", "2", "4", "5", "7", "8"])
+        self.assertEqual(queue.stats["items"], 4)
+        self.assertEqual(queue.stats["failed"], 2)
+        self.assertEqual(self.conn.llen(queue.pending_queue), 0)
+        self.assertEqual(self.conn.llen(queue.failed_queue), 2)
+
+        queue = ArthurQueue(self.conn, QUEUE, "git", batch_size=4)
+        uuids = []
+        for items in queue.batches():
+            uuids.extend(item['uuid'] for item in items)
+            queue.ack()
+
+        self.assertListEqual(uuids, ["2", "7"])
+        self.assertEqual(self.conn.llen(queue.failed_queue), 0)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    unittest.main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+import json
+import logging
+import sys
+import unittest
+
+import httpretty
+
+if '..' not in sys.path:
+    sys.path.insert(0, '..')
+
+from grimoire_elk.elastic_items import ElasticItems
+from grimoire_elk.elk.elastic import ElasticSearch
+
+
+class RawItems(ElasticItems):
+    """ ElasticItems not linked to any connector """
+
+    def get_connector_name(self):
+        return "test"
+
+
+class TestElasticItems(unittest.TestCase):
+    """Unit tests for ElasticItems class"""
+
+    def setUp(self):
+        self.url = 'http://es6.com'
+        self.index_url = self.url + '/test_items'
+        self.items = [{"uuid": str(i)} for i in range(25)]
+
+        httpretty.enable()
+        httpretty.register_uri(httpretty.GET, self.url,
+                               body=json.dumps({"version": {"number": "6.1.0"}}))
+        httpretty.register_uri(httpretty.GET, self.index_url, body="{}")
+        httpretty.register_uri(httpretty.POST, self.index_url + '/_search',
+                               body=self.__page_callback)
+        httpretty.register_uri(httpretty.POST, self.url + '/_search/scroll',
+                               body=self.__page_callback)
+        httpretty.register_uri(httpretty.DELETE, self.url + '/_search/scroll',
+                               body=self.__clear_scroll_callback)
+        self.scrolls_cleared = []
+
+        self.elastic_items = RawItems(None)
+        self.elastic_items.scroll_size = 10
+        self.elastic_items.elastic = ElasticSearch(self.url, 'test_items')
+
+    def tearDown(self):
+        httpretty.disable()
+        httpretty.reset()
+
+    def __page_callback(self, request, uri, headers):
+        """ Return the page of items starting at the scroll_id """
+
+        data = json.loads(request.body.decode('utf-8'))
+        if self.elastic_items.search_after:
+            return self.__search_after_callback(request, uri, headers)
+        start = int(data.get('scroll_id', 0))
+        hits = [{"_source": item} for item in self.items[start:start + 10]]
+        page = {"_scroll_id": str(start + 10), "hits": {"hits": hits}}
+        return (200, headers, json.dumps(page))
+
+    def __clear_scroll_callback(self, request, uri, headers):
+        data = json.loads(request.body.decode('utf-8'))
+        self.scrolls_cleared.extend(data['scroll_id'])
+        return (200, headers, json.dumps({"succeeded": True}))
+
+    def __search_after_callback(self, request, uri, headers):
+        """ Return the page of items after the uuid in search_after """
+
+        data = json.loads(request.body.decode('utf-8'))
+        self.assertEqual(data['sort'], [{"metadata__timestamp": {"order": "asc"}},
+                                        {"_id": {"order": "asc"}}])
+        start = 0
+        if 'search_after' in data:
+            start = int(data['search_after'][1]) + 1
+        hits = [{"_source": item, "sort": [0, item['uuid']]}
+                for item in self.items[start:start + 10]]
+        return (200, headers, json.dumps({"hits": {"hits": hits}}))
+
+    def test_fetch(self):
+        """Test that all the items are fetched"""
+
+        items = [item for item in self.elastic_items.fetch()]
+        self.assertListEqual(items, self.items)
+        self.assertListEqual(self.scrolls_cleared, ["40"])
+
+    def test_fetch_search_after(self):
+        """Test that all the items are fetched using search_after"""
+
+        self.elastic_items.search_after = True
+        items = [item for item in self.elastic_items.fetch()]
+        self.assertListEqual(items, self.items)
+        self.assertListEqual(self.elastic_items.search_after_value, [0, "24"])
+        self.assertListEqual(self.scrolls_cleared, [])
+
+    def test_fetch_search_after_twice(self):
+        """Test that each fetch using search_after reads all the items"""
+
+        self.elastic_items.search_after = True
+        items = [item for item in self.elastic_items.fetch()]
+        self.assertEqual(len(items), 25)
+        items = [item for item in self.elastic_items.fetch()]
+        self.assertListEqual(items, self.items)
+
+    def test_fetch_search_after_resume(self):
+        """Test that fetching with search_after is resumed from the last item"""
+
+        self.elastic_items.search_after = True
+        self.elastic_items.search_after_start = [0, "19"]
+        items = [item for item in self.elastic_items.fetch()]
+        self.assertListEqual(items, self.items[20:])
+        # The start is kept for the next fetch
+        items = [item for item in self.elastic_items.fetch()]
+        self.assertListEqual(items, self.items[20:])
+
+    def test_fetch_prefetch(self):
+        """Test that all the items are fetched reading pages ahead"""
+
+        self.elastic_items.scroll_prefetch = 2
+        items = [item for item in self.elastic_items.fetch()]
+        self.assertListEqual(items, self.items)
+
+    def test_fetch_prefetch_stop(self):
+        """Test that the reading thread finishes if the items are not consumed"""
+
+        self.elastic_items.scroll_prefetch = 1
+        fetch = self.elastic_items.fetch()
+        self.assertDictEqual(next(fetch), {"uuid": "0"})
+        fetch.close()
+
+    def test_query_slice(self):
+        """Test that the query reads only the configured slice"""
+
+        query = json.loads(self.elastic_items.get_elastic_items_query())
+        self.assertNotIn('slice', query)
+
+        self.elastic_items.set_filter_raw({"name": "origin", "value": "a"})
+        self.elastic_items.set_scroll_slice(1, 4)
+        query = json.loads(self.elastic_items.get_elastic_items_query())
+        self.assertDictEqual(query['slice'], {"id": 1, "max": 4})
+        self.assertDictEqual(query['query']['bool']['must'][0], {"term": {"origin": "a"}})
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    unittest.main()
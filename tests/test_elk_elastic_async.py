@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+import asyncio
+import logging
+import sys
+import unittest
+
+from unittest import mock
+
+if '..' not in sys.path:
+    sys.path.insert(0, '..')
+
+from grimoire_elk.elk.elastic import ElasticSearch
+
+# The asyncio client uses async generators, available since Python 3.6
+ASYNC_CLIENT = False
+if sys.version_info >= (3, 6):
+    from grimoire_elk.elk.elastic_async import AsyncElasticSearch, AIOHTTP_LIBS, enrich_items_async
+    if AIOHTTP_LIBS:
+        from aiohttp import web
+        from elastic_async_stub import StubElasticSearch, read_pages, record_scrolls
+        ASYNC_CLIENT = True
+
+
+class RawBackend(object):
+    """ Ocean backend reading the items of an index """
+
+    scroll_size = 10
+
+    def __init__(self, elastic):
+        self.elastic = elastic
+
+    def get_elastic_items_query(self, _filter=None):
+        return '{}'
+
+
+class RichBackend(object):
+    """ Enrich backend adding a field to the raw items """
+
+    sortinghat = False
+
+    def __init__(self, elastic, scroll_ids=None):
+        self.elastic = elastic
+        self.packs = []
+        self.scroll_ids = scroll_ids if scroll_ids is not None else []
+        self.scrolls_started = []  # scrolls started when each item was enriched
+
+    def get_field_unique_id(self):
+        return "uuid"
+
+    def get_rich_item(self, item):
+        self.scrolls_started.append(len(self.scroll_ids))
+        return dict(item, rich=True)
+
+    def resolve_sh_identities(self, items):
+        self.packs.append(len(items))
+
+
+class IndexElasticSearch(object):
+    """ ElasticSearch whose index is already initialized """
+
+    def __init__(self, url, index):
+        self.url = url
+        self.index = index
+        self.major = '6'
+
+
+@unittest.skipIf(not ASYNC_CLIENT, "Python 3.6 or aiohttp not available")
+class TestAsyncElasticSearch(unittest.TestCase):
+    """Unit tests for AsyncElasticSearch class against a stub ES"""
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.stub = StubElasticSearch([{"uuid": str(i)} for i in range(25)], 10)
+        self.runner = web.AppRunner(self.stub.app())
+        self.loop.run_until_complete(self.runner.setup())
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        self.loop.run_until_complete(site.start())
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = 'http://127.0.0.1:%i' % port
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.runner.cleanup())
+        self.loop.close()
+
+    def test_bulk_upload(self):
+        """Test that items are uploaded in concurrent packs"""
+
+        max_items_bulk = ElasticSearch.max_items_bulk
+        bulk_workers = ElasticSearch.bulk_workers
+        ElasticSearch.max_items_bulk = 4
+        ElasticSearch.bulk_workers = 3
+        try:
+            elastic = self.loop.run_until_complete(AsyncElasticSearch.create(self.url, 'test_async'))
+            inserted = self.loop.run_until_complete(elastic.bulk_upload(self.stub.items, "uuid"))
+            self.loop.run_until_complete(elastic.close())
+        finally:
+            ElasticSearch.max_items_bulk = max_items_bulk
+            ElasticSearch.bulk_workers = bulk_workers
+
+        self.assertEqual(inserted, 25)
+        self.assertEqual(self.stub.bulk_requests, 7)
+        self.assertEqual(sorted(self.stub.docs, key=int), [str(i) for i in range(25)])
+        self.assertEqual(self.stub.max_bulk_running, 3)
+
+    def test_bulk_upload_failed(self):
+        """Test that the docs rejected with 429 are sent again and the other failed ones reported"""
+
+        self.stub.rejected = {"3", "12"}
+        self.stub.invalid = {"5"}
+
+        max_items_bulk = ElasticSearch.max_items_bulk
+        retry_429_seconds = ElasticSearch.retry_429_seconds
+        ElasticSearch.max_items_bulk = 10
+        ElasticSearch.retry_429_seconds = 0
+        failed_ids = []
+        try:
+            elastic = self.loop.run_until_complete(AsyncElasticSearch.create(self.url, 'test_async'))
+            inserted = self.loop.run_until_complete(elastic.bulk_upload(self.stub.items, "uuid",
+                                                                        failed_ids))
+            self.loop.run_until_complete(elastic.close())
+        finally:
+            ElasticSearch.max_items_bulk = max_items_bulk
+            ElasticSearch.retry_429_seconds = retry_429_seconds
+
+        self.assertEqual(inserted, 24)
+        self.assertListEqual(failed_ids, ["5"])
+        self.assertNotIn("5", self.stub.docs)
+        self.assertIn("3", self.stub.docs)
+        self.assertIn("12", self.stub.docs)
+
+    def test_fetch_pages(self):
+        """Test that all the pages of a scroll are read and the scroll cleared"""
+
+        elastic = self.loop.run_until_complete(AsyncElasticSearch.create(self.url, 'test_async'))
+        try:
+            pages = self.loop.run_until_complete(read_pages(elastic, '{}', 10))
+        finally:
+            self.loop.run_until_complete(elastic.close())
+
+        self.assertEqual([len(page) for page in pages], [10, 10, 5])
+        self.assertEqual(pages[2][-1], {"uuid": "24"})
+        self.assertEqual(self.stub.scrolls_cleared, 1)
+
+    def test_enrich_items_async(self):
+        """Test that the raw items are read and the rich items written in the same loop"""
+
+        ocean_backend = RawBackend(IndexElasticSearch(self.url, 'test_raw'))
+        enrich_backend = RichBackend(IndexElasticSearch(self.url, 'test_enrich'))
+        enrich_backend.sortinghat = True
+
+        total = self.loop.run_until_complete(enrich_items_async(ocean_backend, enrich_backend))
+
+        self.assertEqual(total, 25)
+        self.assertEqual(sorted(self.stub.docs, key=int), [str(i) for i in range(25)])
+        self.assertTrue(all(doc['rich'] for doc in self.stub.docs.values()))
+        self.assertListEqual(enrich_backend.packs, [10, 10, 5, 0])
+        self.assertEqual(self.stub.scrolls_cleared, 1)
+
+    def test_enrich_items_async_read_ahead(self):
+        """Test that the next page is requested before the current one is enriched"""
+
+        scroll_ids = []
+        ocean_backend = RawBackend(IndexElasticSearch(self.url, 'test_raw'))
+        enrich_backend = RichBackend(IndexElasticSearch(self.url, 'test_enrich'), scroll_ids)
+
+        scroll = record_scrolls(AsyncElasticSearch.scroll, scroll_ids)
+        with mock.patch.object(AsyncElasticSearch, 'scroll', scroll):
+            total = self.loop.run_until_complete(enrich_items_async(ocean_backend, enrich_backend))
+
+        self.assertEqual(total, 25)
+        self.assertListEqual(scroll_ids, ["10", "20", "30"])
+        self.assertListEqual(enrich_backend.scrolls_started, [1] * 10 + [2] * 10 + [3] * 5)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    unittest.main()
@@ -21,6 +21,7 @@
 #     Jesus M. Gonzalez-Barahona <jgb@bitergia.com>
 #
 
+import json
 import logging
 import sys
 import unittest
@@ -30,7 +31,7 @@ import httpretty
 if '..' not in sys.path:
     sys.path.insert(0, '..')
 
-from grimoire_elk.elk.elastic import ElasticSearch, ElasticConnectException
+from grimoire_elk.elk.elastic import BulkWriter, ElasticSearch, ElasticConnectException
 
 
 class TestElasticSearch(unittest.TestCase):
@@ -86,6 +87,7 @@ class TestElasticSearch(unittest.TestCase):
     def tearDown(self):
 
         httpretty.disable()
+        httpretty.reset()
 
     def test_check_instance(self):
         """Test _check_instance function"""
@@ -98,6 +100,180 @@ class TestElasticSearch(unittest.TestCase):
         with self.assertRaises(ElasticConnectException):
             major = ElasticSearch._check_instance(self.url_es6_err, False)
 
+    def __bulk_items_callback(self, request, uri, headers):
+        """ Answer a bulk request with one created result per item """
+
+        body = request.body.decode('utf-8')
+        lines = [line for line in body.split('\n') if line]
+        actions = [json.loads(line) for line in lines[0::2]]
+        items = [{"index": {"_id": action["index"]["_id"], "status": 201}}
+                 for action in actions]
+        self.bulk_requests += 1
+        return (200, headers, json.dumps({"errors": False, "items": items}))
+
+    def __register_index(self, index):
+        url_index = self.url_es6 + '/' + index
+        httpretty.register_uri(httpretty.GET, url_index, body="{}")
+        httpretty.register_uri(httpretty.PUT, url_index + '/items/_bulk',
+                               body=self.__bulk_items_callback)
+        self.bulk_requests = 0
+
+    def test_bulk_upload(self):
+        """Test that items are uploaded in packs of max_items_bulk"""
+
+        self.__register_index('test_bulk')
+        elastic = ElasticSearch(self.url_es6, 'test_bulk')
+        elastic.max_items_bulk = 10
+
+        items = [{"uuid": str(i)} for i in range(55)]
+        inserted = elastic.bulk_upload(items, "uuid")
+        self.assertEqual(inserted, 55)
+        self.assertEqual(self.bulk_requests, 6)
+
+    def test_bulk_upload_parallel(self):
+        """Test that items are uploaded using several bulk workers"""
+
+        self.__register_index('test_bulk')
+        elastic = ElasticSearch(self.url_es6, 'test_bulk')
+        elastic.max_items_bulk = 10
+        elastic.bulk_workers = 3
+        elastic.bulk_queue_size = 1
+
+        items = (({"uuid": str(i)}) for i in range(95))
+        inserted = elastic.bulk_upload(items, "uuid")
+        self.assertEqual(inserted, 95)
+        self.assertEqual(self.bulk_requests, 10)
+
+    def test_bulk_upload_429(self):
+        """Test that a bulk rejected with 429 is sent again"""
+
+        url_index = self.url_es6 + '/test_bulk'
+        httpretty.register_uri(httpretty.GET, url_index, body="{}")
+        httpretty.register_uri(httpretty.PUT, url_index + '/items/_bulk',
+                               responses=[
+                                   httpretty.Response(body="{}", status=429),
+                                   httpretty.Response(body=self.__bulk_items_callback)
+                               ])
+        self.bulk_requests = 0
+
+        elastic = ElasticSearch(self.url_es6, 'test_bulk')
+        elastic.retry_429_seconds = 0
+
+        items = [{"uuid": str(i)} for i in range(5)]
+        inserted = elastic.bulk_upload(items, "uuid")
+        self.assertEqual(inserted, 5)
+        self.assertEqual(self.bulk_requests, 1)
+
+    def test_bulk_upload_sync(self):
+        """Test that the index is refreshed once after a sync upload"""
+
+        self.__register_index('test_bulk')
+        url_refresh = self.url_es6 + '/test_bulk/_refresh'
+        httpretty.register_uri(httpretty.POST, url_refresh, body="{}")
+        elastic = ElasticSearch(self.url_es6, 'test_bulk')
+        elastic.max_items_bulk = 10
+
+        items = [{"uuid": str(i)} for i in range(25)]
+        inserted = elastic.bulk_upload_sync(items, "uuid")
+        self.assertEqual(inserted, 25)
+        self.assertEqual(self.bulk_requests, 3)
+        self.assertEqual(httpretty.last_request().path, '/test_bulk/_refresh')
+        self.assertTrue(elastic.refresh_enabled)
+
+    def test_bulk_upload_sync_poll(self):
+        """Test that polling is used when the index can not be refreshed"""
+
+        self.__register_index('test_bulk')
+        url_refresh = self.url_es6 + '/test_bulk/_refresh'
+        httpretty.register_uri(httpretty.POST, url_refresh, status=403)
+        url_search = self.url_es6 + '/test_bulk/_search'
+        httpretty.register_uri(httpretty.GET, url_search,
+                               body=json.dumps({"hits": {"total": 10}}))
+        elastic = ElasticSearch(self.url_es6, 'test_bulk')
+        elastic.max_items_bulk = 10
+
+        items = [{"uuid": str(i)} for i in range(10)]
+        inserted = elastic.bulk_upload_sync(items, "uuid")
+        self.assertEqual(inserted, 10)
+        self.assertFalse(elastic.refresh_enabled)
+
+        elastic.wait_bulk_seconds = 0
+
+        items = [{"uuid": str(i)} for i in range(15)]
+        inserted = elastic.bulk_upload_sync(items, "uuid")
+        self.assertEqual(inserted, 15)
+        self.assertEqual(httpretty.last_request().path, '/test_bulk/items/_bulk')
+
+    def test_bulk_writer_bytes(self):
+        """Test that bulk packs are limited by size in bytes"""
+
+        self.__register_index('test_bulk')
+        elastic = ElasticSearch(self.url_es6, 'test_bulk')
+        elastic.max_items_bulk = 100
+        elastic.max_bulk_bytes = 1024
+
+        with BulkWriter(elastic) as writer:
+            for i in range(10):
+                writer.add(str(i), {"uuid": str(i), "body": "x" * 400})
+            # Only full packs have been sent yet
+            self.assertEqual(writer.total, 8)
+
+        self.assertEqual(writer.total, 10)
+        self.assertEqual(self.bulk_requests, 5)
+        self.assertGreater(writer.total_bytes, 4000)
+        self.assertLessEqual(len(httpretty.last_request().body), 1024)
+
+    def test_bulk_writer_retry_items(self):
+        """Test that the documents with transient errors are sent again one by one"""
+
+        def bulk_callback(request, uri, headers):
+            lines = request.body.decode('utf-8').strip().split('\n')
+            self.bulk_bodies.append(lines)
+            items = []
+            for action in lines[::2]:
+                doc_id = json.loads(action)['index']['_id']
+                if len(lines) > 2 and doc_id in ('1', '3'):
+                    items.append({"index": {"_id": doc_id, "status": 429,
+                                            "error": "es_rejected_execution_exception"}})
+                elif doc_id == '4':
+                    items.append({"index": {"_id": doc_id, "status": 400,
+                                            "error": "mapper_parsing_exception"}})
+                else:
+                    items.append({"index": {"_id": doc_id, "status": 201}})
+            errors = any('error' in item['index'] for item in items)
+            return (200, headers, json.dumps({"errors": errors, "items": items}))
+
+        url_index = self.url_es6 + '/test_bulk'
+        httpretty.register_uri(httpretty.GET, url_index, body="{}")
+        httpretty.register_uri(httpretty.PUT, url_index + '/items/_bulk', body=bulk_callback)
+        self.bulk_bodies = []
+        elastic = ElasticSearch(self.url_es6, 'test_bulk')
+        elastic.retry_429_seconds = 0
+
+        with BulkWriter(elastic) as writer:
+            for i in range(5):
+                writer.add(str(i), {"uuid": str(i)})
+
+        self.assertEqual(writer.total, 4)
+        self.assertEqual(writer.failed, 1)
+        self.assertListEqual(writer.failed_ids, ['4'])
+        self.assertEqual(len(self.bulk_bodies), 3)
+        self.assertEqual(json.loads(self.bulk_bodies[1][0])['index']['_id'], '1')
+        self.assertDictEqual(json.loads(self.bulk_bodies[2][1]), {"uuid": "3"})
+
+    def test_bulk_writer_unicode(self):
+        """Test that bulk packs are sent encoded in utf-8"""
+
+        self.__register_index('test_bulk')
+        elastic = ElasticSearch(self.url_es6, 'test_bulk')
+
+        with BulkWriter(elastic) as writer:
+            writer.add("\u00f1and\u00fa", {"name": "\u00d1and\u00fa \u4e2d"})
+
+        self.assertEqual(writer.total, 1)
+        body = httpretty.last_request().body.decode('utf-8')
+        self.assertTrue(body.startswith('{"index" : {"_id" : "\u00f1and\u00fa" } }\n'))
+
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+import json
+import logging
+import os
+import re
+import sys
+import unittest
+import warnings
+
+from dateutil import parser
+
+if '..' not in sys.path:
+    sys.path.insert(0, '..')
+
+from grimoire_elk.elk.utils import get_time_diff_days, parse_date, _parse_date_fast
+
+
+def get_strings(data):
+    """ Get all the strings in a JSON document """
+
+    if isinstance(data, dict):
+        for value in data.values():
+            yield from get_strings(value)
+    elif isinstance(data, list):
+        for value in data:
+            yield from get_strings(value)
+    elif isinstance(data, str):
+        yield data
+
+
+class TestParseDate(unittest.TestCase):
+    """Unit tests for the shared date parsing"""
+
+    def assertSameDate(self, date):
+        expected = parser.parse(date)
+        parsed = parse_date(date)
+        self.assertEqual(parsed, expected, date)
+        self.assertEqual(parsed.isoformat(), expected.isoformat(), date)
+        self.assertEqual(parsed.utcoffset(), expected.utcoffset(), date)
+
+    def test_fast_formats(self):
+        """Test that Perceval formats are parsed without dateutil and with its result"""
+
+        dates = ['2016-03-09', '2016-03-09T11:33', '2016-03-09T11:33:21',
+                 '2016-03-09 11:33:21', '2016-03-09T11:33:21.5', '2016-03-09T11:33:21.123456',
+                 '2016-03-09T11:33:21Z', '2016-03-09T11:33:21+00:00', '2016-03-09T11:33:21-0530',
+                 '2016-03-09T11:33:21+02', '2016-03-09 11:33:21 +0200',
+                 'Wed, 9 Mar 2016 11:33:21 +0100', '9 Mar 2016 11:33 -0000',
+                 'Wed Mar 9 11:33:21 2016 -0300', 'Wed Mar 09 11:33:21 2016 +0000']
+        for date in dates:
+            self.assertIsNotNone(_parse_date_fast(date), date)
+            self.assertSameDate(date)
+
+    def test_fallback(self):
+        """Test that other formats and wrong dates are parsed by dateutil"""
+
+        for date in ['7/17/2016 0:47:14', 'Tue, 14 Aug 2012 14:30:13 GMT',
+                     'Wed, 9 Mar 2016 11:33:21 +0100 (CET)', 'Wed Jul 20 11:04:00 +0000 2016']:
+            self.assertIsNone(_parse_date_fast(date), date)
+            self.assertSameDate(date)
+
+        with self.assertRaises(ValueError):
+            parse_date('2016-13-09T11:33:21')
+        with self.assertRaises(ValueError):
+            parse_date('not a date')
+
+    def test_data_dates(self):
+        """Test that all the dates in the test data are parsed as dateutil does"""
+
+        total = 0
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            for name in sorted(os.listdir('data')):
+                if not name.endswith('.json'):
+                    continue
+                with open(os.path.join('data', name)) as f:
+                    content = f.read()
+                try:
+                    data = json.loads(content)
+                except ValueError:
+                    data = [json.loads(line) for line in content.splitlines() if line.strip()]
+                for value in get_strings(data):
+                    if len(value) > 40 or ':' not in value or not re.search(r'\d{4}', value):
+                        continue
+                    try:
+                        parser.parse(value)
+                    except (ValueError, OverflowError):
+                        continue
+                    self.assertSameDate(value)
+                    total += 1
+        self.assertGreater(total, 1000)
+
+    def test_get_time_diff_days(self):
+        """Test the days between two dates"""
+
+        self.assertEqual(get_time_diff_days('2016-03-09T00:00:00Z', '2016-03-10T12:00:00+05:00'), 1.5)
+        self.assertIsNone(get_time_diff_days(None, '2016-03-10'))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    unittest.main()
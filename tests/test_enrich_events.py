@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+import logging
+import sys
+import unittest
+
+import httpretty
+
+if '..' not in sys.path:
+    sys.path.insert(0, '..')
+
+from grimoire_elk.elk.elastic import ElasticSearch
+from grimoire_elk.elk.mediawiki import MediaWikiEnrich
+from grimoire_elk.elk.phabricator import PhabricatorEnrich
+from grimoire_elk.metrics import metrics
+
+from enrich_helpers import ItemsBackend, read_items, register_index
+
+
+class PhabricatorItemsEnrich(PhabricatorEnrich):
+    """ Phabricator enrich whose items come from a list """
+
+    def get_connector_name(self):
+        return "phabricator"
+
+
+class MediaWikiItemsEnrich(MediaWikiEnrich):
+    """ MediaWiki enrich whose items come from a list """
+
+    def get_connector_name(self):
+        return "mediawiki"
+
+
+class TestEnrichEvents(unittest.TestCase):
+    """Unit tests for the enrichment engine of events"""
+
+    def setUp(self):
+        self.url = 'http://es6.com'
+
+        httpretty.enable()
+        self.bulk = register_index(self.url, 'events')
+
+    def tearDown(self):
+        httpretty.disable()
+        httpretty.reset()
+
+    def __get_enrich(self, enrich):
+        elastic = ElasticSearch(self.url, 'events')
+        elastic.max_items_bulk = 10
+        elastic.retry_429_seconds = 0
+        enrich.set_elastic(elastic)
+        return enrich
+
+    def test_events(self):
+        """Test that the events are written, retrying the rejected ones"""
+
+        enrich = self.__get_enrich(PhabricatorItemsEnrich())
+        items = read_items('phabricator')
+        for item in items:
+            # Events are only generated for transactions with author
+            item['data']['transactions'] = [t for t in item['data']['transactions'] if t['authorData']]
+        expected = [doc_id for item in items for doc_id, _ in enrich.get_rich_events_docs(item)]
+        self.assertGreater(len(expected), 10)
+        self.bulk.rejected = {expected[1], expected[12]}
+        self.bulk.invalid = {expected[5]}
+
+        metrics.reset()
+        inserted = enrich.enrich_events(ItemsBackend(items))
+        self.assertEqual(inserted, len(expected) - 1)
+        self.assertSetEqual(set(self.bulk.docs_by_id), set(expected) - self.bulk.invalid)
+        self.assertLessEqual(max(self.bulk.sizes), 10)
+
+        counters = {counter['name']: counter['value'] for counter in metrics.to_json()['counters']}
+        self.assertEqual(counters['docs_failed_total'], 1)
+
+    def test_reviews(self):
+        """Test that the MediaWiki revisions are written with the engine"""
+
+        enrich = self.__get_enrich(MediaWikiItemsEnrich())
+        items = read_items('mediawiki')
+
+        nitems = enrich.enrich_events(ItemsBackend(items))
+        self.assertEqual(nitems, len(items))
+        revids = set(rev['revid'] for item in items for rev in item['data']['revisions'])
+        self.assertSetEqual(set(int(doc_id) for doc_id in self.bulk.docs_by_id), revids)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    unittest.main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+import json
+import logging
+import sys
+import unittest
+
+import httpretty
+
+if '..' not in sys.path:
+    sys.path.insert(0, '..')
+
+from grimoire_elk.elk.elastic import ElasticSearch
+from grimoire_elk.elk.git import GitEnrich
+
+
+class TestGitDemography(unittest.TestCase):
+    """Unit tests for the demography study of git"""
+
+    def setUp(self):
+        self.url = 'http://es6.com'
+        self.index_url = self.url + '/git_enrich'
+        self.commits = {}
+        for i, (author, date) in enumerate([("A", "2015-01-01"), ("B", "2016-01-01"), ("A", "2017-01-01"),
+                                            ("C", "2014-01-01"), ("B", "2012-01-01"), ("D", "1970-01-01")]):
+            self.commits[str(i)] = {"Author": author, "utc_commit": date + "T00:00:00.000Z",
+                                    "grimoire_creation_date": date + "T00:00:00"}
+        self.version = "6.1.0"
+        self.searches = []
+        self.updates = []
+
+        httpretty.enable()
+        httpretty.register_uri(httpretty.GET, self.url, body=self.__version_callback)
+        httpretty.register_uri(httpretty.GET, self.index_url, body="{}")
+        httpretty.register_uri(httpretty.POST, self.index_url + '/_refresh', body="{}")
+        httpretty.register_uri(httpretty.POST, self.index_url + '/_search', body=self.__search_callback)
+        httpretty.register_uri(httpretty.POST, self.url + '/_search/scroll',
+                               body=json.dumps({"_scroll_id": "2", "hits": {"hits": []}}))
+        httpretty.register_uri(httpretty.DELETE, self.url + '/_search/scroll', body="{}")
+        httpretty.register_uri(httpretty.PUT, self.index_url + '/items/_bulk', body=self.__bulk_callback)
+
+    def tearDown(self):
+        httpretty.disable()
+        httpretty.reset()
+
+    def __version_callback(self, request, uri, headers):
+        return (200, headers, json.dumps({"version": {"number": self.version}}))
+
+    def __matches(self, commit, query):
+        for clause in query.get('bool', {}).get('must', []) + [query]:
+            if 'range' in clause and commit['grimoire_creation_date'] < '1980-01-01':
+                return False
+            if 'terms' in clause and commit['Author'] not in clause['terms']['Author']:
+                return False
+        must_not = query.get('bool', {}).get('must_not', [])
+        if must_not and 'author_min_date' in commit and 'author_max_date' in commit:
+            return False
+        return True
+
+    def __search_callback(self, request, uri, headers):
+        query = json.loads(request.body.decode('utf-8'))
+        self.searches.append(query)
+        commits = {cid: commit for cid, commit in self.commits.items() if self.__matches(commit, query['query'])}
+
+        if 'scroll' in uri:
+            hits = [{"_id": cid, "_source": {field: commit[field] for field in query['_source'] if field in commit}}
+                    for cid, commit in commits.items()]
+            return (200, headers, json.dumps({"_scroll_id": "1", "hits": {"hits": hits}}))
+
+        agg = query['aggs']['author']
+        authors = sorted(set(commit['Author'] for commit in commits.values()))
+        if 'composite' in agg:
+            if self.version < "6.1":
+                return (400, headers, json.dumps({"error": "unknown aggregation type [composite]"}))
+            after = agg['composite'].get('after', {}).get('author', '')
+            authors = [author for author in authors if author > after][:agg['composite']['size']]
+            response = {"buckets": [{"key": {"author": author}} for author in authors]}
+            if authors:
+                response['after_key'] = {"author": authors[-1]}
+            return (200, headers, json.dumps({"aggregations": {"author": response}}))
+
+        buckets = []
+        for author in authors:
+            dates = [commit['utc_commit'] for commit in commits.values() if commit['Author'] == author]
+            buckets.append({"key": author, "min": {"value_as_string": min(dates)},
+                            "max": {"value_as_string": max(dates)}})
+        return (200, headers, json.dumps({"aggregations": {"author": {"buckets": buckets}}}))
+
+    def __bulk_callback(self, request, uri, headers):
+        lines = [line for line in request.body.decode('utf-8').split('\n') if line]
+        items = []
+        for action, doc in zip(lines[0::2], lines[1::2]):
+            cid = json.loads(action)["update"]["_id"]
+            self.commits[cid].update(json.loads(doc)["doc"])
+            self.updates.append(cid)
+            items.append({"update": {"_id": cid, "status": 200}})
+        return (200, headers, json.dumps({"errors": False, "items": items}))
+
+    def run_demography(self, no_incremental=False):
+        enrich = GitEnrich()
+        enrich.demography_authors_page = 2
+        enrich.set_elastic(ElasticSearch(self.url, 'git_enrich'))
+        enrich.enrich_demography(None, no_incremental)
+
+    def assertDemography(self):
+        expected = {"A": ("2015", "2017"), "B": ("2012", "2016"), "C": ("2014", "2014")}
+        for commit in self.commits.values():
+            if commit['Author'] == "D":
+                self.assertNotIn('author_min_date', commit)
+                continue
+            min_year, max_year = expected[commit['Author']]
+            self.assertEqual(commit['author_min_date'], min_year + "-01-01T00:00:00.000Z")
+            self.assertEqual(commit['author_max_date'], max_year + "-01-01T00:00:00.000Z")
+
+    def test_demography(self):
+        """Test that the authors are paged and only changed commits are updated"""
+
+        self.run_demography()
+        self.assertDemography()
+        self.assertEqual(sorted(self.updates), ["0", "1", "2", "3", "4"])
+        composite = [query for query in self.searches if 'composite' in query.get('aggs', {}).get('author', {})]
+        self.assertEqual(len(composite), 2)
+
+        # New commit of B: only the commits of B are updated
+        self.updates = []
+        self.commits["6"] = {"Author": "B", "utc_commit": "2018-01-01T00:00:00.000Z",
+                             "grimoire_creation_date": "2018-01-01T00:00:00"}
+        self.run_demography()
+        self.assertEqual(sorted(self.updates), ["1", "4", "6"])
+        self.assertEqual(self.commits["4"]['author_max_date'], "2018-01-01T00:00:00.000Z")
+
+        # Nothing changed even if all the authors are processed
+        self.updates = []
+        self.run_demography(no_incremental=True)
+        self.assertEqual(self.updates, [])
+
+    def test_demography_no_composite(self):
+        """Test that the authors are got with a terms aggregation without composite"""
+
+        self.version = "6.0.0"
+        self.run_demography()
+        self.assertDemography()
+        self.assertEqual(sorted(self.updates), ["0", "1", "2", "3", "4"])
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    unittest.main()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+import json
+import logging
+import sys
+import unittest
+import urllib.parse
+
+from datetime import datetime
+
+import httpretty
+
+if '..' not in sys.path:
+    sys.path.insert(0, '..')
+
+from grimoire_elk.elk.elastic import ElasticSearch
+from grimoire_elk.elk.github import GitHubEnrich
+
+
+MAPS_URL = 'http://maps.com/maps/api/geocode/json'
+
+
+class TestGitHubGeolocations(unittest.TestCase):
+    """Unit tests for the geolocations cache of GitHubEnrich"""
+
+    def setUp(self):
+        self.url = 'http://es6.com'
+        self.cached = [{"location": "Madrid", "lat": 40.4, "lon": -3.7},
+                       {"location": "Nowhere", "not_found": True,
+                        "not_found_on": datetime.utcnow().isoformat()},
+                       {"location": "Oldtown", "not_found": True,
+                        "not_found_on": "2017-01-01T00:00:00"},
+                       {"location": "Unknown", "not_found": True}]
+        self.geocoded = {"Vigo": {"lat": 42.2, "lng": -8.7}}
+        self.over_limit = {"Lugo"}  # locations failing with a quota error
+        self.maps_requests = []
+        self.bulk_docs = {}
+        self.scrolls_cleared = []
+
+        httpretty.enable()
+        httpretty.register_uri(httpretty.GET, self.url,
+                               body=json.dumps({"version": {"number": "6.1.0"}}))
+        httpretty.register_uri(httpretty.GET, self.url + '/github_enrich', body="{}")
+        httpretty.register_uri(httpretty.POST, self.url + '/github/geolocations/_search',
+                               body=self.__search_callback)
+        httpretty.register_uri(httpretty.POST, self.url + '/_search/scroll',
+                               body=json.dumps({"_scroll_id": "2", "hits": {"hits": []}}))
+        httpretty.register_uri(httpretty.DELETE, self.url + '/_search/scroll',
+                               body=self.__clear_scroll_callback)
+        httpretty.register_uri(httpretty.PUT, self.url + '/github/geolocations/_bulk',
+                               body=self.__bulk_callback)
+        httpretty.register_uri(httpretty.GET, MAPS_URL, body=self.__maps_callback)
+
+        self.enrich = GitHubEnrich()
+        self.enrich.maps_api_url = MAPS_URL
+        self.enrich.set_elastic(ElasticSearch(self.url, 'github_enrich'))
+
+    def tearDown(self):
+        httpretty.disable()
+        httpretty.reset()
+
+    def __search_callback(self, request, uri, headers):
+        hits = [{"_source": location} for location in self.cached]
+        return (200, headers, json.dumps({"_scroll_id": "1", "hits": {"hits": hits}}))
+
+    def __clear_scroll_callback(self, request, uri, headers):
+        self.scrolls_cleared.extend(json.loads(request.body.decode('utf-8'))['scroll_id'])
+        return (200, headers, json.dumps({"succeeded": True}))
+
+    def __maps_callback(self, request, uri, headers):
+        address = urllib.parse.parse_qs(urllib.parse.urlparse(uri).query)['address'][0]
+        self.maps_requests.append(address)
+        results = []
+        status = "ZERO_RESULTS"
+        if address in self.geocoded:
+            results = [{"geometry": {"location": self.geocoded[address]}}]
+            status = "OK"
+        elif address in self.over_limit:
+            status = "OVER_QUERY_LIMIT"
+        return (200, headers, json.dumps({"results": results, "status": status}))
+
+    def __bulk_callback(self, request, uri, headers):
+        lines = [line for line in request.body.decode('utf-8').split('\n') if line]
+        items = []
+        for action, doc in zip(lines[0::2], lines[1::2]):
+            doc_id = json.loads(action)["index"]["_id"]
+            self.bulk_docs[doc_id] = json.loads(doc)
+            items.append({"index": {"_id": doc_id, "status": 201}})
+        return (200, headers, json.dumps({"errors": False, "items": items}))
+
+    def test_preload(self):
+        """Test that the cache, including recent not found locations, is read with a scroll"""
+
+        self.assertListEqual(list(self.enrich.geolocations), ["Madrid"])
+        self.assertSetEqual(self.enrich.location_not_found, {"Nowhere"})
+        self.assertListEqual(self.scrolls_cleared, ["2"])
+
+    def test_get_geo_point(self):
+        """Test that the maps API is used only for unknown locations"""
+
+        self.assertDictEqual(self.enrich.get_geo_point("Madrid"), {"lat": 40.4, "lon": -3.7})
+        self.assertIsNone(self.enrich.get_geo_point("Nowhere"))
+        self.assertDictEqual(self.enrich.get_geo_point("Vigo"), {"lat": 42.2, "lon": -8.7})
+        self.assertIsNone(self.enrich.get_geo_point("Atlantis"))
+        self.assertIsNone(self.enrich.get_geo_point("Atlantis"))
+        self.assertListEqual(self.maps_requests, ["Vigo", "Atlantis"])
+
+        # Expired not found locations and errors are looked for again
+        self.assertIsNone(self.enrich.get_geo_point("Oldtown"))
+        self.assertIsNone(self.enrich.get_geo_point("Lugo"))
+        self.assertIsNone(self.enrich.get_geo_point("Lugo"))
+        self.assertListEqual(self.maps_requests[2:], ["Oldtown", "Lugo", "Lugo"])
+        self.assertNotIn("Lugo", self.enrich.location_not_found)
+
+    def test_geo_locations_to_es(self):
+        """Test that only the new locations are written to the cache"""
+
+        self.enrich.get_geo_point("Madrid")
+        self.enrich.get_geo_point("Vigo")
+        self.enrich.get_geo_point("Atlantis")
+        self.enrich.get_geo_point("Lugo")
+        self.enrich.geo_locations_to_es()
+
+        self.assertIn("not_found_on", self.bulk_docs["not_found-Atlantis"])
+        self.bulk_docs["not_found-Atlantis"].pop("not_found_on")
+        self.assertDictEqual(self.bulk_docs, {
+            "42.2--8.7-Vigo": {"lat": 42.2, "lon": -8.7, "location": "Vigo"},
+            "not_found-Atlantis": {"location": "Atlantis", "not_found": True}
+        })
+
+        self.bulk_docs = {}
+        self.enrich.geo_locations_to_es()
+        self.assertDictEqual(self.bulk_docs, {})
+
+    def test_location_found_after_not_found(self):
+        """Test that a location found after being not found keeps its geo point"""
+
+        self.geocoded["Oldtown"] = {"lat": 43.0, "lng": -7.5}
+        self.assertDictEqual(self.enrich.get_geo_point("Oldtown"), {"lat": 43.0, "lon": -7.5})
+        self.enrich.geo_locations_to_es()
+        self.assertIn("43.0--7.5-Oldtown", self.bulk_docs)
+
+        # The cache has both entries, the not found one read last
+        self.cached.insert(0, self.bulk_docs["43.0--7.5-Oldtown"])
+        self.cached.append({"location": "Oldtown", "not_found": True,
+                            "not_found_on": datetime.utcnow().isoformat()})
+        self.enrich.set_elastic(ElasticSearch(self.url, 'github_enrich'))
+
+        self.assertNotIn("Oldtown", self.enrich.location_not_found)
+        self.assertDictEqual(self.enrich.get_geo_point("Oldtown"), {"lat": 43.0, "lon": -7.5})
+        self.assertListEqual(self.maps_requests, ["Oldtown"])
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+import logging
+import sys
+import unittest
+
+import httpretty
+
+if '..' not in sys.path:
+    sys.path.insert(0, '..')
+
+from grimoire_elk.elk.elastic import ElasticSearch
+from grimoire_elk.elk.meetup import MeetupEnrich
+
+from enrich_helpers import ItemsBackend, read_items, register_index
+
+
+class MeetupItemsEnrich(MeetupEnrich):
+    """ Meetup enrich whose items come from a list """
+
+    def get_connector_name(self):
+        return "meetup"
+
+
+class TestMeetupEnrich(unittest.TestCase):
+    """Unit tests for the enrichment of Meetup events, comments and rsvps"""
+
+    def setUp(self):
+        self.url = 'http://es6.com'
+
+        httpretty.enable()
+        self.bulk = register_index(self.url, 'meetup_enrich')
+
+        self.items = read_items('meetup')
+
+    def tearDown(self):
+        httpretty.disable()
+        httpretty.reset()
+
+    def test_enrich_items(self):
+        """Test that events, comments and rsvps are written reading the items once"""
+
+        enrich = MeetupItemsEnrich()
+        elastic = ElasticSearch(self.url, 'meetup_enrich')
+        elastic.max_items_bulk = 5
+        enrich.set_elastic(elastic)
+
+        ocean_backend = ItemsBackend(self.items)
+        self.assertEqual(enrich.enrich_items(ocean_backend), len(self.items))
+        self.assertEqual(ocean_backend.fetches, 1)
+
+        expected = set(item['uuid'] for item in self.items)
+        for item in self.items:
+            expected.update(str(comment['id']) for comment in enrich.get_rich_item_comments(item))
+            expected.update(str(rsvp['id']) for rsvp in enrich.get_rich_item_rsvps(item))
+        bulk_docs = self.bulk.docs_by_id
+        self.assertSetEqual(set(bulk_docs), expected)
+        self.assertLessEqual(max(self.bulk.sizes), 5)
+
+        kinds = set(doc['type'] for doc in bulk_docs.values() if 'type' in doc)
+        self.assertSetEqual(kinds, {"meetup", "comment", "rsvp"})
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    unittest.main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import unittest
+
+if '..' not in sys.path:
+    sys.path.insert(0, '..')
+
+from grimoire_elk.elk.enrich import Enrich, DEFAULT_PROJECT
+
+
+class GitProjectsEnrich(Enrich):
+    """ Enrich for git items whose repository is the origin """
+
+    def get_connector_name(self):
+        return "git"
+
+    def get_project_repository(self, eitem):
+        return eitem['repository']
+
+
+def find_project(prjs_map, ds_name, repository, origin):
+    """ Project of an item found scanning all the repositories """
+
+    if repository in prjs_map[ds_name]:
+        return prjs_map[ds_name][repository]
+    if origin in prjs_map[ds_name]:
+        return prjs_map[ds_name][origin]
+    for ds_repo in prjs_map[ds_name]:
+        if origin in str(ds_repo):
+            return prjs_map[ds_name][ds_repo]
+    return DEFAULT_PROJECT
+
+
+class TestEnrichProjects(unittest.TestCase):
+    """Unit tests for the projects of the enriched items"""
+
+    def setUp(self):
+        random.seed(1)
+        projects = {}
+        for i in range(200):
+            project = "eclipse.project%i" % (i % 40)
+            if i % 3 == 0:
+                project += ".sub%i" % i
+            repos = ["https://git.eclipse.org/r/project%i/repo%i.git" % (i % 40, j)
+                     for j in range(random.randint(1, 5))]
+            projects[project] = {"git": repos, "meta": {"title": project}}
+        projects["other"] = {"git": ["https://github.com/other/repo"],
+                             "gerrit": ["git.eclipse.org_project1"]}
+
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+            json.dump(projects, f)
+            self.projects_file = f.name
+        self.enrich = GitProjectsEnrich(json_projects_map=self.projects_file)
+
+    def tearDown(self):
+        os.remove(self.projects_file)
+
+    def test_get_item_project(self):
+        """Test that the project found is the one of the first repository containing the origin"""
+
+        origins = ["https://git.eclipse.org/r/project%i/repo%i" % (i, j)
+                   for i in range(45) for j in range(6)]
+        origins += ["https://github.com/other/repo", "repo1.git", "project3", "", "not\nfound"]
+
+        cached = []
+        for _ in range(2):
+            for origin in origins:
+                eitem = {"origin": origin, "repository": origin + ".git"}
+                project = self.enrich.get_item_project(eitem)['project']
+                self.assertEqual(project, find_project(self.enrich.prjs_map, "git",
+                                                       eitem['repository'], origin), origin)
+            cached.append(len(self.enrich.prjs_origin_cache))
+        self.assertGreater(cached[0], 0)
+        self.assertEqual(cached[0], cached[1])
+
+    def test_map_changed(self):
+        """Test that the index is rebuilt when the map is replaced"""
+
+        eitem = {"origin": "new/repo", "repository": None}
+        self.assertEqual(self.enrich.get_item_project(eitem)['project'], DEFAULT_PROJECT)
+
+        self.enrich.prjs_map = {"git": {"https://github.com/new/repo.git": "new"}}
+        self.assertEqual(self.enrich.get_item_project(eitem)['project'], "new")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    unittest.main()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from concurrent.futures.process import BrokenProcessPool
+
+import httpretty
+
+try:
+    import sqlalchemy
+    from sqlalchemy.pool import QueuePool
+    SQLALCHEMY_LIBS = True
+except ImportError:
+    SQLALCHEMY_LIBS = False
+
+if '..' not in sys.path:
+    sys.path.insert(0, '..')
+
+from grimoire_elk.elk.elastic import ElasticSearch
+from grimoire_elk.elk.jenkins import JenkinsEnrich
+
+from enrich_helpers import ItemsBackend, read_items, register_index
+
+
+class JenkinsItemsEnrich(JenkinsEnrich):
+    """ Jenkins enrich whose items come from a list """
+
+    def get_connector_name(self):
+        return "jenkins"
+
+
+class JenkinsDyingEnrich(JenkinsItemsEnrich):
+    """ Jenkins enrich whose process dies enriching an item """
+
+    dying_uuid = None
+
+    def get_rich_item(self, item):
+        if item['uuid'] == self.dying_uuid:
+            os._exit(1)
+        return super().get_rich_item(item)
+
+
+class SortingHatDatabase(object):
+    """ SortingHat database with only its SQLAlchemy engine """
+
+    def __init__(self, path):
+        self._engine = sqlalchemy.create_engine('sqlite:///' + path, poolclass=QueuePool)
+
+
+class JenkinsSortingHatEnrich(JenkinsItemsEnrich):
+    """ Jenkins enrich using SortingHat connections
+
+    The rich items include the connections to SortingHat available in the
+    pool of the process which computed them.
+    """
+
+    def resolve_sh_identities(self, items):
+        super().resolve_sh_identities([])
+        if items:
+            # Query SortingHat, leaving the connection in the pool
+            with self.sh_db._engine.connect() as conn:
+                conn.execute("SELECT 1")
+
+    def get_rich_item(self, item):
+        eitem = super().get_rich_item(item)
+        eitem['sh_connections'] = self.sh_db._engine.pool.checkedin()
+        return eitem
+
+
+class TestEnrichWorkers(unittest.TestCase):
+    """Unit tests for the enrichment with several processes"""
+
+    def setUp(self):
+        self.url = 'http://es6.com'
+
+        httpretty.enable()
+        self.bulk = register_index(self.url, 'jenkins_enrich')
+
+        items = read_items('jenkins')
+        self.items = [dict(item, uuid="%s-%i" % (item['uuid'], i)) for i in range(5) for item in items]
+
+    def tearDown(self):
+        httpretty.disable()
+        httpretty.reset()
+
+    def bulk_docs(self):
+        """ Documents stored, without the enrichment date """
+
+        docs = []
+        for doc_id, doc in self.bulk.docs:
+            doc = dict(doc)
+            doc.pop('metadata__enriched_on')
+            docs.append((doc_id, doc))
+        return docs
+
+    def enrich(self, workers, enrich_class=JenkinsItemsEnrich, sh_db=None):
+        enrich = enrich_class()
+        enrich.enrich_workers = workers
+        if sh_db:
+            enrich.sortinghat = True
+            enrich.sh_db = sh_db
+        elastic = ElasticSearch(self.url, 'jenkins_enrich')
+        elastic.max_items_bulk = 7
+        enrich.set_elastic(elastic)
+        return enrich.enrich_items(ItemsBackend(self.items))
+
+    def test_enrich_workers(self):
+        """Test that the rich items are the same, in the same order, with several processes"""
+
+        self.assertEqual(self.enrich(1), len(self.items))
+        expected = self.bulk_docs()
+        self.bulk.docs = []
+
+        self.assertEqual(self.enrich(3), len(self.items))
+        bulk_docs = self.bulk_docs()
+        self.assertEqual([doc_id for doc_id, _ in bulk_docs], [item['uuid'] for item in self.items])
+        self.assertListEqual(bulk_docs, expected)
+        self.assertIn('metadata__gelk_backend_name', bulk_docs[0][1])
+
+    def test_enrich_workers_dead(self):
+        """Test that the enrichment fails if a process dies"""
+
+        JenkinsDyingEnrich.dying_uuid = self.items[10]['uuid']
+        with self.assertRaises(BrokenProcessPool):
+            self.enrich(3, JenkinsDyingEnrich)
+        self.assertLessEqual(len(self.bulk.docs), 7)
+
+    @unittest.skipIf(not SQLALCHEMY_LIBS, "SQLAlchemy not available")
+    def test_enrich_workers_sortinghat(self):
+        """Test that the processes don't share the SortingHat connections"""
+
+        tmp_path = tempfile.mkdtemp(prefix='gelk_')
+        try:
+            sh_db = SortingHatDatabase(os.path.join(tmp_path, 'sh.db'))
+            self.assertEqual(self.enrich(3, JenkinsSortingHatEnrich, sh_db), len(self.items))
+
+            # The connections of this process are still usable
+            with sh_db._engine.connect() as conn:
+                self.assertEqual(conn.execute("SELECT 1").scalar(), 1)
+        finally:
+            shutil.rmtree(tmp_path)
+
+        self.assertEqual(len(self.bulk.docs), len(self.items))
+        self.assertSetEqual({doc['sh_connections'] for _, doc in self.bulk.docs}, {0})
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    unittest.main()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import requests
+
+if '..' not in sys.path:
+    sys.path.insert(0, '..')
+
+from grimoire_elk.elk.git import GitEnrich
+from grimoire_elk.elk.github_logins import GitHubLoginsCache, GitHubLoginsResolver
+
+
+class StubGitHubServer(ThreadingMixIn, HTTPServer):
+    """ GitHub API server returning the commits of a dict """
+
+    daemon_threads = True
+
+    def __init__(self, commits):
+        super().__init__(('127.0.0.1', 0), StubGitHubHandler)
+        self.commits = commits
+        self.requests = []
+        self.rate_limit = 5000
+        self.rate_limit_reset = int(time.time()) - 1
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%i' % self.server_address[1]
+
+
+class StubGitHubHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+            server.rate_limit = max(server.rate_limit - 1, 0)
+            remaining = server.rate_limit
+        commit = server.commits.get(self.path.split('/')[-1])
+        status = 200 if commit is not None else 404
+        body = json.dumps(commit if commit is not None else {"message": "Not Found"}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('X-RateLimit-Remaining', str(remaining))
+        self.send_header('X-RateLimit-Reset', str(server.rate_limit_reset))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestGitHubLogins(unittest.TestCase):
+    """Unit tests for the GitHub logins cache and resolver"""
+
+    def setUp(self):
+        self.commits = {
+            "c1": {"author": {"login": "jsmith"}, "committer": {"login": "jdoe"}},
+            "c2": {"author": None, "committer": {"login": "jdoe"}},
+            "c3": {"author": {"login": "bot"}, "committer": None}
+        }
+        self.server = StubGitHubServer(self.commits)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.tmp_path = tempfile.mkdtemp(prefix='gelk_')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.tmp_path)
+
+    def test_get_commits(self):
+        """Test that commits are read concurrently and only once"""
+
+        resolver = GitHubLoginsResolver(requests.Session(), 'token', self.server.url, workers=3)
+        commits = [("owner/repo", "c1"), ("owner/repo", "c2"), ("owner/repo", "c1"),
+                   ("owner/repo", "c3"), ("owner/repo", "c4")]
+        jsons = resolver.get_commits(commits)
+
+        self.assertEqual(len(self.server.requests), 4)
+        self.assertIsNone(jsons[("owner/repo", "c4")])
+        self.assertEqual(GitHubLoginsResolver.get_login(jsons[("owner/repo", "c1")], 'author'), 'jsmith')
+        self.assertIsNone(GitHubLoginsResolver.get_login(jsons[("owner/repo", "c2")], 'author'))
+        self.assertEqual(resolver.rate_limit, 4996)
+
+    def test_rate_limit(self):
+        """Test that requests go on once the rate limit is reset"""
+
+        self.server.rate_limit = 2
+        resolver = GitHubLoginsResolver(requests.Session(), 'token', self.server.url,
+                                        min_rate_to_sleep=1)
+        jsons = resolver.get_commits([("owner/repo", "c1"), ("owner/repo", "c2"), ("owner/repo", "c3")])
+
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertNotIn(None, jsons.values())
+
+    def test_rate_limit_deferred(self):
+        """Test that commits are not read, without waiting, until the rate limit is reset"""
+
+        self.server.rate_limit = 2
+        self.server.rate_limit_reset = int(time.time()) + 3600
+        resolver = GitHubLoginsResolver(requests.Session(), 'token', self.server.url,
+                                        min_rate_to_sleep=1)
+
+        start = time.time()
+        jsons = resolver.get_commits([("owner/repo", "c1"), ("owner/repo", "c2"), ("owner/repo", "c3")])
+        self.assertLess(time.time() - start, 60)
+
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertIsNotNone(jsons[("owner/repo", "c1")])
+        self.assertIsNone(jsons[("owner/repo", "c2")])
+        self.assertIsNone(jsons[("owner/repo", "c3")])
+        self.assertEqual(resolver.deferred, 2)
+
+        # Once the rate limit is reset the commits are read
+        self.server.rate_limit = 5000
+        resolver.rate_limit_reset_ts = int(time.time()) - 1
+        jsons = resolver.get_commits([("owner/repo", "c2"), ("owner/repo", "c3")])
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertNotIn(None, jsons.values())
+
+    def test_cache(self):
+        """Test that logins, also missing ones, are kept in a file until they expire"""
+
+        cache_file = os.path.join(self.tmp_path, 'logins.json')
+        cache = GitHubLoginsCache(cache_file)
+        cache['John Smith <jsmith@example.com>'] = 'jsmith'
+        cache['Bot <bot@example.com>'] = None
+        cache.save()
+
+        cache = GitHubLoginsCache(cache_file)
+        self.assertEqual(cache['John Smith <jsmith@example.com>'], 'jsmith')
+        self.assertIn('Bot <bot@example.com>', cache)
+        self.assertIsNone(cache['Bot <bot@example.com>'])
+
+        cache.negative_ttl = 0
+        self.assertNotIn('Bot <bot@example.com>', cache)
+        with self.assertRaises(KeyError):
+            cache['Bot <bot@example.com>']
+        self.assertIn('John Smith <jsmith@example.com>', cache)
+
+    def test_prefetch_identities(self):
+        """Test that git enrich gets the logins of a pack of commits at once"""
+
+        cache_file = os.path.join(self.tmp_path, 'logins.json')
+        enrich = GitEnrich()
+        enrich.github_logins.cache_file = cache_file
+        enrich.set_github_token('token')
+        enrich.github_resolver.api_url = self.server.url
+        enrich.github_resolver.workers = 2
+
+        items = []
+        for commit, author, committer in [("c1", "John Smith <jsmith@example.com>", "Jane Doe <jdoe@example.com>"),
+                                          ("c2", "Unknown <unknown@example.com>", "Jane Doe <jdoe@example.com>"),
+                                          ("c3", "Bot <bot@example.com>", "Bot <bot@example.com>")]:
+            items.append({"origin": "https://github.com/owner/repo.git",
+                          "data": {"commit": commit, "Author": author, "Commit": committer}})
+        enrich.prefetch_identities(items)
+
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(enrich.github_logins["John Smith <jsmith@example.com>"], "jsmith")
+        self.assertEqual(enrich.github_logins["Jane Doe <jdoe@example.com>"], "jdoe")
+        self.assertIsNone(enrich.github_logins["Unknown <unknown@example.com>"])
+        self.assertEqual(enrich.github_logins["Bot <bot@example.com>"], "bot")
+
+        login = enrich.get_github_login("John Smith <jsmith@example.com>", "author", "c1", "owner/repo")
+        self.assertEqual(login, "jsmith")
+        self.assertEqual(len(self.server.requests), 3)
+
+        # The cache is saved every save_every logins, not after each pack
+        self.assertFalse(os.path.exists(cache_file))
+        enrich.github_logins.save()
+        self.assertEqual(len(GitHubLoginsCache(cache_file)), 4)
+
+    def test_prefetch_identities_rate_limit(self):
+        """Test that the users of the commits not read by the rate limit are resolved later"""
+
+        self.server.rate_limit = 1
+        self.server.rate_limit_reset = int(time.time()) + 3600
+        enrich = GitEnrich()
+        enrich.set_github_token('token')
+        enrich.github_resolver.api_url = self.server.url
+        enrich.github_resolver.min_rate_to_sleep = 0
+
+        items = [{"origin": "https://github.com/owner/repo.git",
+                  "data": {"commit": commit, "Author": author, "Commit": None}}
+                 for commit, author in [("c1", "John Smith <jsmith@example.com>"),
+                                        ("c3", "Bot <bot@example.com>")]]
+        enrich.prefetch_identities(items)
+
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(enrich.github_logins["John Smith <jsmith@example.com>"], "jsmith")
+        self.assertNotIn("Bot <bot@example.com>", enrich.github_logins)
+
+        # Next pack, once the rate limit is reset
+        self.server.rate_limit = 5000
+        enrich.github_resolver.rate_limit_reset_ts = int(time.time()) - 1
+        enrich.prefetch_identities(items)
+
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(enrich.github_logins["Bot <bot@example.com>"], "bot")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    unittest.main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import httpretty
+
+if '..' not in sys.path:
+    sys.path.insert(0, '..')
+
+from grimoire_elk.elk.elastic import ElasticSearch
+from grimoire_elk.metrics import Metrics, metrics
+
+
+class TestMetrics(unittest.TestCase):
+    """Unit tests for the metrics of the stages"""
+
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp(prefix='gelk_')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+    def test_prometheus(self):
+        """Test the export of counters and histograms in Prometheus text format"""
+
+        stage_metrics = Metrics(buckets=(0.1, 1.0, float('inf')))
+        stage_metrics.inc('items_enriched_total', 10, backend="git")
+        stage_metrics.inc('items_enriched_total', 5, backend="git")
+        stage_metrics.inc('items_enriched_total', backend='say "hi"')
+        stage_metrics.observe('stage_seconds', 0.05, stage="enrich_items")
+        stage_metrics.observe('stage_seconds', 0.5, stage="enrich_items")
+        stage_metrics.observe('stage_seconds', 5, stage="enrich_items")
+
+        self.assertEqual(stage_metrics.to_prometheus(), "\n".join([
+            '# TYPE gelk_items_enriched_total counter',
+            'gelk_items_enriched_total{backend="git"} 15',
+            'gelk_items_enriched_total{backend="say \\"hi\\""} 1',
+            '# TYPE gelk_stage_seconds histogram',
+            'gelk_stage_seconds_bucket{stage="enrich_items",le="0.1"} 1',
+            'gelk_stage_seconds_bucket{stage="enrich_items",le="1.0"} 2',
+            'gelk_stage_seconds_bucket{stage="enrich_items",le="+Inf"} 3',
+            'gelk_stage_seconds_sum{stage="enrich_items"} 5.55',
+            'gelk_stage_seconds_count{stage="enrich_items"} 3'
+        ]) + "\n")
+
+    def test_save_json(self):
+        """Test that the metrics are saved as JSON"""
+
+        stage_metrics = Metrics()
+        stage_metrics.inc('bulk_requests_total', index="git")
+        with stage_metrics.time('bulk_seconds', index="git"):
+            pass
+
+        metrics_file = os.path.join(self.tmp_path, 'metrics.json')
+        stage_metrics.save(metrics_file)
+        with open(metrics_file) as f:
+            data = json.load(f)
+
+        self.assertListEqual(data['counters'], [{"name": "bulk_requests_total",
+                                                 "labels": {"index": "git"}, "value": 1}])
+        self.assertEqual(data['histograms'][0]['count'], 1)
+        self.assertEqual(data['histograms'][0]['buckets']['0.005'], 1)
+
+        metrics_file = os.path.join(self.tmp_path, 'metrics.prom')
+        stage_metrics.save(metrics_file)
+        with open(metrics_file) as f:
+            self.assertIn('gelk_bulk_requests_total{index="git"} 1\n', f.read())
+
+    @httpretty.activate
+    def test_bulk_metrics(self):
+        """Test that the bulk requests, bytes and errors are counted"""
+
+        url = 'http://es6.com'
+        items = [{"index": {"_id": "1", "status": 201}},
+                 {"index": {"_id": "2", "status": 400, "error": "mapper_parsing_exception"}}]
+        httpretty.register_uri(httpretty.GET, url, body=json.dumps({"version": {"number": "6.1.0"}}))
+        httpretty.register_uri(httpretty.GET, url + '/git', body="{}")
+        httpretty.register_uri(httpretty.PUT, url + '/git/items/_bulk',
+                               body=json.dumps({"errors": True, "items": items}))
+
+        metrics.reset()
+        elastic = ElasticSearch(url, 'git')
+        inserted = elastic.bulk_upload([{"uuid": "1"}, {"uuid": "2"}], "uuid")
+        self.assertEqual(inserted, 1)
+
+        counters = {counter['name']: counter['value'] for counter in metrics.to_json()['counters']}
+        self.assertEqual(counters['bulk_requests_total'], 1)
+        self.assertEqual(counters['bulk_errors_total'], 1)
+        self.assertGreater(counters['bulk_bytes_total'], 0)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    unittest.main()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+import contextlib
+import logging
+import sys
+import unittest
+
+from datetime import datetime
+
+if '..' not in sys.path:
+    sys.path.insert(0, '..')
+
+from grimoire_elk.elk.enrich import Enrich, SORTINGHAT_LIBS
+from grimoire_elk.metrics import metrics
+
+if SORTINGHAT_LIBS:
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from sqlalchemy.pool import StaticPool
+    from sortinghat import utils
+    from sortinghat.db.model import (ModelBase, Enrollment, Identity,
+                                     Organization, Profile, UniqueIdentity)
+    from grimoire_elk.elk.sortinghat import SortingHat
+
+
+class SqliteDatabase(object):
+    """ In memory SortingHat database with the same connect() than Database """
+
+    def __init__(self):
+        self._engine = create_engine('sqlite://', poolclass=StaticPool,
+                                     connect_args={'check_same_thread': False})
+        ModelBase.metadata.create_all(self._engine)
+        self._Session = sessionmaker(bind=self._engine)
+
+    @contextlib.contextmanager
+    def connect(self):
+        session = self._Session()
+        try:
+            yield session
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+
+class MailEnrich(Enrich):
+    """ Enrich whose raw items have just a From identity """
+
+    def get_connector_name(self):
+        return "mbox"
+
+    def get_identities(self, item):
+        yield item['from']
+
+
+@unittest.skipIf(not SORTINGHAT_LIBS, "SortingHat not available")
+class TestSortingHatBatch(unittest.TestCase):
+    """Unit tests for the batched SortingHat identity resolution"""
+
+    def setUp(self):
+        self.db = SqliteDatabase()
+        self.identities = [
+            {"email": "jsmith@example.com", "name": "John Smith", "username": None},
+            {"email": "jsmith@bitergia.com", "name": "John Smith", "username": None},
+            {"email": "jdoe@example.com", "name": "Jane Doe", "username": None},
+            {"email": "bot@example.com", "name": "CI Bot", "username": None}
+        ]
+        uuids = ["jsmith", "jsmith", "jdoe", "bot"]
+
+        with self.db.connect() as session:
+            example = Organization(name="Example")
+            bitergia = Organization(name="Bitergia")
+            session.add_all([example, bitergia])
+            for uuid in set(uuids):
+                session.add(UniqueIdentity(uuid=uuid))
+            session.flush()
+            for identity, uuid in zip(self.identities, uuids):
+                sh_id = utils.uuid("mbox", email=identity['email'],
+                                   name=identity['name'], username=identity['username'])
+                session.add(Identity(id=sh_id, uuid=uuid, source="mbox", **identity))
+            session.add(Profile(uuid="jsmith", name="John Smith",
+                                email="jsmith@example.com", is_bot=False))
+            session.add(Profile(uuid="bot", name="Bot", email=None, is_bot=True))
+            session.add(Enrollment(uuid="jsmith", organization=example,
+                                   start=datetime(1900, 1, 1), end=datetime(2015, 1, 1)))
+            session.add(Enrollment(uuid="jsmith", organization=bitergia,
+                                   start=datetime(2015, 1, 1), end=datetime(2100, 1, 1)))
+
+        self.enrich = MailEnrich()
+        self.enrich.sh_db = self.db
+        self.enrich.sortinghat = True
+
+    def test_get_profiles(self):
+        """Test that profiles of several uuids are read at once"""
+
+        profiles = SortingHat.get_profiles(self.db, ["jsmith", "jdoe", "bot"])
+        self.assertDictEqual(profiles, {
+            "jsmith": {"name": "John Smith", "email": "jsmith@example.com", "is_bot": False},
+            "bot": {"name": "Bot", "email": None, "is_bot": True}
+        })
+
+    def test_get_enrollments(self):
+        """Test that enrollments of several uuids are read at once"""
+
+        enrollments = SortingHat.get_enrollments(self.db, ["jsmith", "jdoe"])
+        self.assertListEqual(list(enrollments), ["jsmith"])
+        self.assertListEqual([name for _, _, name in enrollments["jsmith"]],
+                             ["Bitergia", "Example"])
+
+    def test_resolve_sh_identities(self):
+        """Test that the batched resolution gives the same SH fields"""
+
+        dates = [datetime(2010, 1, 1), datetime(2017, 1, 1), None]
+        expected = [self.enrich.get_item_sh_fields(identity, date)
+                    for identity in self.identities for date in dates]
+
+        self.enrich.resolve_sh_identities([{"from": identity} for identity in self.identities])
+        self.assertEqual(len(self.enrich.sh_batch_ids), 4)
+        self.assertSetEqual(self.enrich.sh_batch_uuids, {"jsmith", "jdoe", "bot"})
+
+        fields = [self.enrich.get_item_sh_fields(identity, date)
+                  for identity in self.identities for date in dates]
+        self.assertListEqual(fields, expected)
+        self.assertEqual(fields[1]['author_org_name'], "Bitergia")
+        self.assertEqual(fields[3]['author_org_name'], "Example")
+        self.assertTrue(fields[9]['author_bot'])
+
+        self.enrich.resolve_sh_identities([])
+        self.assertDictEqual(self.enrich.sh_batch_ids, {})
+
+    def test_get_sh_ids_lookups(self):
+        """Test that the lookups in the batch, in the cache and in SortingHat are counted apart"""
+
+        self.enrich.resolve_sh_identities([{"from": self.identities[0]}])
+
+        metrics.reset()
+        self.enrich.get_sh_ids(self.identities[0], "mbox")
+        sh_ids = [self.enrich.get_sh_ids(self.identities[2], "mbox") for _ in range(3)]
+        self.assertEqual(sh_ids[0]["uuid"], "jdoe")
+        self.assertListEqual(sh_ids, [sh_ids[0]] * 3)
+
+        lookups = {counter['labels']['source']: counter['value'] for counter in metrics.to_json()['counters']
+                   if counter['name'] == 'sortinghat_lookups_total'}
+        self.assertDictEqual(lookups, {"batch": 1, "sortinghat": 1, "cache": 2})
+
+    def test_add_identities(self):
+        """Test that only new identities, profiles and organizations are added"""
+
+        identities = self.identities + [
+            {"email": "JSMITH@example.com", "name": "John Smith", "username": None},
+            {"email": None, "name": None, "username": None},
+            {"email": "new@example.com", "name": None, "username": "new", "company": "Example"},
+            {"email": "jdoe@example.com", "name": "Jane Doe", "username": None, "company": "Acme"},
+            {"email": None, "name": None, "username": "other", "company": "acme"}
+        ]
+
+        bulk_size = SortingHat.bulk_size
+        SortingHat.bulk_size = 3
+        try:
+            total = SortingHat.add_identities(self.db, identities, "mbox")
+        finally:
+            SortingHat.bulk_size = bulk_size
+        self.assertEqual(total, len(identities))
+
+        new_id = utils.uuid("mbox", email="new@example.com", username="new")
+        other_id = utils.uuid("mbox", username="other")
+        with self.db.connect() as session:
+            self.assertEqual(session.query(Identity).count(), 6)
+            self.assertEqual(session.query(Organization).count(), 3)
+            profile = session.query(Profile).filter(Profile.uuid == new_id).one()
+            self.assertEqual((profile.name, profile.email), ("new", "new@example.com"))
+
+        # Only the first identity of a new organization is enrolled in it
+        enrollments = SortingHat.get_enrollments(self.db, [new_id, other_id, "jdoe"])
+        self.assertListEqual(list(enrollments), ["jdoe"])
+        self.assertEqual([name for _, _, name in enrollments["jdoe"]], ["Acme"])
+
+        # Loading them again does not change anything
+        SortingHat.add_identities(self.db, identities, "mbox")
+        with self.db.connect() as session:
+            self.assertEqual(session.query(Identity).count(), 6)
+            self.assertEqual(session.query(Enrollment).count(), 3)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    unittest.main()
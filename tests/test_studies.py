@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+import json
+import logging
+import sys
+import unittest
+
+import httpretty
+
+if '..' not in sys.path:
+    sys.path.insert(0, '..')
+
+from grimoire_elk.elk.elastic import ElasticSearch
+from grimoire_elk.elk.enrich import Enrich
+from grimoire_elk.metrics import metrics
+from grimoire_elk.studies import run_studies, study
+
+
+class StudiesEnrich(Enrich):
+    """ Enrich with studies recording its calls """
+
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+        self.studies = [self.study_commits, self.study_failing, self.study_plain]
+
+    def get_connector_name(self):
+        return "test"
+
+    @study(filters=[{"term": {"kind": "commit"}}])
+    def study_commits(self, enrich_backend, no_incremental=False, from_date=None):
+        self.calls.append(("study_commits", from_date))
+        return 10
+
+    @study()
+    def study_failing(self, enrich_backend, no_incremental=False, from_date=None):
+        self.calls.append(("study_failing", from_date))
+        raise RuntimeError("Study failed")
+
+    def study_plain(self, enrich_backend, no_incremental=False):
+        self.calls.append(("study_plain", None))
+        return 2
+
+
+class TestStudies(unittest.TestCase):
+    """Unit tests for the runner of the studies"""
+
+    def setUp(self):
+        self.url = 'http://es6.com'
+        self.checkpoints = {}
+        self.last_date = "2018-01-01T00:00:00.000Z"
+        self.queries = []
+
+        httpretty.enable()
+        httpretty.register_uri(httpretty.GET, self.url,
+                               body=json.dumps({"version": {"number": "6.1.0"}}))
+        httpretty.register_uri(httpretty.GET, self.url + '/test_enrich', body="{}")
+        httpretty.register_uri(httpretty.POST, self.url + '/test_enrich/_search',
+                               body=self.__search_callback)
+        for study_name in ["study_commits", "study_failing"]:
+            checkpoint_url = self.url + '/gelk_studies/items/test_enrich_' + study_name
+            httpretty.register_uri(httpretty.GET, checkpoint_url, body=self.__checkpoint_callback)
+            httpretty.register_uri(httpretty.PUT, checkpoint_url, body=self.__checkpoint_callback)
+
+        self.enrich = StudiesEnrich()
+        self.enrich.set_elastic(ElasticSearch(self.url, 'test_enrich'))
+
+    def tearDown(self):
+        httpretty.disable()
+        httpretty.reset()
+
+    def __search_callback(self, request, uri, headers):
+        self.queries.append(json.loads(request.body.decode('utf-8')))
+        agg = {"value": 1514764800000.0, "value_as_string": self.last_date}
+        return (200, headers, json.dumps({"aggregations": {"last_date": agg}}))
+
+    def __checkpoint_callback(self, request, uri, headers):
+        doc_id = uri.split('/')[-1]
+        if request.method == 'PUT':
+            self.checkpoints[doc_id] = json.loads(request.body.decode('utf-8'))
+            return (200, headers, "{}")
+        if doc_id not in self.checkpoints:
+            return (404, headers, json.dumps({"found": False}))
+        return (200, headers, json.dumps({"found": True, "_source": self.checkpoints[doc_id]}))
+
+    def test_run_studies(self):
+        """Test that the studies are run from its checkpoint and a failure doesn't stop the others"""
+
+        metrics.reset()
+        results = run_studies(self.enrich)
+        self.assertDictEqual(results, {"study_commits": 10, "study_failing": None, "study_plain": 2})
+        self.assertListEqual(self.enrich.calls, [("study_commits", None), ("study_failing", None),
+                                                 ("study_plain", None)])
+        self.assertListEqual(self.queries[0]["query"]["bool"]["filter"], [{"term": {"kind": "commit"}}])
+
+        # Only the checkpoint of the study that didn't fail is stored
+        self.assertListEqual(list(self.checkpoints), ["test_enrich_study_commits"])
+        checkpoint = self.checkpoints["test_enrich_study_commits"]
+        self.assertEqual(checkpoint["checkpoint"], self.last_date)
+        self.assertEqual(checkpoint["processed"], 10)
+
+        counters = {(counter['name'], counter['labels'].get('study')): counter['value']
+                    for counter in metrics.to_json()['counters']}
+        self.assertEqual(counters[('study_items_total', 'study_commits')], 10)
+        self.assertEqual(counters[('study_errors_total', 'study_failing')], 1)
+
+        # No new items since the checkpoint
+        self.enrich.calls = []
+        results = run_studies(self.enrich)
+        self.assertEqual(results["study_commits"], 0)
+        self.assertNotIn(("study_commits", None), self.enrich.calls)
+
+        # New items, processed from the checkpoint
+        self.enrich.calls = []
+        previous_date = self.last_date
+        self.last_date = "2018-02-01T00:00:00.000Z"
+        run_studies(self.enrich)
+        self.assertIn(("study_commits", previous_date), self.enrich.calls)
+        self.assertEqual(self.checkpoints["test_enrich_study_commits"]["checkpoint"], self.last_date)
+
+        # All the items are processed without incremental
+        self.enrich.calls = []
+        run_studies(self.enrich, no_incremental=True)
+        self.assertIn(("study_commits", None), self.enrich.calls)
+
+    def test_run_studies_concurrent(self):
+        """Test that the studies can run concurrently"""
+
+        self.enrich.studies_workers = 3
+
+        results = run_studies(self.enrich)
+        self.assertDictEqual(results, {"study_commits": 10, "study_failing": None, "study_plain": 2})
+        self.assertEqual(len(self.enrich.calls), 3)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    unittest.main()
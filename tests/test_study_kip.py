@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+
+import fnmatch
+import json
+import logging
+import sys
+import unittest
+
+from datetime import datetime, timedelta
+from unittest import mock
+
+import httpretty
+
+if '..' not in sys.path:
+    sys.path.insert(0, '..')
+
+from grimoire_elk.elk.elastic import ElasticSearch
+from grimoire_elk.elk.mbox import MBoxEnrich
+
+
+def matches(doc, query):
+    """ Check if a doc matches the filters used by the study """
+
+    if 'bool' in query:
+        clauses = query['bool']
+        must = clauses.get('filter', [])
+        must_not = clauses.get('must_not', [])
+        must_not = must_not if isinstance(must_not, list) else [must_not]
+        should = clauses.get('should', [])
+        matches_must = all(matches(doc, clause) for clause in must)
+        matches_must_not = any(matches(doc, clause) for clause in must_not)
+        matches_should = not should or any(matches(doc, clause) for clause in should)
+        return matches_must and not matches_must_not and matches_should
+    if 'wildcard' in query:
+        field, pattern = list(query['wildcard'].items())[0]
+        return fnmatch.fnmatchcase(doc.get(field) or '', pattern)
+    if 'exists' in query:
+        return doc.get(query['exists']['field']) is not None
+    if 'terms' in query:
+        field, values = list(query['terms'].items())[0]
+        return doc.get(field) in values
+    if 'range' in query:
+        field, limits = list(query['range'].items())[0]
+        return doc.get(field) is not None and doc[field] > limits['gt']
+    raise ValueError("Query not supported %s" % query)
+
+
+class TestKafkaKip(unittest.TestCase):
+    """Unit tests for the Kafka KIP study"""
+
+    def setUp(self):
+        self.url = 'http://es6.com'
+        self.docs = {}
+        self.updated = []
+        self.queries = []
+
+        self.add_message("1", "[DISCUSS] KIP-1: Quotas", "2017-01-01T10:00:00+00:00")
+        self.add_message("2", "Re: [DISCUSS] KIP-1: Quotas", "2017-01-03T10:00:00+00:00")
+        self.add_message("3", "[VOTE] KIP-1: Quotas", "2017-01-05T10:00:00+00:00", "+1 (binding)")
+        self.add_message("4", "Re: [VOTE] KIP-1: Quotas", "2017-01-06T10:00:00+00:00", "+1 (binding)")
+        self.add_message("5", "Re: [VOTE] KIP-1: Quotas", "2017-01-07T10:00:00+00:00", "+1 (non-binding)")
+        self.add_message("6", "[DISCUSS] KIP-2: Security", "2016-01-01T10:00:00+00:00")
+        self.add_message("7", "Kafka release", "2017-01-01T10:00:00+00:00")
+
+        httpretty.enable()
+        httpretty.register_uri(httpretty.GET, self.url,
+                               body=json.dumps({"version": {"number": "6.1.0"}}))
+        httpretty.register_uri(httpretty.GET, self.url + '/mbox_enrich', body="{}")
+        httpretty.register_uri(httpretty.POST, self.url + '/mbox_enrich/_search',
+                               body=self.__search_callback)
+        httpretty.register_uri(httpretty.POST, self.url + '/_search/scroll',
+                               body=json.dumps({"_scroll_id": "1", "hits": {"hits": []}}))
+        httpretty.register_uri(httpretty.DELETE, self.url + '/_search/scroll', body="{}")
+        httpretty.register_uri(httpretty.PUT, self.url + '/mbox_enrich/items/_bulk',
+                               body=self.__bulk_callback)
+
+        self.enrich = MBoxEnrich()
+        self.enrich.set_elastic(ElasticSearch(self.url, 'mbox_enrich'))
+
+    def tearDown(self):
+        httpretty.disable()
+        httpretty.reset()
+
+    def add_message(self, uuid, subject, date, body=""):
+        self.docs[uuid] = {"uuid": uuid, "Subject": subject, "email_date": date,
+                           "body_extract": body, "body": "Message body " * 100}
+
+    def __search_callback(self, request, uri, headers):
+        query = json.loads(request.body.decode('utf-8'))
+        self.queries.append(query['query'])
+        hits = [{"_id": doc_id, "_source": {field: doc[field] for field in query['_source'] if field in doc}}
+                for doc_id, doc in sorted(self.docs.items()) if matches(doc, query['query'])]
+        return (200, headers, json.dumps({"_scroll_id": "1", "hits": {"hits": hits}}))
+
+    def __bulk_callback(self, request, uri, headers):
+        lines = [line for line in request.body.decode('utf-8').split('\n') if line]
+        items = []
+        for action, doc in zip(lines[0::2], lines[1::2]):
+            doc_id = json.loads(action)["update"]["_id"]
+            self.docs[doc_id].update(json.loads(doc)["doc"])
+            self.updated.append(doc_id)
+            items.append({"update": {"_id": doc_id, "status": 200}})
+        return (200, headers, json.dumps({"errors": False, "items": items}))
+
+    def test_kafka_kip(self):
+        """Test that the KIP fields are computed in one pass"""
+
+        self.enrich.kafka_kip(self.enrich)
+
+        self.assertListEqual(sorted(self.updated), ["1", "2", "3", "4", "5", "6"])
+        self.assertNotIn("kip", self.docs["7"])
+
+        self.assertEqual(self.docs["1"]["kip_type"], "discuss")
+        self.assertEqual(self.docs["1"]["kip_start_end"], "discuss_start")
+        self.assertEqual(self.docs["2"]["kip_start_end"], "discuss_end")
+        self.assertEqual(self.docs["2"]["kip_discuss_time_days"], 2.0)
+        self.assertEqual(self.docs["3"]["kip_vote"], 1)
+        self.assertEqual(self.docs["3"]["kip_binding"], 1)
+        self.assertEqual(self.docs["5"]["kip_binding"], 0)
+        self.assertEqual(self.docs["5"]["kip_status"], "discarded")
+        self.assertEqual(self.docs["1"]["kip_final_status"], "discarded")
+        self.assertEqual(self.docs["6"]["kip_status"], "inactive")
+        # Its only message is the first one, not the last one
+        self.assertIsNone(self.docs["6"].get("kip_final_status"))
+
+    def test_kafka_kip_incremental(self):
+        """Test that only the KIPs with new messages are computed again"""
+
+        self.enrich.kafka_kip(self.enrich)
+
+        # No new messages
+        self.updated = []
+        self.enrich.kafka_kip(self.enrich)
+        self.assertListEqual(self.updated, [])
+
+        # A third binding vote adopts KIP-1
+        self.add_message("8", "Re: [VOTE] KIP-1: Quotas", "2017-01-08T10:00:00+00:00", "+1 binding")
+        self.enrich.kafka_kip(self.enrich)
+
+        self.assertNotIn("6", self.updated)
+        self.assertIn("8", self.updated)
+        self.assertEqual(self.docs["8"]["kip_status"], "adopted")
+        self.assertEqual(self.docs["8"]["kip_start_end"], "voting_end")
+        self.assertEqual(self.docs["1"]["kip_final_status"], "adopted")
+        self.assertIsNone(self.docs["5"]["kip_start_end"])
+
+    def test_kafka_kip_incremental_inactive(self):
+        """Test that the open KIPs become inactive without new messages"""
+
+        recent = (datetime.utcnow() - timedelta(days=80)).isoformat() + "+00:00"
+        self.add_message("9", "[DISCUSS] KIP-3: Streams", recent)
+        self.enrich.kafka_kip(self.enrich)
+        self.assertEqual(self.docs["9"]["kip_status"], "discussion")
+        inactive_days = self.docs["9"]["kip_discuss_inactive_days"]
+
+        # 20 days later, without new messages
+        self.updated = []
+        later = datetime.utcnow() + timedelta(days=20)
+        with mock.patch('grimoire_elk.elk.mbox_study_kip.datetime') as mock_datetime:
+            mock_datetime.utcnow.return_value = later
+            self.enrich.kafka_kip(self.enrich)
+
+        self.assertEqual(self.docs["9"]["kip_status"], "inactive")
+        self.assertGreater(self.docs["9"]["kip_discuss_inactive_days"], inactive_days)
+        # The closed KIPs are not computed again
+        self.assertNotIn("1", self.updated)
+
+    def test_kafka_kip_incremental_closed(self):
+        """Test that the messages of the closed KIPs are not read again"""
+
+        self.add_message("10", "Question about KIP-1", "2017-02-01T10:00:00+00:00")
+        self.enrich.kafka_kip(self.enrich)
+        self.assertEqual(self.docs["10"]["kip"], 0)
+        self.assertEqual(self.docs["1"]["kip_final_status"], "discarded")
+
+        # Only the open KIP-2 is computed again
+        self.queries = []
+        self.enrich.kafka_kip(self.enrich)
+        kips_query = self.queries[-1]['bool']['filter'][-1]['bool']['should'][0]
+        self.assertDictEqual(kips_query, {"terms": {"kip": [2]}})
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    unittest.main()
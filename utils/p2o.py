@@ -32,6 +32,9 @@ from grimoire_elk.arthur import feed_backend, enrich_backend
 from grimoire_elk.elastic_items import ElasticItems
 
 from grimoire_elk.elk.elastic import ElasticSearch
+from grimoire_elk.elk.enrich import Enrich
+from grimoire_elk.elk.git import GitEnrich
+from grimoire_elk.metrics import metrics
 from grimoire_elk.utils import get_params_parser, config_logging
 
 
@@ -64,8 +67,24 @@ if __name__ == '__main__':
             # Configure elastic bulk size and scrolling
             if args.bulk_size:
                 ElasticSearch.max_items_bulk = args.bulk_size
+            if args.bulk_bytes:
+                ElasticSearch.max_bulk_bytes = args.bulk_bytes
+            if args.bulk_workers:
+                ElasticSearch.bulk_workers = args.bulk_workers
             if args.scroll_size:
                 ElasticItems.scroll_size = args.scroll_size
+            if args.scroll_prefetch:
+                ElasticItems.scroll_prefetch = args.scroll_prefetch
+            if args.search_after:
+                ElasticItems.search_after = True
+            if args.enrich_workers:
+                Enrich.enrich_workers = args.enrich_workers
+            if args.studies_workers:
+                Enrich.studies_workers = args.studies_workers
+            if args.github_logins_cache:
+                GitEnrich.github_logins_cache_file = args.github_logins_cache
+            if args.github_workers:
+                GitEnrich.github_workers = args.github_workers
             if not args.enrich_only:
                 feed_backend(url, clean, args.fetch_cache,
                              args.backend, args.backend_args,
@@ -93,7 +112,8 @@ if __name__ == '__main__':
                                args.author_id, args.author_uuid,
                                args.filter_raw, args.filters_raw_prefix,
                                args.jenkins_rename_file, unaffiliated_group,
-                               args.pair_programming)
+                               args.pair_programming, args.enrich_slices,
+                               args.enrich_async)
                 logging.info("Enrich backend completed")
             elif args.events_enrich:
                 logging.info("Enrich option is needed for events_enrich")
@@ -103,6 +123,9 @@ if __name__ == '__main__':
     except KeyboardInterrupt:
         logging.info("\n\nReceived Ctrl-C or other break signal. Exiting.\n")
         sys.exit(0)
+    finally:
+        if args.metrics_file:
+            metrics.save(args.metrics_file)
 
     total_time_min = (datetime.now() - app_init).total_seconds() / 60
 